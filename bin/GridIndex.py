@@ -0,0 +1,112 @@
+import math
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Uniform grid spatial index over envelopes (using OGR ordering of minx, maxx, miny, maxy). Each item is registered in
+# every cell its envelope touches, so lookups only consider items in the cells overlapped by the query envelope.
+class GridIndex:
+
+    cell_size = 1.0
+    cells = None
+    envelopes = None
+
+    def __init__(self, cell_size):
+        if not cell_size or cell_size <= 0:
+            raise Exception("Grid index cell size must be greater than zero")
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.envelopes = {}
+
+    @staticmethod
+    def from_envelopes(envelopes, cell_size=None):
+        # if cell size not supplied, use average envelope span so each item touches only a few cells
+        if not cell_size:
+            total_span = 0.0
+            for env in envelopes.values():
+                total_span += max(env[1] - env[0], env[3] - env[2])
+            cell_size = total_span / len(envelopes) if len(envelopes) else 1.0
+            if cell_size <= 0:
+                cell_size = 1.0
+        index = GridIndex(cell_size)
+        for item_id in sorted(envelopes.keys()):
+            index.insert(item_id, envelopes[item_id])
+        return index
+
+    def _cell_range(self, envelope):
+        return (
+            int(math.floor(envelope[0] / self.cell_size)),
+            int(math.floor(envelope[1] / self.cell_size)),
+            int(math.floor(envelope[2] / self.cell_size)),
+            int(math.floor(envelope[3] / self.cell_size))
+        )
+
+    def insert(self, item_id, envelope):
+        envelope = tuple(envelope)
+        self.envelopes[item_id] = envelope
+        cx0, cx1, cy0, cy1 = self._cell_range(envelope)
+        for cx in range(cx0, cx1+1):
+            for cy in range(cy0, cy1+1):
+                key = (cx, cy)
+                if key in self.cells:
+                    self.cells[key].append(item_id)
+                else:
+                    self.cells[key] = [item_id]
+
+    def query(self, envelope, buffer=0):
+        # sorted ids of items whose envelopes overlap the given envelope (optionally expanded by buffer)
+        if buffer:
+            envelope = (envelope[0]-buffer, envelope[1]+buffer, envelope[2]-buffer, envelope[3]+buffer)
+        cx0, cx1, cy0, cy1 = self._cell_range(envelope)
+        found = set()
+        for cx in range(cx0, cx1+1):
+            for cy in range(cy0, cy1+1):
+                key = (cx, cy)
+                if key not in self.cells:
+                    continue
+                for item_id in self.cells[key]:
+                    if item_id in found:
+                        continue
+                    env = self.envelopes[item_id]
+                    if env[0] > envelope[1] or env[1] < envelope[0]:
+                        continue
+                    if env[2] > envelope[3] or env[3] < envelope[2]:
+                        continue
+                    found.add(item_id)
+        return sorted(found)
+
+    def candidate_pairs(self):
+        # yields every (i, j) pair of overlapping items, i < j, exactly once
+        for item_id in sorted(self.envelopes.keys()):
+            for other_id in self.query(self.envelopes[item_id]):
+                if other_id > item_id:
+                    yield item_id, other_id
+
+    def save(self, path, signature=None):
+        with open(path, 'wb') as f:
+            pickle.dump({
+                'signature': signature,
+                'cell_size': self.cell_size,
+                'cells': self.cells,
+                'envelopes': self.envelopes
+            }, f, 2)
+
+    @staticmethod
+    def load(path, signature=None):
+        # returns None if file does not exist or was saved with a different signature
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            return None
+        if data.get('signature') != signature:
+            return None
+        index = GridIndex(data['cell_size'])
+        index.cells = data['cells']
+        index.envelopes = data['envelopes']
+        return index
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+import numpy as np
+
+
+# Samples a raster band by pixel coordinates, reading whole blocks (in the band's native block size) and keeping the
+# most recently used blocks in memory, so nearby samples don't each hit the raster.
+class RasterBlockCache:
+
+    band = None
+    block_size = None
+    raster_size = None
+    max_blocks = 64
+
+    def __init__(self, band, max_blocks=64):
+        self.band = band
+        self.block_size = tuple(band.GetBlockSize())
+        self.raster_size = (band.XSize, band.YSize)
+        self.max_blocks = max_blocks
+        self.nodata = band.GetNoDataValue()
+        self._blocks = OrderedDict()
+
+    def _block(self, bx, by):
+        key = (bx, by)
+        if key in self._blocks:
+            block = self._blocks.pop(key)
+        else:
+            x0 = bx*self.block_size[0]
+            y0 = by*self.block_size[1]
+            width = min(self.block_size[0], self.raster_size[0] - x0)
+            height = min(self.block_size[1], self.raster_size[1] - y0)
+            block = self.band.ReadAsArray(x0, y0, width, height).astype(float)
+            if self.nodata is not None:
+                block[block == self.nodata] = np.nan
+            if len(self._blocks) >= self.max_blocks:
+                self._blocks.popitem(last=False)
+        self._blocks[key] = block
+        return block
+
+    def sample(self, px, py):
+        # values at integer pixel coordinate arrays, NaN outside raster or at no data. Samples are visited grouped by
+        # block, so each block is read once per call.
+        px = np.asarray(px, dtype=np.int64)
+        py = np.asarray(py, dtype=np.int64)
+        values = np.full(len(px), np.nan)
+        inside = (px >= 0) & (py >= 0) & (px < self.raster_size[0]) & (py < self.raster_size[1])
+        index = np.nonzero(inside)[0]
+        bx = px[index] // self.block_size[0]
+        by = py[index] // self.block_size[1]
+        order = np.lexsort((bx, by))
+        for i in order.tolist():
+            block = self._block(int(bx[i]), int(by[i]))
+            k = index[i]
+            values[k] = block[py[k] - by[i]*self.block_size[1], px[k] - bx[i]*self.block_size[0]]
+        return values
@@ -0,0 +1,42 @@
+# Disjoint sets over integer items 0..n-1. Roots are always the smallest item in the set, so grouping is deterministic
+# regardless of the order unions are made in.
+class UnionFind:
+
+    parent = None
+
+    def __init__(self, count):
+        self.parent = list(range(count))
+
+    def add(self):
+        self.parent.append(len(self.parent))
+        return len(self.parent) - 1
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            # path halving
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return root_a
+        if root_a < root_b:
+            self.parent[root_b] = root_a
+            return root_a
+        self.parent[root_a] = root_b
+        return root_b
+
+    def groups(self):
+        # lists of members for each set, ordered by smallest member
+        by_root = {}
+        for item in range(len(self.parent)):
+            root = self.find(item)
+            if root in by_root:
+                by_root[root].append(item)
+            else:
+                by_root[root] = [item]
+        return [by_root[root] for root in sorted(by_root.keys())]
@@ -0,0 +1,55 @@
+import multiprocessing
+import numpy as np
+from bin.UnionFind import UnionFind
+
+
+def _basins(network, use_incidence=False):
+    # Split network into connected components (basins), joining segments through their from/to nodes, or through the
+    # undirected node incidence if flow direction isn't known yet. Returns list of (segments, nodes) index arrays,
+    # largest basin first. Nodes without segments are dropped.
+    segment_count = network.segment_count
+    sets = UnionFind(segment_count + network.node_count)
+    if use_incidence:
+        slot_node = np.repeat(np.arange(network.node_count), np.diff(network.inc_offsets))
+        pairs = zip(network.inc_segments.tolist(), (slot_node + segment_count).tolist())
+    else:
+        pairs = []
+        for nodes in (network.from_node, network.to_node):
+            connected = np.nonzero(nodes >= 0)[0]
+            pairs += zip(connected.tolist(), (nodes[connected] + segment_count).tolist())
+    for segment, node in pairs:
+        sets.union(segment, node)
+
+    basins = []
+    for members in sets.groups():
+        members = np.array(members, dtype=np.int64)
+        segments = members[members < segment_count]
+        if len(segments):
+            basins.append((segments, members[members >= segment_count] - segment_count))
+    # stable, so equal sized basins keep network order
+    basins.sort(key=lambda basin: -len(basin[0]))
+    return basins
+
+
+def _map_pool(worker, tasks, processes):
+    # Run worker over tasks (e.g. basins or tiles, largest first) in a process pool, yielding (index, result) as each
+    # finishes. Tasks are handed out one at a time in order, so the largest start first and smaller ones fill in.
+    if not processes or processes <= 1 or len(tasks) <= 1:
+        for i in range(len(tasks)):
+            yield i, worker(tasks[i])
+        return
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        for result in pool.imap_unordered(_indexed_worker, [(worker, i, task) for i, task in enumerate(tasks)]):
+            yield result
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _indexed_worker(args):
+    worker, i, task = args
+    return i, worker(task)
@@ -1,219 +1,63 @@
-import csv
-import common.feature_utils as feature_utils
+import numpy as np
+from collections import deque
 from bin.PassPrint import PassPrint
-from shared import _get_segments, _parse_nodes
+from bin.basins import _basins, _map_pool
+from bin.network.Network import Network
+from shared import _parse_nodes, _read_network, _update_network_cache, _write_segment_columns
+from bin.tables import _write_table
 
 
 printer = None
 
 
 def calculate_flow(stream_dataset, stream_id_column, node_dataset_or_table, drainage_node_ids, from_node_column,
-                   to_node_column, braided_column, output_flow_table_path):
+                   to_node_column, braided_column, output_flow_table_path, processes=None):
     global printer
     if not printer:
         printer = PassPrint()
 
     # get segments
     printer.msg("Creating segments..")
-    segments = _get_segments(stream_dataset, stream_id_column)
+    network = _read_network(stream_dataset, stream_id_column)
     # get node network
     printer.msg("Creating node network..")
     nodes, drainage_nodes = _parse_nodes(node_dataset_or_table, drainage_node_ids=drainage_node_ids, require_drainage=True)
-
-    # maps by id
-    segment_map = {}
-    for segment in segments:
-        segment_map[segment.id] = segment
-    node_map = {}
-    for node in nodes:
-        node_map[node.id] = node
-        # all nodes assumed connected to start
-        node.end_node = False
-        node.start_node = False
+    network.set_incidence([node.id for node in nodes], [node.segments for node in nodes])
+    drainage_nodes = [network.node_index(node.id) for node in drainage_nodes]
+    nodes = None
 
     printer.msg("Calculating flow..")
-
-    # map first segments to drainage nodes
-    active_segments = []
-    for node in drainage_nodes:
-        # drainage node is end node
-        node.end_node = True
-        # for each segment linked
-        for s in range(len(node.segments)):
-            sid = node.segments[s]
-            # replace with actual segment object
-            segment = segment_map[sid]
-            if not segment:
-                raise Exception("Could not find segment ({0}) for node ({1})".format(node.id, sid))
-            node.segments[s] = segment
-            # link objects (since drainage, always to-relationship)
-            segment.to_node = node
-            # add to active
-            active_segments.append(segment)
-        # remove node from map
-        del node_map[node.id]
-
-    braided_count = 0
-
-    # now loop until no more active segments found
-    while len(active_segments):
-        active_nodes = []
-
-        for segment in active_segments:
-            # possible case with duplicates for braided streams
-            if segment.from_node:
-                segment.braided = True
-                braided_count += 1
-            else:
-                # find upstream node (can only be one)
-                from_node = None
-                from_node_seg_i = -1
-                mapped_nodes = []
-                for node in node_map.values():
-                    for s in range(len(node.segments)):
-                        # upstream node is node where linked segment is not yet properly attached to instance (just id)
-                        if isinstance(node.segments[s], int):
-                            if node.segments[s] == segment.id:
-                                from_node = node
-                                from_node_seg_i = s
-                                break
-                        # possible case of splitting stream where segment is already attached as flow-from
-                        elif node.segments[s] == segment:
-                            mapped_nodes.append(node)
-                            if node != segment.to_node:
-                                from_node = node
-                                break
-                    if from_node:
-                        break
-                # in complex braided streams this can happen
-                if not from_node:
-                    printer.error("Error finding upstream node for segment ({0})".format(segment.id))
-                    printer.error("  Often due to complex braided networks. Streams may be to be cleaned and reprocesses.")
-                    raise Exception("Error calculating network flow.")
-                # make upstream relationship
-                segment.from_node = from_node
-                if from_node_seg_i >= 0:
-                    from_node.segments[from_node_seg_i] = segment
-                # add to active nodes
-                active_nodes.append(from_node)
-                # trim down connected elements from maps (for nodes, first check every segment relationship has been
-                # matched as braided streams means there may be downstream split)
-                del segment_map[segment.id]
-                delete_node = True
-                for s in from_node.segments:
-                    if isinstance(s, int):
-                        delete_node = False
-                        break
-                if delete_node:
-                    del node_map[from_node.id]
-
-        # error check (may occur with complex braided streams until I fix it)
-        for segment in active_segments:
-            if not segment.from_node:
-                raise Exception("Could not match upstream node for segment ({0})".format(segment.id))
-
-        # check for braided streams
-        for node in active_nodes:
-            feeds_segments = []
-            for segment in active_segments:
-                if segment.from_node == node:
-                    feeds_segments.append(segment)
-            if len(feeds_segments) > 1:
-                for segment in feeds_segments:
-                    segment.braided = True
-
-        # clear active segments
-        active_segments = []
-        # find upstream segments for next set of nodes
-        for node in active_nodes:
-            connected_segments = []
-            for segment in segment_map.values():
-                for s in range(len(node.segments)):
-                    # check if segment matches
-                    if isinstance(node.segments[s], int) and node.segments[s] == segment.id:
-                        node.segments[s] = segment
-                        # add downstream (to segment) relationship
-                        if not segment.to_node:
-                            segment.to_node = node
-                            connected_segments.append(segment)
-                        # unless some other branch already added it as downstream, if upstream is free, mark as braided
-                        elif not segment.from_node:
-                            segment.from_node = node
-                            segment.braided = True
-                        # otherwise this braided network is too confusing to solve
-                        else:
-                            printer.error("Error finding upstream node for segment ({0})".format(segment.id))
-                            printer.error("  Often due to complex braided networks. Streams may be to be cleaned and reprocesses.")
-                            raise Exception("Error calculating network flow.")
-                        break
-            # if no upstream segment, mark node as starting node
-            if not len(connected_segments):
-                node.start_node = True
-            else:
-                active_segments += connected_segments
-
-    # for warnings later
-    unconnected_segments = segment_map.keys()
+    if processes and processes > 1:
+        braided_count, unconnected_segments = _solve_flow_basins(network, drainage_nodes, processes)
+    else:
+        braided_count, unconnected_segments = _solve_flow(network, drainage_nodes)
+    network.build_adjacency()
 
     if output_flow_table_path:
         printer.msg("Saving output table..")
-        with open(output_flow_table_path, 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([stream_id_column, from_node_column, to_node_column, braided_column])
-            for segment in segments:
-                from_node_id = segment.from_node.id if segment.from_node else ""
-                to_node_id = segment.to_node.id if segment.to_node else ""
-                writer.writerow([segment.id, from_node_id, to_node_id, 1 if segment.braided else 0])
+        _write_flow_table(network, output_flow_table_path,
+                          [stream_id_column, from_node_column, to_node_column, braided_column])
 
     printer.msg("Adding new attributes to shapefile")
 
-    stream_ds = feature_utils.getFeatureDataset(stream_dataset, write=True)
-    stream_layer = stream_ds.GetLayer()
-    stream_defn = stream_layer.GetLayerDefn()
-
-    index_stream_id = stream_defn.GetFieldIndex(stream_id_column)
-    if index_stream_id < 0:
-        return Exception("Could not find column ({0})".format(stream_id_column))
-    stream_id = stream_defn.GetFieldDefn(index_stream_id)
-
-    index_from_node = stream_defn.GetFieldIndex(from_node_column)
-    if index_from_node < 0:
-        printer.msg("  creating column {0}".format(from_node_column))
-        from_node = feature_utils.createFieldDefinition(from_node_column, int)
-        stream_layer.CreateField(from_node)
-
-    index_to_node = stream_defn.GetFieldIndex(to_node_column)
-    if index_to_node < 0:
-        printer.msg("  creating column {0}".format(to_node_column))
-        to_node = feature_utils.createFieldDefinition(to_node_column, int)
-        stream_layer.CreateField(to_node)
-
-    index_braided = stream_defn.GetFieldIndex(braided_column)
-    if index_braided < 0:
-        printer.msg("  creating column {0}".format(braided_column))
-        braided = feature_utils.createFieldDefinition(braided_column, int)
-        stream_layer.CreateField(braided)
-
-    segment_map = {}
-    for segment in segments:
-        segment_map[segment.id] = segment
-
-    printer.msg("  writing..")
-    stream_feat = stream_layer.GetNextFeature()
-    while stream_feat:
-        sid = feature_utils.getFieldValue(stream_feat, stream_id)
-        segment = segment_map[sid]
-        if segment.from_node:
-            stream_feat.SetField(from_node_column, segment.from_node.id)
-        if segment.to_node:
-            stream_feat.SetField(to_node_column, segment.to_node.id)
-        stream_feat.SetField(braided_column, 1 if segment.braided else 0)
-        stream_layer.SetFeature(stream_feat)
-        stream_feat = stream_layer.GetNextFeature()
-
-    stream_defn = None
-    stream_layer = None
-    stream_ds = None
+    # node columns of unconnected segments are left as they were
+    from_node_ids = [nid if nid >= 0 else None for nid in network.node_ids_of(network.from_node).tolist()]
+    to_node_ids = [nid if nid >= 0 else None for nid in network.node_ids_of(network.to_node).tolist()]
+    written_count, created = _write_segment_columns(stream_dataset, network, [
+        (from_node_column, from_node_ids),
+        (to_node_column, to_node_ids),
+        (braided_column, network.braided.astype(np.int64).tolist())
+    ])
+    for column in created:
+        printer.msg("  created column {0}".format(column))
+    printer.msg("  {0} features updated".format(written_count))
+
+    # so only cache node columns if all were written
+    cached = {braided_column: network.braided.astype(np.int64)}
+    if not len(unconnected_segments):
+        cached[from_node_column] = network.node_ids_of(network.from_node)
+        cached[to_node_column] = network.node_ids_of(network.to_node)
+    _update_network_cache(stream_dataset, stream_id_column, network, cached)
 
     # print warnings last
     # check for unconnected elements and throw up warnings
@@ -223,7 +67,7 @@ def calculate_flow(stream_dataset, stream_id_column, node_dataset_or_table, drai
             indent=0
         )
         printer.warn(
-            "  {0}: {1}".format(stream_id_column, ", ".join([str(sid) for sid in unconnected_segments])),
+            "  {0}: {1}".format(stream_id_column, ", ".join([str(sid) for sid in network.segment_ids[unconnected_segments]])),
             indent=0
         )
     # warning if braided/looping streams possible in network
@@ -232,3 +76,163 @@ def calculate_flow(stream_dataset, stream_id_column, node_dataset_or_table, drai
             "WARNING: Possible braided stream errors, check outputs and correct as needed before proceeding.",
             indent=0
         )
+
+
+def _write_flow_table(network, output_flow_table_path, header):
+    from_node_ids = network.node_ids_of(network.from_node).tolist()
+    to_node_ids = network.node_ids_of(network.to_node).tolist()
+    _write_table(output_flow_table_path, [(name, "int64", values) for name, values in zip(header, [
+        network.segment_ids.tolist(),
+        [nid if nid >= 0 else None for nid in from_node_ids],
+        [nid if nid >= 0 else None for nid in to_node_ids],
+        network.braided.astype(np.int64).tolist()
+    ])])
+
+
+def _solve_flow_basins(network, drainage_nodes, processes):
+    # Solve flow of each basin (connected component of node network) separately in a process pool, merging results
+    # back into network. Basins don't interact, so results match solving the whole network at once. Basins without
+    # drainage nodes are left unconnected.
+    all_basins = _basins(network, use_incidence=True)
+    node_basin = np.full(network.node_count, -1, dtype=np.int64)
+    for b in range(len(all_basins)):
+        node_basin[all_basins[b][1]] = b
+    # drainage nodes of each basin, in given order
+    basin_drainage = {}
+    for node in drainage_nodes:
+        basin_drainage.setdefault(int(node_basin[node]), []).append(node)
+
+    basins = []
+    tasks = []
+    unconnected_segments = []
+    for b in range(len(all_basins)):
+        segments, nodes = all_basins[b]
+        if b not in basin_drainage:
+            unconnected_segments += segments.tolist()
+            continue
+        basins.append((segments, nodes))
+        # as local node indices (basin nodes are sorted)
+        local_drainage = np.searchsorted(nodes, basin_drainage[b]).tolist()
+        tasks.append((network.subnetwork(segments, nodes), local_drainage))
+
+    braided_count = 0
+    for i, (count, unconnected, from_node, to_node, braided) in _map_pool(_solve_flow_basin, tasks, processes):
+        segments, nodes = basins[i]
+        braided_count += count
+        unconnected_segments += segments[unconnected].tolist()
+        network.from_node[segments] = np.where(from_node >= 0, nodes[from_node], -1)
+        network.to_node[segments] = np.where(to_node >= 0, nodes[to_node], -1)
+        network.braided[segments] = braided
+    return braided_count, sorted(unconnected_segments)
+
+
+def _solve_flow_basin(task):
+    # process pool worker
+    global printer
+    if not printer:
+        printer = PassPrint()
+    network, drainage_nodes = task
+    braided_count, unconnected = _solve_flow(network, drainage_nodes)
+    return braided_count, unconnected, network.from_node, network.to_node, network.braided
+
+
+def _solve_flow(network, drainage_nodes):
+    # Orient segments over the undirected node incidence, from drainage nodes upstream. Sets from/to node and braided
+    # arrays of network. Returns count of braided segments found and indices of unconnected segments.
+    # Loops (braids, canals, diversions) are the 2-edge-connected components of the network, found in linear time from
+    # its bridges (Tarjan). Condensing each to a single node leaves a forest joined by bridges, so every bridge is
+    # oriented towards the drainage node(s) of its tree. Within a loop, segments are oriented by search distance from
+    # the node(s) it drains through, ties broken by node index so no directed cycle is created, and all are flagged
+    # braided. Both follow from the search distance of each node to the nearest drainage node. Segments looping back
+    # onto the same node have no direction, and are left unconnected (so reported with unconnected segments).
+    seg_slot_offsets, seg_slots = Network._csr(network.inc_segments, network.segment_count)
+    slot_node = np.repeat(np.arange(network.node_count), np.diff(network.inc_offsets))
+    # nodes at either end of each segment (the same node for segments looping back on themselves, -1 for segments
+    # missing from node network)
+    in_network = np.diff(seg_slot_offsets) > 0
+    end_a = np.full(network.segment_count, -1, dtype=np.int64)
+    end_b = np.full(network.segment_count, -1, dtype=np.int64)
+    end_a[in_network] = slot_node[seg_slots[seg_slot_offsets[:-1][in_network]]]
+    end_b[in_network] = slot_node[seg_slots[seg_slot_offsets[1:][in_network] - 1]]
+    bridges = _bridges(network, end_a.tolist(), end_b.tolist())
+
+    # search distance to nearest drainage node
+    inc_offsets = network.inc_offsets.tolist()
+    inc_segments = network.inc_segments.tolist()
+    end_a_list = end_a.tolist()
+    end_b_list = end_b.tolist()
+    distance = [-1]*network.node_count
+    queue = deque()
+    for node in drainage_nodes:
+        if distance[node] < 0:
+            distance[node] = 0
+            queue.append(node)
+    while queue:
+        node = queue.popleft()
+        for segment in inc_segments[inc_offsets[node]:inc_offsets[node+1]]:
+            other = end_b_list[segment] if end_a_list[segment] == node else end_a_list[segment]
+            if distance[other] < 0:
+                distance[other] = distance[node] + 1
+                queue.append(other)
+    distance = np.array(distance, dtype=np.int64)
+
+    # downstream end is nearer to drainage (or the lower node index where both are as near)
+    distance_a = np.where(in_network, distance[end_a], -1)
+    distance_b = np.where(in_network, distance[end_b], -1)
+    connected = (distance_a >= 0) & (distance_b >= 0) & (end_a != end_b)
+    to_a = (distance_a < distance_b) | ((distance_a == distance_b) & (end_a <= end_b))
+    network.from_node[connected] = np.where(to_a, end_b, end_a)[connected]
+    network.to_node[connected] = np.where(to_a, end_a, end_b)[connected]
+    braided = connected & (~bridges | (distance_a == distance_b))
+    network.braided[braided] = True
+
+    # for warnings later
+    return int(braided.sum()), np.nonzero(~connected)[0].tolist()
+
+
+def _bridges(network, end_a, end_b):
+    # Bridges of the undirected node network (segments not on any loop), by Tarjan's low-link depth first search,
+    # iterative to avoid recursion limits. Parallel segments and segments looping back on themselves are never bridges.
+    inc_offsets = network.inc_offsets.tolist()
+    inc_segments = network.inc_segments.tolist()
+    visit_index = [-1]*network.node_count
+    low = [0]*network.node_count
+    bridges = np.zeros(network.segment_count, dtype=bool)
+    count = 0
+    for root in range(network.node_count):
+        if visit_index[root] >= 0:
+            continue
+        visit_index[root] = low[root] = count
+        count += 1
+        # depth first stack of nodes, the segment each was reached by, and next incidence slot to visit
+        node_stack = [root]
+        parent_stack = [-1]
+        slot_stack = [inc_offsets[root]]
+        while node_stack:
+            node = node_stack[-1]
+            slot = slot_stack[-1]
+            if slot < inc_offsets[node+1]:
+                slot_stack[-1] = slot + 1
+                segment = inc_segments[slot]
+                if segment == parent_stack[-1]:
+                    continue
+                other = end_b[segment] if end_a[segment] == node else end_a[segment]
+                if visit_index[other] < 0:
+                    visit_index[other] = low[other] = count
+                    count += 1
+                    node_stack.append(other)
+                    parent_stack.append(segment)
+                    slot_stack.append(inc_offsets[other])
+                elif visit_index[other] < low[node]:
+                    low[node] = visit_index[other]
+            else:
+                node_stack.pop()
+                segment = parent_stack.pop()
+                slot_stack.pop()
+                if node_stack:
+                    parent = node_stack[-1]
+                    if low[node] < low[parent]:
+                        low[parent] = low[node]
+                    if low[node] > visit_index[parent]:
+                        bridges[segment] = True
+    return bridges
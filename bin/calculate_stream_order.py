@@ -1,174 +1,482 @@
-import csv
-import common.feature_utils as feature_utils
-from shared import _get_segments, _parse_nodes
+import numpy as np
+from collections import deque
+from shared import _load_cached_columns, _missing_columns, _read_network, _update_network_cache, _write_segment_columns
+from bin.tables import _write_table
 from bin.PassPrint import PassPrint
-from bin.network.Node import Node
-from bin.network.Segment import Segment
+from bin.basins import _basins, _map_pool
 
 
 printer = None
 
 
+# supported stream order types, in default column order
+ORDER_TYPES = ("strahler", "shreve", "horton", "hack")
+
+
 def calculate_stream_order(stream_dataset, stream_id_column, from_node_column, to_node_column, braided_column,
-                           stream_order_column, output_table_path):
+                           stream_order_column, output_table_path, engine="python", order_columns=None,
+                           changed_stream_ids=None, processes=None):
     global printer
     if not printer:
         printer = PassPrint()
 
+    # orders to calculate as order type to column name (by default only Strahler)
+    if not order_columns:
+        order_columns = {"strahler": stream_order_column}
+    for order_type in order_columns:
+        if order_type not in ORDER_TYPES:
+            raise Exception("Unknown stream order type ({0})".format(order_type))
+    order_types = [order_type for order_type in ORDER_TYPES if order_type in order_columns]
+    incremental = changed_stream_ids is not None
+    if incremental and ("horton" in order_types or "hack" in order_types):
+        raise Exception("Incremental stream order update only supported for Strahler and Shreve orders")
+
+    if incremental:
+        # orders are updated from those stored by a previous full calculation, and node columns as last cached (before
+        # any edits), as reconnected segments also change orders downstream of their previous end nodes
+        stored_columns = [order_columns[order_type] for order_type in order_types]
+        missing = _missing_columns(stream_dataset, stored_columns)
+        if missing:
+            raise Exception("Incremental stream order update requires existing stream order columns ({0})".format(
+                ", ".join(missing)
+            ))
+        previous = _load_cached_columns(stream_dataset, stream_id_column,
+                                        [from_node_column, to_node_column] + stored_columns)
+        if previous is None:
+            raise Exception("Incremental stream order update requires stream orders cached by a previous full "
+                            "calculation, none found for stream dataset ({0})".format(stream_dataset))
+
     printer.msg("Creating segments..")
-    all_segments = _get_segments(stream_dataset, stream_id_column, from_node_column=from_node_column,
-                                 to_node_column=to_node_column, braided_column=braided_column)
+    network = _read_network(stream_dataset, stream_id_column, from_node_column=from_node_column,
+                            to_node_column=to_node_column, braided_column=braided_column,
+                            attribute_columns=[order_columns[t] for t in order_types] if incremental else None)
 
     printer.msg("Creating node network..")
-    all_nodes, first_order_nodes = _get_node_network(all_segments)
+    first_order_nodes = _get_node_network(network)
 
-    printer.msg("Assigning stream order..")
-    _assign_stream_order(first_order_nodes)
+    if incremental:
+        printer.msg("Updating stream order downstream of changed segments..")
+        changed_segments = network.segment_index(list(changed_stream_ids))
+        if (changed_segments < 0).any():
+            raise Exception("Could not find changed stream IDs ({0})".format(
+                ", ".join([str(sid) for sid, s in zip(changed_stream_ids, changed_segments) if s < 0])
+            ))
+        previous_segments = network.segment_index(previous[0])
+        stored = dict((t, network.attributes[order_columns[t]]) for t in order_types)
+        _check_stored_orders(network, changed_segments, previous_segments, previous[1][2:], stored, order_types,
+                             order_columns)
+        changed_previous = np.isin(previous_segments, changed_segments)
+        previous_node_ids = np.concatenate([values[changed_previous] for values in previous[1][:2]])
+        previous_nodes = network.node_index(previous_node_ids[previous_node_ids > 0])
+        orders, updated_segments = _update_orders(network, changed_segments.tolist(), stored, order_types,
+                                                  previous_nodes[previous_nodes >= 0].tolist())
+        printer.msg("  {0} segments updated".format(len(updated_segments)))
+    else:
+        printer.msg("Assigning stream order..")
+        if processes and processes > 1:
+            orders, unordered_count = _assign_orders_basins(network, order_types, engine, processes)
+        else:
+            orders, unordered_count = _assign_orders(network, first_order_nodes, order_types, engine)
+        if unordered_count:
+            printer.warn("  {0} segments could not be ordered, check for loops in flow direction".format(unordered_count))
 
     if output_table_path:
         printer.msg("Saving stream order table..")
-        with open(output_table_path, 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["STREAM_ID", "STRAHLER_STREAM_ORDER"])
-            for segment in all_segments:
-                writer.writerow([segment.id, segment.order])
+        _write_order_table(network, orders, order_types, output_table_path)
 
     printer.msg("Updating streams..")
-    segment_map = {}
-    for segment in all_segments:
-        segment_map[segment.id] = segment
-
-    streams_ds = feature_utils.getFeatureDataset(stream_dataset, write=True)
-    streams_layer = streams_ds.GetLayer()
-    streams_defn = streams_layer.GetLayerDefn()
-
-    f_index = streams_defn.GetFieldIndex(stream_id_column)
-    if f_index < 0:
-        raise Exception("Could not find column ({0})".format(stream_id_column))
-    field_stream_id = streams_defn.GetFieldDefn(f_index)
-    f_index = streams_defn.GetFieldIndex(stream_order_column)
-    if f_index < 0:
-        printer.msg("  creating column {0}".format(stream_order_column))
-        field_stream_order = feature_utils.createFieldDefinition(stream_order_column, int)
-        streams_layer.CreateField(field_stream_order)
-
-    stream_feat = streams_layer.GetNextFeature()
-    while stream_feat:
-        stream_id = feature_utils.getFieldValue(stream_feat, field_stream_id)
-        if stream_id in segment_map:
-            stream_feat.SetField(stream_order_column, segment_map[stream_id].order)
-        streams_layer.SetFeature(stream_feat)
-        stream_feat = streams_layer.GetNextFeature()
-
-    streams_defn = None
-    streams_layer = None
-    streams_ds = None
-
-
-def _get_node_network(all_segments):
-    # get unique node ids
-    nodes = []
-    node_ids = []
-    for segment in all_segments:
-        # match from node
-        if segment.from_node not in node_ids:
-            from_node = Node(segment.from_node)
-            node_ids.append(segment.from_node)
-            nodes.append(from_node)
-        else:
-            from_node = None
-            for node in nodes:
-                if node.id == segment.from_node:
-                    from_node = node
-                    break
-        segment.connect_from_node(from_node)
-        # match to node
-        if segment.to_node not in node_ids:
-            to_node = Node(segment.to_node)
-            node_ids.append(segment.to_node)
-            nodes.append(to_node)
+    # in incremental mode stored values are known, so only updated features are fetched
+    written_count, created = _write_segment_columns(
+        stream_dataset,
+        network,
+        [(order_columns[order_type], orders[order_type].tolist()) for order_type in order_types],
+        previous_values=network.attributes if incremental else None
+    )
+    for column in created:
+        printer.msg("  created column {0}".format(column))
+    printer.msg("  {0} features updated".format(written_count))
+
+    _update_network_cache(stream_dataset, stream_id_column, network, dict(
+        (order_columns[order_type], orders[order_type]) for order_type in order_types
+    ))
+
+
+def _check_stored_orders(network, changed_segments, previous_segments, cached_orders, stored, order_types,
+                         order_columns):
+    # Orders stored in the dataset must be those cached by the last calculation for every segment not changed since,
+    # otherwise (e.g. orders edited or cache left from an earlier state) an incremental update would build on wrong
+    # values.
+    unchanged = np.ones(network.segment_count, dtype=bool)
+    unchanged[changed_segments] = False
+    cached = previous_segments >= 0
+    unchanged_cached = np.zeros(network.segment_count, dtype=bool)
+    unchanged_cached[previous_segments[cached]] = True
+    if (unchanged & ~unchanged_cached).any():
+        raise Exception("Cached stream orders are out of date (segments not cached and not given as changed), "
+                        "recalculate all stream orders")
+    matched = cached & unchanged[np.maximum(previous_segments, 0)]
+    for order_type, cached_values in zip(order_types, cached_orders):
+        if (stored[order_type][previous_segments[matched]] != cached_values[matched]).any():
+            raise Exception("Stored stream orders ({0}) don't match those cached by the last calculation, recalculate "
+                            "all stream orders".format(order_columns[order_type]))
+
+
+def _write_order_table(network, orders, order_types, output_table_path):
+    _write_table(output_table_path, [("STREAM_ID", "int64", network.segment_ids.tolist())] + [
+        ("{0}_STREAM_ORDER".format(order_type.upper()), "int64", orders[order_type].tolist())
+        for order_type in order_types
+    ])
+
+
+def _assign_orders(network, first_order_nodes, order_types, engine="python"):
+    # Calculate requested order types, returning dictionary of order type to per-segment array and count of segments
+    # that could not be ordered. Every order type is constant along a chain of segments through pass-through nodes,
+    # and only the most downstream segment of a chain meets other streams, so orders are calculated on the network with
+    # chains compressed to single segments and copied back to every segment of each chain.
+    compressed, segment_chain, node_map = network.compress_chains()
+    first_order_nodes = node_map[np.asarray(first_order_nodes, dtype=np.int64)]
+    # compressed segments rank as their last segment where streams join, but as their first where streams split
+    first_segments = np.nonzero((network.from_node < 0) | (node_map[network.from_node] >= 0))[0]
+    first_segment = np.zeros(compressed.segment_count, dtype=np.int64)
+    first_segment[segment_chain[first_segments]] = first_segments
+    compressed_orders = _assign_network_orders(compressed, first_order_nodes[first_order_nodes >= 0].tolist(),
+                                               order_types, engine, first_segment)
+    network.order[:] = compressed.order[segment_chain]
+    orders = dict((order_type, compressed_orders[order_type][segment_chain]) for order_type in order_types)
+
+    unordered_count = int(((network.order <= 0) & (network.from_node >= 0)).sum())
+    return orders, unordered_count
+
+
+def _assign_network_orders(network, first_order_nodes, order_types, engine, downstream_rank=None):
+    # Calculate requested order types in one topological pass (Strahler order and Shreve magnitude going downstream),
+    # plus one reverse pass tracing main stems if Horton or Hack orders are requested. Returns dictionary of order
+    # type to per-segment array.
+    main_stem = "horton" in order_types or "hack" in order_types
+    with_shreve = main_stem or "shreve" in order_types
+    if engine == "numpy":
+        topological_nodes, shreve = _assign_stream_order_numpy(network, first_order_nodes, with_shreve)
+    elif engine == "python":
+        topological_nodes, shreve = _assign_stream_order(network, first_order_nodes, with_shreve)
+    else:
+        raise Exception("Unknown stream order engine ({0})".format(engine))
+
+    orders = {"strahler": network.order}
+    if with_shreve:
+        orders["shreve"] = shreve
+    if main_stem:
+        orders["horton"], orders["hack"] = _assign_main_stem_orders(network, topological_nodes, shreve,
+                                                                    downstream_rank)
+    return orders
+
+
+def _assign_orders_basins(network, order_types, engine, processes):
+    # Same as _assign_orders, but with each basin (connected component of flow network) ordered separately in a
+    # process pool, merging results back into network.
+    basins = _basins(network)
+    tasks = [(network.subnetwork(segments, nodes), order_types, engine) for segments, nodes in basins]
+    orders = dict((order_type, np.zeros(network.segment_count, dtype=np.int64)) for order_type in order_types)
+    unordered_count = 0
+    for i, (basin_orders, basin_unordered, basin_strahler) in _map_pool(_assign_orders_basin, tasks, processes):
+        segments = basins[i][0]
+        for order_type in order_types:
+            orders[order_type][segments] = basin_orders[order_type]
+        network.order[segments] = basin_strahler
+        unordered_count += basin_unordered
+    return orders, unordered_count
+
+
+def _assign_orders_basin(task):
+    # process pool worker
+    network, order_types, engine = task
+    orders, unordered_count = _assign_orders(network, _get_node_network(network), order_types, engine)
+    return orders, unordered_count, network.order
+
+
+def _get_node_network(network):
+    # adjacency is built when reading network, just find starting points
+    return network.source_nodes().tolist()
+
+
+def _strahler_order(upstream_orders, upstream_braided):
+    # stream order at node from orders and braided flags of all upstream segments
+    count_upstream = len(upstream_orders)
+    if count_upstream == 0:
+        # no upstream, first order
+        return 1
+    if count_upstream == 1:
+        # only one upstream, inherit order
+        return upstream_orders[0]
+    sorted_braided = sorted([upstream_orders[i] for i in range(count_upstream) if upstream_braided[i]])
+    sorted_regular = sorted([upstream_orders[i] for i in range(count_upstream) if not upstream_braided[i]])
+    # highest braided values
+    value_if_braided = sorted_braided[-1] if len(sorted_braided) else 0
+    # get expected value if ignoring braided values
+    value_if_regular = 0
+    if len(sorted_regular):
+        if len(sorted_regular) > 1 and sorted_regular[-1] == sorted_regular[-2]:
+            value_if_regular = sorted_regular[-1] + 1
         else:
-            to_node = None
-            for node in nodes:
-                if node.id == segment.to_node:
-                    to_node = node
-                    break
-        segment.connect_to_node(to_node)
-    # find drainage points
-    first_order_nodes = []
-    for node in nodes:
-        if not len(node.get_upstream_segments()):
-            first_order_nodes.append(node)
-    return nodes, first_order_nodes
-
-
-def _assign_stream_order(first_order_nodes):
-    # do first length
-    active_nodes = []
-    for node in first_order_nodes:
-        for s in node.segments:
-            s.order = 1
-            if s.to_node not in active_nodes:
-                active_nodes.append(s.to_node)
-
-    # keep looping until no more active nodes
-    while len(active_nodes):
-        next_nodes = []
-        # for each node
-        for node in active_nodes:
-            # get downstream segments, if none, skip
-            downstream_segments = node.get_downstream_segments()
-            if not len(downstream_segments):
-                continue
+            value_if_regular = sorted_regular[-1]
+    if value_if_regular == value_if_braided:
+        # if value is equal for each time, increment order
+        return value_if_regular + 1
+    # value is highest of either
+    return value_if_regular if value_if_regular > value_if_braided else value_if_braided
 
-            # get all upstream segment stream orders
-            can_assign_value = True
-            upstream_segment_values = []
-            for s in node.get_upstream_segments():
-                # if not all upstream segments have order, can't assign yet
-                if s.order <= 0:
-                    can_assign_value = False
-                    break
-                else:
-                    upstream_segment_values.append([s.order, s.braided])
-
-            # if can't assign value, just keep it in active list and continue
-            if not can_assign_value:
-                next_nodes.append(node)
+
+def _topological_order(network, first_order_nodes):
+    # Kahn's algorithm with in-degree counters, so each node is processed exactly once, after all its upstream
+    # segments. Nodes within (or downstream of) loops never reach zero in-degree and are left out.
+    to_node = network.to_node.tolist()
+    out_offsets = network.out_offsets.tolist()
+    out_segments = network.out_segments.tolist()
+    remaining = network.in_degree().tolist()
+    queue = deque(first_order_nodes)
+    ordered = []
+    while queue:
+        node = queue.popleft()
+        ordered.append(node)
+        for s in out_segments[out_offsets[node]:out_offsets[node+1]]:
+            downstream_node = to_node[s]
+            if downstream_node < 0:
                 continue
+            remaining[downstream_node] -= 1
+            if not remaining[downstream_node]:
+                queue.append(downstream_node)
+    return ordered
+
 
-            # get new stream order
-            count_upstream = len(upstream_segment_values)
-            if count_upstream == 0:
-                # no upstream, first order
-                stream_order = 1
-            elif count_upstream == 1:
-                # only one upstream, inherit order
-                stream_order = upstream_segment_values[0][0]
+def _shreve_magnitude(upstream_magnitudes, upstream_braided):
+    # magnitude at node is sum of regular upstream magnitudes, but like stream order, braided channels carry the same
+    # flow so only the largest braided magnitude is added
+    if not len(upstream_magnitudes):
+        return 1
+    regular = 0
+    braided = 0
+    for i in range(len(upstream_magnitudes)):
+        if upstream_braided[i]:
+            braided = max(braided, upstream_magnitudes[i])
+        else:
+            regular += upstream_magnitudes[i]
+    return regular + braided
+
+
+def _assign_stream_order(network, first_order_nodes, with_shreve=False):
+    # Assign Strahler orders (and optionally Shreve magnitudes) node by node in topological order. Returns the
+    # topological node order and magnitude array (or None).
+    order = network.order.tolist()
+    magnitude = [-1]*network.segment_count if with_shreve else None
+    braided = network.braided.tolist()
+    in_offsets = network.in_offsets.tolist()
+    in_segments = network.in_segments.tolist()
+    out_offsets = network.out_offsets.tolist()
+    out_segments = network.out_segments.tolist()
+
+    topological_nodes = _topological_order(network, first_order_nodes)
+    for node in topological_nodes:
+        downstream_segments = out_segments[out_offsets[node]:out_offsets[node+1]]
+        if not len(downstream_segments):
+            continue
+        upstream_segments = in_segments[in_offsets[node]:in_offsets[node+1]]
+        upstream_braided = [braided[s] for s in upstream_segments]
+        stream_order = _strahler_order([order[s] for s in upstream_segments], upstream_braided)
+        if with_shreve:
+            node_magnitude = _shreve_magnitude([magnitude[s] for s in upstream_segments], upstream_braided)
+        for s in downstream_segments:
+            order[s] = stream_order
+            if with_shreve:
+                magnitude[s] = node_magnitude
+
+    network.order[:] = order
+    return topological_nodes, np.array(magnitude, dtype=np.int64) if with_shreve else None
+
+
+def _assign_main_stem_orders(network, topological_nodes, shreve, downstream_rank=None):
+    # Horton and Hack orders, tracing main stems upstream from outlets in reverse topological order. At each node the
+    # main upstream channel continues the order of the downstream channel (for Horton picking highest Strahler order
+    # first, for Hack the largest magnitude first, ties going to the first segment). Other tributaries start new
+    # streams, with Horton order of their own Strahler order and Hack order one more than the downstream channel.
+    # Braided tributaries are parallel channels of the same stream, so they carry the downstream channel's orders.
+    # Ties between downstream channels go to the first by downstream_rank if given (otherwise segment index).
+    strahler = network.order.tolist()
+    shreve = shreve.tolist()
+    braided = network.braided.tolist()
+    in_offsets = network.in_offsets.tolist()
+    in_segments = network.in_segments.tolist()
+    out_offsets = network.out_offsets.tolist()
+    out_segments = network.out_segments.tolist()
+
+    horton = list(strahler)
+    hack = [1 if o > 0 else -1 for o in strahler]
+    rank = downstream_rank.tolist() if downstream_rank is not None else range(network.segment_count)
+
+    for node in reversed(topological_nodes):
+        upstream_segments = in_segments[in_offsets[node]:in_offsets[node+1]]
+        if not len(upstream_segments):
+            continue
+        downstream_segments = out_segments[out_offsets[node]:out_offsets[node+1]]
+        main_horton = max(upstream_segments, key=lambda s: (strahler[s], shreve[s], -s))
+        main_hack = max(upstream_segments, key=lambda s: (shreve[s], strahler[s], -s))
+        if len(downstream_segments):
+            # continue from the largest downstream channel
+            downstream = max(downstream_segments, key=lambda s: (strahler[s], shreve[s], -rank[s]))
+            downstream_horton = horton[downstream]
+            downstream_hack = hack[downstream]
+        else:
+            # outlet
+            downstream_horton = strahler[main_horton]
+            downstream_hack = 1
+        for s in upstream_segments:
+            if s == main_horton or braided[s]:
+                horton[s] = downstream_horton
+            if s == main_hack or braided[s]:
+                hack[s] = downstream_hack
             else:
-                sorted_braided = sorted([x[0] for x in upstream_segment_values if x[1]])
-                sorted_regular = sorted([x[0] for x in upstream_segment_values if not x[1]])
-                # highest braided values
-                value_if_braided = sorted_braided[-1] if len(sorted_braided) else 0
-                # get expected value if ignoring braided values
-                value_if_regular = 0
-                if len(sorted_regular):
-                    if len(sorted_regular) > 1 and sorted_regular[-1] == sorted_regular[-2]:
-                        value_if_regular = sorted_regular[-1] + 1
-                    else:
-                        value_if_regular = sorted_regular[-1]
-                if value_if_regular == value_if_braided:
-                    # if value is equal for each time, increment order
-                    stream_order = value_if_regular + 1
-                else:
-                    # value is highest of either
-                    stream_order = value_if_regular if value_if_regular > value_if_braided else value_if_braided
-
-            # assign stream order to all downstream segments
-            for s in downstream_segments:
-                s.order = stream_order
-                # append next set of nodes to process
-                if s.to_node not in next_nodes:
-                    active_nodes.append(s.to_node)
-
-        active_nodes = next_nodes
+                hack[s] = downstream_hack + 1
+
+    return np.array(horton, dtype=np.int64), np.array(hack, dtype=np.int64)
+
+
+def _update_orders(network, changed_segments, stored, order_types, previous_nodes=None):
+    # Incremental recalculation of Strahler order and/or Shreve magnitude after local edits. Starting from the nodes at
+    # either end of each changed segment (and the nodes they were previously connected to, if reconnected), values are
+    # recomputed from stored upstream values, walking downstream only while the recomputed values differ from the
+    # stored ones. Returns dictionary of updated values per order type and sorted indices of segments whose values
+    # changed.
+    rules = {"strahler": _strahler_order, "shreve": _shreve_magnitude}
+    values = dict((t, stored[t].tolist()) for t in order_types)
+    braided = network.braided.tolist()
+    from_node = network.from_node.tolist()
+    to_node = network.to_node.tolist()
+    in_offsets = network.in_offsets.tolist()
+    in_segments = network.in_segments.tolist()
+    out_offsets = network.out_offsets.tolist()
+    out_segments = network.out_segments.tolist()
+
+    queue = deque()
+    queued = set()
+    start_nodes = [node for s in changed_segments for node in (from_node[s], to_node[s])]
+    for node in start_nodes + list(previous_nodes or []):
+        if node >= 0 and node not in queued:
+            queued.add(node)
+            queue.append(node)
+
+    updated = set()
+    # guard against endless updates around loops in flow direction
+    max_visits = 2*network.segment_count + len(queued)
+    visits = 0
+    while queue:
+        node = queue.popleft()
+        queued.discard(node)
+        visits += 1
+        if visits > max_visits:
+            raise Exception("Could not update stream order incrementally, check for loops in flow direction")
+
+        downstream_segments = out_segments[out_offsets[node]:out_offsets[node+1]]
+        if not len(downstream_segments):
+            continue
+        upstream_segments = in_segments[in_offsets[node]:in_offsets[node+1]]
+        upstream_braided = [braided[s] for s in upstream_segments]
+        node_values = dict(
+            (t, rules[t]([values[t][s] for s in upstream_segments], upstream_braided)) for t in order_types
+        )
+        for s in downstream_segments:
+            changed = False
+            for t in order_types:
+                if values[t][s] != node_values[t]:
+                    values[t][s] = node_values[t]
+                    changed = True
+            # stop here unless values changed
+            if changed:
+                updated.add(s)
+                if to_node[s] >= 0 and to_node[s] not in queued:
+                    queued.add(to_node[s])
+                    queue.append(to_node[s])
+
+    orders = dict((t, np.array(values[t], dtype=np.int64)) for t in order_types)
+    if "strahler" in orders:
+        network.order[:] = orders["strahler"]
+    return orders, sorted(updated)
+
+
+def _gather(offsets, items, nodes):
+    # concatenated CSR slices for given nodes, with count of items per node
+    counts = offsets[nodes+1] - offsets[nodes]
+    total = int(counts.sum())
+    index = np.repeat(offsets[nodes] - (np.cumsum(counts) - counts), counts) + np.arange(total)
+    return items[index], counts
+
+
+def _level_strahler_orders(upstream_orders, upstream_braided, counts):
+    # Vectorized _strahler_order over a set of nodes, given upstream segment orders and braided flags grouped by node
+    # (counts per node). Uses grouped max reductions over the regular and braided upstream values.
+    stream_order = np.ones(len(counts), dtype=np.int64)
+    single = counts == 1
+    stream_order[single] = upstream_orders[np.cumsum(counts)[single] - 1]
+    multi = counts > 1
+    if multi.any():
+        starts = (np.cumsum(counts) - counts)[counts > 0]
+        has_upstream = np.nonzero(counts > 0)[0]
+        group = np.repeat(np.arange(len(has_upstream)), counts[has_upstream])
+        regular = np.where(upstream_braided, 0, upstream_orders)
+        braided = np.where(upstream_braided, upstream_orders, 0)
+        # highest regular value, incremented where it is shared by more than one regular upstream segment
+        max_regular = np.maximum.reduceat(regular, starts)
+        at_max = (regular == max_regular[group]) & ~upstream_braided
+        count_at_max = np.add.reduceat(at_max.astype(np.int64), starts)
+        value_if_regular = np.where(count_at_max > 1, max_regular + 1, max_regular)
+        value_if_braided = np.maximum.reduceat(braided, starts)
+        value = np.where(
+            value_if_regular == value_if_braided,
+            value_if_regular + 1,
+            np.maximum(value_if_regular, value_if_braided)
+        )
+        multi_groups = counts[has_upstream] > 1
+        stream_order[has_upstream[multi_groups]] = value[multi_groups]
+    return stream_order
+
+
+def _level_shreve_magnitudes(upstream_magnitudes, upstream_braided, counts):
+    # vectorized _shreve_magnitude over a set of nodes, with upstream values grouped by node (counts per node)
+    magnitude = np.ones(len(counts), dtype=np.int64)
+    has_upstream = np.nonzero(counts > 0)[0]
+    if len(has_upstream):
+        starts = (np.cumsum(counts) - counts)[has_upstream]
+        regular = np.add.reduceat(np.where(upstream_braided, 0, upstream_magnitudes), starts)
+        braided = np.maximum.reduceat(np.where(upstream_braided, upstream_magnitudes, 0), starts)
+        magnitude[has_upstream] = regular + braided
+    return magnitude
+
+
+def _assign_stream_order_numpy(network, first_order_nodes, with_shreve=False):
+    # Level-synchronous version of _assign_stream_order. Nodes are processed one topological level at a time (each
+    # level being the nodes whose upstream segments were all ordered by previous levels), with stream orders for the
+    # whole level computed by array operations. Returns the topological node order and magnitude array (or None).
+    order = network.order
+    magnitude = np.full(network.segment_count, -1, dtype=np.int64) if with_shreve else None
+    braided = network.braided
+    to_node = network.to_node
+    remaining = network.in_degree().copy()
+
+    levels = []
+    frontier = np.asarray(first_order_nodes, dtype=np.int64)
+    while len(frontier):
+        levels.append(frontier)
+        upstream_segments, upstream_counts = _gather(network.in_offsets, network.in_segments, frontier)
+        upstream_braided = braided[upstream_segments]
+        level_orders = _level_strahler_orders(order[upstream_segments], upstream_braided, upstream_counts)
+
+        downstream_segments, downstream_counts = _gather(network.out_offsets, network.out_segments, frontier)
+        order[downstream_segments] = np.repeat(level_orders, downstream_counts)
+        if with_shreve:
+            level_magnitudes = _level_shreve_magnitudes(magnitude[upstream_segments], upstream_braided, upstream_counts)
+            magnitude[downstream_segments] = np.repeat(level_magnitudes, downstream_counts)
+
+        downstream_nodes = to_node[downstream_segments]
+        downstream_nodes = downstream_nodes[downstream_nodes >= 0]
+        remaining -= np.bincount(downstream_nodes, minlength=network.node_count).astype(remaining.dtype)
+        frontier = np.unique(downstream_nodes[remaining[downstream_nodes] == 0]).astype(np.int64)
+
+    topological_nodes = np.concatenate(levels).tolist() if len(levels) else []
+    return topological_nodes, magnitude
@@ -1,6 +1,9 @@
+import numpy as np
 from bin.PassPrint import PassPrint
+from bin.RasterBlockCache import RasterBlockCache
 from common import feature_utils, raster_utils
-from shared import _get_segments, _parse_nodes
+from bin.calculate_stream_order import _topological_order
+from shared import _parse_nodes, _read_network, _stream_layer, _update_network_cache, _write_segment_columns
 from gdal import osr
 
 
@@ -16,37 +19,34 @@ def complete_braided_streams(stream_dataset, stream_id_column, node_dataset_or_t
     # get node network
     printer.msg("Reading node network..")
     nodes, drainage_nodes = _parse_nodes(node_dataset_or_table, get_coords=(True if elevation_dataset else False))
-    # original nodes map
-    og_nodes_map = {}
-    for node in nodes:
-        og_nodes_map[node.id] = node
 
     # read streams layer and get segments
     printer.msg("Reading streams dataset..")
-    stream_dataset = feature_utils.getFeatureDataset(stream_dataset, write=1)
-    stream_layer = stream_dataset.GetLayer()
+    stream_ds = feature_utils.getFeatureDataset(stream_dataset)
+    stream_layer = _stream_layer(stream_ds)
     stream_defn = stream_layer.GetLayerDefn()
     stream_srs = stream_layer.GetSpatialRef()
 
     index_stream_id = stream_defn.GetFieldIndex(stream_id_column)
     if index_stream_id < 0:
-        return Exception("Could not find column ({0})".format(stream_id_column))
-    stream_id_col = stream_defn.GetFieldDefn(index_stream_id)
+        raise Exception("Could not find column ({0})".format(stream_id_column))
     index_from_node = stream_defn.GetFieldIndex(from_node_column)
     if index_from_node < 0:
-        return Exception("Could not find column ({0})".format(from_node_column))
+        raise Exception("Could not find column ({0})".format(from_node_column))
     index_to_node = stream_defn.GetFieldIndex(to_node_column)
     if index_to_node < 0:
-        return Exception("Could not find column ({0})".format(to_node_column))
+        raise Exception("Could not find column ({0})".format(to_node_column))
 
     printer.msg("Creating segments..")
-    segments = _get_segments(stream_dataset, stream_id_column, nodes, from_node_column, to_node_column, braided_column)
+    network = _read_network(stream_dataset, stream_id_column, from_node_column, to_node_column, braided_column)
+    if elevation_dataset:
+        network.set_node_coords([node.id for node in nodes], [node.coords[:2] for node in nodes])
+    nodes = None
+    from_node = network.from_node
+    to_node = network.to_node
 
     # get braided segments
-    braided_segments = []
-    for segment in segments:
-        if segment.braided:
-            braided_segments.append(segment)
+    braided_segments = [s for s in np.nonzero(network.braided)[0].tolist() if from_node[s] >= 0 and to_node[s] >= 0]
 
     if not len(braided_segments):
         printer.msg("No braided segments labeled to complete.")
@@ -61,129 +61,160 @@ def complete_braided_streams(stream_dataset, stream_id_column, node_dataset_or_t
         dem_srs = raster_utils.getRasterSpatialReference(dem)
         dem_transform = osr.CoordinateTransformation(stream_srs, dem_srs)
 
-    try:
-        printer.msg("Completing braided networks..")
-        braided_segment_ids = []
-        for initial_segment in braided_segments:
-
-            # if DEM exists, check whether to swap to/from node
-            if dem:
-                nodes = [initial_segment.from_node, initial_segment.to_node]
-                node_els = [0, 0]
-                for i in range(2):
-                    node_coords = dem_transform.TransformPoint(nodes[i].coords[0], nodes[i].coords[1])
-                    node_pixels = raster_utils.calcPixelCoordinate(node_coords, dataset=dem)
-                    node_els[i] = raster_utils.readRaster(dem, 1, node_pixels[0], node_pixels[1])
-                # swap from/to nodes
-                if node_els[0] < node_els[1]:
-                    initial_segment.from_node = nodes[1]
-                    initial_segment.to_node = nodes[0]
-                    # make changes to shapefile with callback
-                    def update_segment_nodes(feat):
-                        if feature_utils.getFieldValue(feat, stream_id_col) == initial_segment.id:
-                            feat.SetField(index_from_node, initial_segment.from_node.id)
-                            feat.SetField(index_to_node, initial_segment.to_node.id)
-                            stream_layer.SetFeature(feat)
-                            return True
-                    feature_utils.forEachFeature(stream_layer, update_segment_nodes)
-
-            source_node = initial_segment.from_node
-
-            # as we run down network, for each split, value is equally split / for each merge, values added up
-            start_value = 1000000.0  # start with high number to avoid fraction issues
-            tolerance = 0.0001
-            fraction_by_node = {source_node.id: start_value}
-            fraction_by_segment = {}
-
-            # we also keep a list of touched node ids, so we ignore other feeder segments that appear when traversing back
-            # up the sub-network later
-            touched_nids = [source_node.id]
-
-            # search down from starting node, tracking values
-            active_nodes = [source_node]
-            end_node = None
-            while len(active_nodes):
-                next_active_nodes = []
-
-                for node in active_nodes:
-                    # get feeding node fraction value
-                    node_fraction = fraction_by_node[node.id]
-                    # for downstream segments
-                    downstream = node.get_downstream_segments()
-                    if len(downstream):
-                        fraction_value = node_fraction / len(downstream)
-                        for segment in downstream:
-                            # add fraction value from feeding node
-                            if segment.id not in fraction_by_segment:
-                                fraction_by_segment[segment.id] = fraction_value
-                            else:
-                                fraction_by_segment[segment.id] += fraction_value
-                            # get next set of downstream nodes
-                            if segment.to_node not in next_active_nodes:
-                                next_active_nodes.append(segment.to_node)
-
-                for node in next_active_nodes:
-                    # add new node id
-                    touched_nids.append(node.id)
-                    # update this active node layer's fraction values
-                    node_fraction = 0
-                    for segment in node.get_upstream_segments():
-                        if segment.id in fraction_by_segment:
-                            node_fraction += fraction_by_segment[segment.id]
-                    # if at original value (with tolerance due to bitmath), we've found common end point
-                    if abs(node_fraction - start_value) < tolerance:
-                        end_node = node
-                        break
-                    # update value
-                    fraction_by_node[node.id] = node_fraction
-                # propagate break condition
-                if end_node:
-                    break
-
-                active_nodes = next_active_nodes
-
-            if not end_node:
-                printer.error("Could not find shared end node for all assumed braided flows out of start node={0}. Complex networks with braided and unbraided streams from common start node should be classified manually)".format(source_node.id))
-                raise Exception("Could not parse braided stream network.")
-
-            # traverse upstream from end node, ignoring those nodes that weren't processed going downstream, keeping list of
-            # unique node ids identified as part of this braided network
-            active_nodes = [end_node]
-            while len(active_nodes):
-                next_active_nodes = []
-
-                for node in active_nodes:
-                    for segment in node.get_upstream_segments():
-                        if segment.from_node.id not in touched_nids:
-                            continue
-                        if segment.id not in braided_segment_ids:
-                            braided_segment_ids.append(segment.id)
-                        if segment.from_node not in next_active_nodes:
-                            next_active_nodes.append(segment.from_node)
-
-                active_nodes = next_active_nodes
-
-        dem = None
-        if not len(braided_segment_ids):
-            return
+    # node ids as stored, before any swaps
+    stored_from_node_ids = network.node_ids_of(from_node).tolist()
+    stored_to_node_ids = network.node_ids_of(to_node).tolist()
 
-        printer.msg("Updating streams..")
-
-        index_braided = stream_defn.GetFieldIndex(braided_column)
-        if index_braided < 0:
-            return Exception("Could not find column ({0})".format(braided_column))
+    try:
+        # if DEM exists, check whether to swap to/from node of braided segments first
+        swapped_segments = []
+        if dem:
+            printer.msg("Checking braided flow direction..")
+            swapped_segments = _check_braided_directions(network, braided_segments, dem, dem_transform)
+            if len(swapped_segments):
+                printer.msg("  {0} segments reversed".format(len(swapped_segments)))
 
-        stream_feat = stream_layer.GetNextFeature()
-        while stream_feat:
-            sid = feature_utils.getFieldValue(stream_feat, stream_id_col)
-            if sid in braided_segment_ids:
-                stream_feat.SetField(braided_column, 1)
-            stream_layer.SetFeature(stream_feat)
-            stream_feat = stream_layer.GetNextFeature()
+        printer.msg("Completing braided networks..")
+        braided_segment_ids = _find_braided_networks(network, braided_segments)
 
     finally:
         dem = None
-        node_layer = None
-        node_dataset = None
+        stream_defn = None
         stream_layer = None
-        stream_dataset = None
+        stream_ds = None
+
+    # swaps and braided flags written together, directly by FID of changed features
+    braided = network.braided | np.isin(network.segment_ids, braided_segment_ids)
+    if len(swapped_segments) or len(braided_segment_ids):
+        printer.msg("Updating streams..")
+        written_count, created = _write_segment_columns(
+            stream_dataset,
+            network,
+            [
+                (from_node_column, network.node_ids_of(from_node).tolist()),
+                (to_node_column, network.node_ids_of(to_node).tolist()),
+                (braided_column, braided.astype(np.int64).tolist())
+            ],
+            previous_values={
+                from_node_column: stored_from_node_ids,
+                to_node_column: stored_to_node_ids,
+                braided_column: network.braided.astype(np.int64).tolist()
+            }
+        )
+        printer.msg("  {0} features updated".format(written_count))
+
+    # refresh cache with written columns
+    _update_network_cache(stream_dataset, stream_id_column, network, {
+        from_node_column: network.node_ids_of(from_node),
+        to_node_column: network.node_ids_of(to_node),
+        braided_column: braided.astype(np.int64)
+    })
+
+
+def _check_braided_directions(network, braided_segments, dem, dem_transform):
+    # Swap from/to nodes of braided segments flowing uphill, by elevation sampled at each end node. End nodes are
+    # sampled once each, in one batch. Returns list of swapped segments.
+    from_node = network.from_node
+    to_node = network.to_node
+    segments = np.asarray(braided_segments, dtype=np.int64)
+    nodes = np.unique(np.concatenate((from_node[segments], to_node[segments])))
+    node_els = np.full(network.node_count, np.nan)
+    node_els[nodes] = _sample_elevations(dem, dem_transform, network.node_coords[nodes])
+    # swap from/to nodes
+    swapped = segments[node_els[from_node[segments]] < node_els[to_node[segments]]]
+    from_node[swapped], to_node[swapped] = to_node[swapped], from_node[swapped]
+    if len(swapped):
+        network.build_adjacency()
+    return swapped.tolist()
+
+
+def _sample_elevations(dem, dem_transform, coords):
+    # Elevations at (n, 2) coordinates. Points are transformed to the DEM reference in one call, converted to pixels
+    # with the inverse geotransform, and read block by block through a block cache. NaN outside DEM or at no data.
+    if not len(coords):
+        return np.zeros(0)
+    points = np.array(dem_transform.TransformPoints(coords.tolist()), dtype=float)[:, :2]
+    gt = dem.GetGeoTransform()
+    det = gt[1]*gt[5] - gt[2]*gt[4]
+    dx = points[:, 0] - gt[0]
+    dy = points[:, 1] - gt[3]
+    px = np.floor((gt[5]*dx - gt[2]*dy) / det)
+    py = np.floor((gt[1]*dy - gt[4]*dx) / det)
+    return RasterBlockCache(dem.GetRasterBand(1)).sample(px, py)
+
+
+def _find_braided_networks(network, braided_segments):
+    # Complete braided sub-networks in one pass over the oriented network. The braid starting at the from node of each
+    # braided segment (split node) rejoins at the split node's immediate post-dominator, the nearest node that all flow
+    # from the split passes through. The braid is then every segment on paths between the two. Split nodes are taken
+    # in topological order, and those inside an earlier braid are skipped, as their braid is contained in it. Returns
+    # list of stream ids of all segments in braided sub-networks.
+    to_node = network.to_node.tolist()
+    out_offsets = network.out_offsets.tolist()
+    out_segments = network.out_segments.tolist()
+    topological_nodes = _topological_order(network, network.source_nodes().tolist())
+    rejoin_nodes = _post_dominators(network, topological_nodes)
+    split_nodes = set(network.from_node[braided_segments].tolist())
+
+    in_braid = [False]*network.segment_count
+    covered = [False]*network.node_count
+    for split_node in [node for node in topological_nodes if node in split_nodes] + \
+            [node for node in split_nodes if rejoin_nodes[node] is None]:
+        if covered[split_node]:
+            continue
+        end_node = rejoin_nodes[split_node]
+        if end_node is None or end_node < 0:
+            printer.error("Could not find shared end node for all assumed braided flows out of start node={0}. Complex networks with braided and unbraided streams from common start node should be classified manually)".format(network.node_ids[split_node]))
+            raise Exception("Could not parse braided stream network.")
+
+        # all segments reachable from split node before rejoin node (which every path must reach)
+        stack = [split_node]
+        seen = set(stack)
+        while stack:
+            node = stack.pop()
+            covered[node] = True
+            for segment in out_segments[out_offsets[node]:out_offsets[node+1]]:
+                in_braid[segment] = True
+                next_node = to_node[segment]
+                if next_node != end_node and next_node not in seen:
+                    seen.add(next_node)
+                    stack.append(next_node)
+
+    return network.segment_ids[np.array(in_braid, dtype=bool)].tolist()
+
+
+def _post_dominators(network, topological_nodes):
+    # Immediate post-dominator of each node, -1 where flow from node doesn't rejoin before leaving the network (or
+    # enters a loop), None for nodes not in topological order. Nodes are resolved in reverse topological order, so all
+    # downstream nodes are resolved first, by intersecting paths up the post-dominator tree (as in Cooper, Harvey and
+    # Kennedy's dominance algorithm). Ranks decrease towards the network exit (-1).
+    to_node = network.to_node.tolist()
+    out_offsets = network.out_offsets.tolist()
+    out_segments = network.out_segments.tolist()
+    rank = [-1]*network.node_count
+    for i, node in enumerate(reversed(topological_nodes)):
+        rank[node] = i
+    rejoin = [None]*network.node_count
+
+    def intersect(a, b):
+        while a != b:
+            if a < 0 or b < 0:
+                return -1
+            if rank[a] > rank[b]:
+                a = rejoin[a]
+            else:
+                b = rejoin[b]
+        return a
+
+    for node in reversed(topological_nodes):
+        result = None
+        for segment in out_segments[out_offsets[node]:out_offsets[node+1]]:
+            next_node = to_node[segment]
+            if next_node < 0 or rank[next_node] < 0:
+                result = -1
+            else:
+                result = next_node if result is None else intersect(result, next_node)
+            if result < 0:
+                break
+        rejoin[node] = result if result is not None else -1
+    return rejoin
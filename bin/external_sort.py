@@ -0,0 +1,95 @@
+import heapq
+import os
+import tempfile
+import numpy as np
+
+
+class RecordSpool:
+    # Appends fixed-width records (of numpy structured dtype) to a temporary file, buffering writes in blocks.
+
+    dtype = None
+    path = None
+    count = 0
+
+    def __init__(self, dtype, temp_dir=None, buffer_records=65536):
+        self.dtype = np.dtype(dtype)
+        handle, self.path = tempfile.mkstemp(suffix=".rec", dir=temp_dir)
+        os.close(handle)
+        self.count = 0
+        self._file = open(self.path, 'wb')
+        self._buffer = []
+        self._buffer_records = buffer_records
+
+    def append(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= self._buffer_records:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer):
+            np.array(self._buffer, dtype=self.dtype).tofile(self._file)
+            self.count += len(self._buffer)
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _read_blocks(path, dtype, block_records):
+    with open(path, 'rb') as f:
+        while True:
+            block = np.fromfile(f, dtype=dtype, count=block_records)
+            if not len(block):
+                break
+            for record in block.tolist():
+                yield record
+
+
+def _external_sort(spool, order, memory_budget_mb, temp_dir=None):
+    # Sort spooled records on the given fields with bounded memory. Records are sorted in chunks sized to fit the
+    # budget, written out as sorted runs, then k-way merged. Yields records as tuples in dtype field order, with sort
+    # fields first for comparison. Run files are removed once fully read.
+    spool.close()
+    dtype = spool.dtype
+    # sorting needs a few copies of each chunk in memory
+    chunk_records = max(1024, int(memory_budget_mb * 1024 * 1024 / (dtype.itemsize * 4)))
+    rest = [name for name in dtype.names if name not in order]
+    key_fields = list(order) + rest
+
+    runs = []
+    try:
+        with open(spool.path, 'rb') as f:
+            while True:
+                chunk = np.fromfile(f, dtype=dtype, count=chunk_records)
+                if not len(chunk):
+                    break
+                chunk = np.sort(chunk, order=key_fields)
+                handle, run_path = tempfile.mkstemp(suffix=".run", dir=temp_dir)
+                os.close(handle)
+                _reordered(chunk, key_fields).tofile(run_path)
+                runs.append(run_path)
+                chunk = None
+
+        run_dtype = np.dtype([(name, dtype.fields[name][0]) for name in key_fields])
+        block_records = max(256, chunk_records // max(1, len(runs)))
+        for record in heapq.merge(*[_read_blocks(run, run_dtype, block_records) for run in runs]):
+            yield record
+    finally:
+        for run_path in runs:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+
+
+def _reordered(array, names):
+    out = np.empty(len(array), dtype=[(name, array.dtype.fields[name][0]) for name in names])
+    for name in names:
+        out[name] = array[name]
+    return out
@@ -1,22 +1,35 @@
-import csv
+import math
+import numpy as np
 import ogr
 import common.feature_utils as feature_utils
 from bin.PassPrint import PassPrint
+from bin.UnionFind import UnionFind
+from bin.external_sort import RecordSpool, _external_sort
 from bin.network.Node import Node
-from bin.shared import _check_srs_units
+from bin.shared import NODE_LAYER_NAME, WRITE_BATCH_SIZE, _check_srs_units, _create_feature_dataset, _node_layer, _read_columns, \
+    _stream_layer
+from bin.tables import TableWriter, _write_table
 
 
 printer = None
 
+NODE_FIELDS = [
+    {'name': "NODE",       'type': int},
+    {'name': "STREAM_IDS", 'type': basestring},
+    {'name': "END_POINT",  'type': int},
+    {'name': "DRAINAGE",   'type': int}
+]
 
-def get_node_network(stream_dataset, stream_id_column, output_node_shp, output_table_path, output_table_rev_path, tolerance):
+
+def get_node_network(stream_dataset, stream_id_column, output_node_shp, output_table_path, output_table_rev_path, tolerance,
+                     memory_budget_mb=None):
     global printer
     if not printer:
         printer = PassPrint()
 
     printer.msg("Opening dataset..")
     streams_ds = feature_utils.getFeatureDataset(stream_dataset)
-    streams_layer = streams_ds.GetLayer()
+    streams_layer = _stream_layer(streams_ds)
     streams_srs = streams_layer.GetSpatialRef()
     streams_defn = streams_layer.GetLayerDefn()
 
@@ -28,35 +41,13 @@ def get_node_network(stream_dataset, stream_id_column, output_node_shp, output_t
         raise Exception("Could not find stream ID column ({0})".format(stream_id_column))
     id_field_defn = streams_defn.GetFieldDefn(id_field_index)
 
-    all_nodes = []
-    all_stream_ids = []
-    # all_feats = []
-    current_id = 1
+    if memory_budget_mb:
+        return _get_node_network_external(streams_layer, id_field_defn, streams_srs, output_node_shp, output_table_path,
+                                          output_table_rev_path, tolerance, memory_budget_mb)
 
     # process all nodes at end points of all lines
     printer.msg("Creating nodes..")
-    stream_feat = streams_layer.GetNextFeature()
-    while stream_feat:
-        stream_id = feature_utils.getFieldValue(stream_feat, id_field_defn)
-        all_stream_ids.append(stream_id)
-
-        geom = stream_feat.GetGeometryRef()
-        points = geom.GetPoints()
-
-        first_node = Node(current_id)
-        current_id += 1
-        first_node.coords = points[0]
-        first_node.segments.append(stream_id)
-        all_nodes.append(first_node)
-
-        last_node = Node(current_id)
-        current_id += 1
-        last_node.coords = points[-1]
-        last_node.segments.append(stream_id)
-        all_nodes.append(last_node)
-
-        # all_feats.append(stream_feat)
-        stream_feat = streams_layer.GetNextFeature()
+    all_nodes, all_stream_ids, _ = _read_end_nodes(streams_layer, id_field_defn)
 
     # at this point no longer need dataset
     streams_defn = None
@@ -64,91 +55,301 @@ def get_node_network(stream_dataset, stream_id_column, output_node_shp, output_t
     streams_ds = None
 
     printer.msg("Finding node intersections..")
-    tolerance2 = tolerance*tolerance
+    filtered_nodes = _consolidate_nodes(all_nodes, tolerance)
+
+    printer.msg("Finalizing network..")
+    network_map = _number_nodes(filtered_nodes, all_stream_ids)
+
+    printer.msg("Saving node network table..")
+    _write_node_tables(filtered_nodes, network_map, output_table_path, output_table_rev_path)
+
+    printer.msg("Saving node shapefile..")
+    _write_node_dataset(output_node_shp, streams_srs, filtered_nodes)
+
+
+def _read_end_nodes(streams_layer, id_field_defn):
+    # one node at each end point of all lines, and lists of all stream ids and feature FIDs
+    fids, column_values, end_points = _read_columns(streams_layer, [id_field_defn.GetName()], end_points=True)
+    # skip features with null stream id (as when reading network), or with no or empty geometry
+    keep = ~np.ma.getmaskarray(column_values[0]) & np.isfinite(end_points).all(axis=(1, 2))
+    all_stream_ids = column_values[0][keep].astype(np.int64).tolist()
+    fids = fids[keep]
+    end_points = end_points[keep]
+    all_nodes = []
+    current_id = 1
+    for stream_id, points in zip(all_stream_ids, end_points.tolist()):
+        for point in points:
+            node = Node(current_id)
+            current_id += 1
+            node.coords = tuple(point)
+            node.segments.append(stream_id)
+            all_nodes.append(node)
+    return all_nodes, all_stream_ids, fids.tolist()
+
+
+def _consolidate_nodes(all_nodes, tolerance):
     filtered_nodes = []
-    connected_node_ids = []
-
-    # outer loop on every node
-    start_index = 0
-    count_nodes = len(all_nodes)
-    while start_index < count_nodes-1:
-        this_node = all_nodes[start_index]
-        start_index += 1
-        # skip if it's already been connected
-        if this_node.id in connected_node_ids:
-            continue
+    for members in _cluster_endpoints([node.coords for node in all_nodes], tolerance):
+        # consolidate onto first node in cluster
+        this_node = all_nodes[members[0]]
+        for i in members[1:]:
+            this_node.segments += all_nodes[i].segments
         filtered_nodes.append(this_node)
-        # inner loop on every node pair
-        for i in range(start_index, count_nodes, 1):
-            this_coords = this_node.coords
-            that_coords = all_nodes[i].coords
-            # check overlap
-            distance_x = abs(this_coords[0] - that_coords[0])
-            if distance_x <= tolerance:
-                distance_y = abs(this_coords[1] - that_coords[1])
-                if distance_y <= tolerance:
-                    distance = distance_x*distance_x + distance_y*distance_y
-                    if distance <= tolerance2:
-                        # overlaps, consolidate nodes
-                        this_node.segments += all_nodes[i].segments
-                        connected_node_ids.append(all_nodes[i].id)
+    return filtered_nodes
 
-    printer.msg("Finalizing network..")
-    # reverse mapping by stream id
+
+def _number_nodes(filtered_nodes, all_stream_ids):
+    # reassign node ids in order, returning reverse mapping of stream id to node ids
     network_map = {}
     for sid in all_stream_ids:
         network_map[sid] = []
-    # reassign node ids while we go
     current_id = 1
     for node in filtered_nodes:
         node.id = current_id
         current_id += 1
         for sid in node.segments:
             network_map[sid].append(node.id)
+    return network_map
 
-    printer.msg("Saving node network table..")
+
+def _write_node_tables(filtered_nodes, network_map, output_table_path, output_table_rev_path):
     if output_table_path:
-        with open(output_table_path, 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["NODE", "STREAM_IDS"])
-            for node in filtered_nodes:
-                writer.writerow([node.id, ",".join([str(sid) for sid in node.segments])])
+        _write_table(output_table_path, [
+            ("NODE", "int64", [node.id for node in filtered_nodes]),
+            ("STREAM_IDS", "int64 list", [list(node.segments) for node in filtered_nodes])
+        ])
     if output_table_rev_path:
-        with open(output_table_rev_path, 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["STREAM_ID", "NODES"])
-            for sid, nids in network_map.iteritems():
-                writer.writerow([sid, ",".join([str(nid) for nid in nids])])
+        stream_ids = list(network_map.keys())
+        _write_table(output_table_rev_path, [
+            ("STREAM_ID", "int64", stream_ids),
+            ("NODES", "int64 list", [list(network_map[sid]) for sid in stream_ids])
+        ])
 
-    printer.msg("Saving node shapefile..")
-    fields = [
-        {'name': "NODE",       'type': int},
-        {'name': "STREAM_IDS", 'type': basestring},
-        {'name': "END_POINT",  'type': int},
-        {'name': "DRAINAGE",   'type': int}
-    ]
-    node_ds = feature_utils.createFeatureDataset(
-        output_node_shp,
-        "nodes",
-        streams_srs,
-        ogr.wkbPoint,
-        fields=fields,
-        overwrite=True
-    )
-    node_layer = node_ds.GetLayer()
+
+def _write_node_dataset(output_node_shp, srs, filtered_nodes):
+    node_ds = _create_node_dataset(output_node_shp, srs)
+    node_layer = _node_layer(node_ds)
     defn = node_layer.GetLayerDefn()
-    for node in filtered_nodes:
-        feat = ogr.Feature(defn)
-        pt = ogr.Geometry(ogr.wkbPoint)
-        pt.AddPoint(node.coords[0], node.coords[1])
-        streams = node.segments
-        feat.SetGeometry(pt)
-        feat.SetField(fields[0]['name'], node.id)
-        feat.SetField(fields[1]['name'], ",".join([str(sid) for sid in streams]))
-        feat.SetField(fields[2]['name'], 1 if len(streams) <= 1 else 0)
-        feat.SetField(fields[3]['name'], 0)
-        node_layer.CreateFeature(feat)
-        feat = None
+    transactions = node_layer.TestCapability(ogr.OLCTransactions)
+    for i, node in enumerate(filtered_nodes):
+        _batch_transaction(node_layer, transactions, i)
+        _create_node_feature(node_layer, defn, node.id, node.coords, node.segments)
+    if transactions and len(filtered_nodes):
+        node_layer.CommitTransaction()
     defn = None
     node_layer = None
     node_ds = None
+
+
+def _create_node_dataset(output_node_shp, srs):
+    return _create_feature_dataset(output_node_shp, NODE_LAYER_NAME, srs, ogr.wkbPoint, NODE_FIELDS)
+
+
+def _batch_transaction(layer, transactions, count):
+    # features are created in transactions of WRITE_BATCH_SIZE where driver supports them (e.g. GeoPackage), count
+    # being features created so far
+    if transactions and count % WRITE_BATCH_SIZE == 0:
+        if count:
+            layer.CommitTransaction()
+        layer.StartTransaction()
+
+
+def _create_node_feature(node_layer, defn, node_id, coords, stream_ids):
+    feat = ogr.Feature(defn)
+    pt = ogr.Geometry(ogr.wkbPoint)
+    pt.AddPoint(coords[0], coords[1])
+    feat.SetGeometry(pt)
+    feat.SetField(NODE_FIELDS[0]['name'], node_id)
+    feat.SetField(NODE_FIELDS[1]['name'], ",".join([str(sid) for sid in stream_ids]))
+    feat.SetField(NODE_FIELDS[2]['name'], 1 if len(stream_ids) <= 1 else 0)
+    feat.SetField(NODE_FIELDS[3]['name'], 0)
+    node_layer.CreateFeature(feat)
+    feat = None
+
+
+def _cluster_endpoints(coords, tolerance):
+    # Groups of point indices within tolerance of each other (transitively). Points are hashed into grid cells the
+    # size of the tolerance, so only points in neighbouring cells need to be compared.
+    clusters = UnionFind(len(coords))
+    grid = {}
+    if not tolerance or tolerance <= 0:
+        # exact matches only
+        for i in range(len(coords)):
+            key = (coords[i][0], coords[i][1])
+            if key in grid:
+                clusters.union(grid[key], i)
+            else:
+                grid[key] = i
+        return clusters.groups()
+
+    tolerance2 = tolerance*tolerance
+    for i in range(len(coords)):
+        this_coords = coords[i]
+        cx = int(math.floor(this_coords[0] / tolerance))
+        cy = int(math.floor(this_coords[1] / tolerance))
+        for nx in (cx-1, cx, cx+1):
+            for ny in (cy-1, cy, cy+1):
+                for j in grid.get((nx, ny), ()):
+                    that_coords = coords[j]
+                    distance_x = this_coords[0] - that_coords[0]
+                    distance_y = this_coords[1] - that_coords[1]
+                    if distance_x*distance_x + distance_y*distance_y <= tolerance2:
+                        clusters.union(i, j)
+        if (cx, cy) in grid:
+            grid[(cx, cy)].append(i)
+        else:
+            grid[(cx, cy)] = [i]
+    return clusters.groups()
+
+
+def _get_node_network_external(streams_layer, id_field_defn, streams_srs, output_node_shp, output_table_path,
+                               output_table_rev_path, tolerance, memory_budget_mb):
+    # Out-of-core version of node consolidation. End points are spooled to disk as fixed-width records keyed by grid
+    # cell, externally sorted by column then row, and clustered in a single sweep keeping only two grid columns in
+    # memory. Nodes are written as each cluster is completed, so node ids follow spatial order instead of input order.
+    cell_size = tolerance if tolerance and tolerance > 0 else 1.0
+
+    printer.msg("Spooling end points..")
+    endpoints = RecordSpool([
+        ('cx', '<i8'), ('cy', '<i8'), ('seq', '<i8'), ('x', '<f8'), ('y', '<f8'), ('sid', '<i8')
+    ])
+    links = RecordSpool([('sid', '<i8'), ('nid', '<i8')]) if output_table_rev_path else None
+    try:
+        seq = 0
+        stream_feat = streams_layer.GetNextFeature()
+        while stream_feat:
+            stream_id = feature_utils.getFieldValue(stream_feat, id_field_defn)
+            geometry = stream_feat.GetGeometryRef()
+            points = geometry.GetPoints() if geometry is not None else None
+            if stream_id is None or not points:
+                # skipped as when reading end nodes in memory
+                stream_feat = streams_layer.GetNextFeature()
+                continue
+            for point in (points[0], points[-1]):
+                endpoints.append((
+                    int(math.floor(point[0] / cell_size)), int(math.floor(point[1] / cell_size)),
+                    seq, point[0], point[1], stream_id
+                ))
+                seq += 1
+            stream_feat = streams_layer.GetNextFeature()
+        streams_layer = None
+
+        printer.msg("Clustering sorted end points..")
+        node_ds = _create_node_dataset(output_node_shp, streams_srs)
+        node_layer = _node_layer(node_ds)
+        defn = node_layer.GetLayerDefn()
+        transactions = node_layer.TestCapability(ogr.OLCTransactions)
+        writer = None
+        if output_table_path:
+            writer = TableWriter(output_table_path, [("NODE", "int64"), ("STREAM_IDS", "int64 list")])
+        try:
+            node_id = 0
+            sorted_records = _external_sort(endpoints, ['cx', 'cy', 'seq'], memory_budget_mb)
+            for cluster in _sweep_clusters(sorted_records, tolerance):
+                node_id += 1
+                stream_ids = [member[5] for member in cluster]
+                _batch_transaction(node_layer, transactions, node_id - 1)
+                _create_node_feature(node_layer, defn, node_id, (cluster[0][3], cluster[0][4]), stream_ids)
+                if writer:
+                    writer.write([node_id, stream_ids])
+                if links:
+                    for sid in stream_ids:
+                        links.append((sid, node_id))
+            if transactions and node_id:
+                node_layer.CommitTransaction()
+        finally:
+            if writer:
+                writer.close()
+            defn = None
+            node_layer = None
+            node_ds = None
+
+        if links:
+            printer.msg("Saving node network reverse table..")
+            writer = TableWriter(output_table_rev_path, [("STREAM_ID", "int64"), ("NODES", "int64 list")])
+            try:
+                current_sid = None
+                nids = []
+                for sid, nid in _external_sort(links, ['sid', 'nid'], memory_budget_mb):
+                    if sid != current_sid:
+                        if current_sid is not None:
+                            writer.write([current_sid, nids])
+                        current_sid = sid
+                        nids = []
+                    nids.append(nid)
+                if current_sid is not None:
+                    writer.write([current_sid, nids])
+            finally:
+                writer.close()
+    finally:
+        endpoints.remove()
+        if links:
+            links.remove()
+
+
+def _sweep_clusters(records, tolerance):
+    # Cluster end point records sorted by grid (column, row, seq). Points can only match within neighbouring cells, so
+    # a cluster is complete once the sweep has moved two columns past its last member. Yields member lists (sorted by
+    # seq) of each completed cluster.
+    tolerance2 = tolerance*tolerance if tolerance and tolerance > 0 else 0
+    parent = {}
+    members = {}
+    last_column = {}
+    prev_cells = {}
+    cur_cells = {}
+    cur_column = None
+
+    def find(seq):
+        while parent[seq] != seq:
+            parent[seq] = parent[parent[seq]]
+            seq = parent[seq]
+        return seq
+
+    def complete(before_column):
+        done = sorted([root for root in last_column if last_column[root] < before_column])
+        clusters = []
+        for root in done:
+            cluster = sorted(members.pop(root), key=lambda r: r[2])
+            del last_column[root]
+            for member in cluster:
+                del parent[member[2]]
+            clusters.append(cluster)
+        return clusters
+
+    for record in records:
+        cx, cy, seq = record[0], record[1], record[2]
+        if cur_column is None:
+            cur_column = cx
+        elif cx != cur_column:
+            prev_cells = cur_cells if cx == cur_column + 1 else {}
+            cur_cells = {}
+            cur_column = cx
+            for cluster in complete(cx - 1):
+                yield cluster
+
+        parent[seq] = seq
+        members[seq] = [record]
+        last_column[seq] = cx
+        for cells in (prev_cells, cur_cells):
+            for ny in (cy-1, cy, cy+1):
+                for other in cells.get(ny, ()):
+                    distance_x = record[3] - other[3]
+                    distance_y = record[4] - other[4]
+                    if distance_x*distance_x + distance_y*distance_y > tolerance2:
+                        continue
+                    root_a = find(seq)
+                    root_b = find(other[2])
+                    if root_a == root_b:
+                        continue
+                    if root_b < root_a:
+                        root_a, root_b = root_b, root_a
+                    parent[root_b] = root_a
+                    members[root_a] += members.pop(root_b)
+                    last_column[root_a] = max(last_column[root_a], last_column.pop(root_b))
+        if cy in cur_cells:
+            cur_cells[cy].append(record)
+        else:
+            cur_cells[cy] = [record]
+
+    for cluster in complete(float("inf")):
+        yield cluster
@@ -0,0 +1,217 @@
+import numpy as np
+
+
+# Array-backed stream network. Segments and nodes are referenced by their index into segment_ids / node_ids. Flow
+# topology is stored as from/to node index arrays per segment (-1 where unknown) with directed adjacency in CSR form,
+# e.g. downstream segments of node n are out_segments[out_offsets[n]:out_offsets[n+1]]. Node incidence (undirected, as
+# listed by the node network) is stored the same way, for stages run before flow direction is known.
+class Network:
+
+    segment_ids = None
+    node_ids = None
+    from_node = None
+    to_node = None
+    braided = None
+    order = None
+    fids = None
+    fingerprint = None
+    attributes = None
+    node_coords = None
+    out_offsets = None
+    out_segments = None
+    in_offsets = None
+    in_segments = None
+    inc_offsets = None
+    inc_segments = None
+
+    def __init__(self, segment_ids, node_ids=None):
+        self.segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        self.node_ids = np.asarray(node_ids if node_ids is not None else [], dtype=np.int64)
+        count = len(self.segment_ids)
+        self.from_node = np.full(count, -1, dtype=np.int32)
+        self.to_node = np.full(count, -1, dtype=np.int32)
+        self.braided = np.zeros(count, dtype=bool)
+        self.order = np.full(count, -1, dtype=np.int64)
+        self.attributes = {}
+
+    @property
+    def segment_count(self):
+        return len(self.segment_ids)
+
+    @property
+    def node_count(self):
+        return len(self.node_ids)
+
+    @staticmethod
+    def from_node_ids(segment_ids, from_node_ids, to_node_ids, braided=None):
+        # network from per-segment from/to node ids (ids <= 0 are treated as unconnected)
+        from_node_ids = np.asarray(from_node_ids, dtype=np.int64)
+        to_node_ids = np.asarray(to_node_ids, dtype=np.int64)
+        both = np.concatenate((from_node_ids, to_node_ids))
+        node_ids = np.unique(both[both > 0])
+        network = Network(segment_ids, node_ids)
+        network.from_node = network.node_index(from_node_ids)
+        network.to_node = network.node_index(to_node_ids)
+        if braided is not None:
+            network.braided = np.asarray(braided, dtype=bool)
+        network.build_adjacency()
+        return network
+
+    def segment_index(self, ids):
+        # index of segment id(s), -1 where not found
+        return self._index_of(self.segment_ids, ids)
+
+    def node_index(self, ids):
+        # index of node id(s), -1 where not found
+        return self._index_of(self.node_ids, ids)
+
+    @staticmethod
+    def _index_of(values, ids):
+        scalar = np.isscalar(ids)
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        if not len(values):
+            found = np.full(len(ids), -1, dtype=np.int32)
+        else:
+            sorter = np.argsort(values, kind='mergesort')
+            pos = np.searchsorted(values, ids, sorter=sorter)
+            pos = np.minimum(pos, len(values) - 1)
+            found = sorter[pos].astype(np.int32)
+            found[values[found] != ids] = -1
+        return int(found[0]) if scalar else found
+
+    def node_ids_of(self, nodes):
+        # node ids of node indices, -1 where index is -1
+        nodes = np.asarray(nodes)
+        ids = np.full(len(nodes), -1, dtype=np.int64)
+        ids[nodes >= 0] = self.node_ids[nodes[nodes >= 0]]
+        return ids
+
+    @staticmethod
+    def _csr(keys, count):
+        # group item indices by key (skipping negative keys), stable in item order
+        items = np.nonzero(keys >= 0)[0]
+        items = items[np.argsort(keys[items], kind='mergesort')]
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys[items], minlength=count), out=offsets[1:])
+        return offsets, items.astype(np.int32)
+
+    def build_adjacency(self):
+        # rebuild directed adjacency from from/to node arrays (call after changing flow direction)
+        self.out_offsets, self.out_segments = self._csr(self.from_node, self.node_count)
+        self.in_offsets, self.in_segments = self._csr(self.to_node, self.node_count)
+
+    def set_incidence(self, node_ids, node_stream_ids):
+        # set nodes and undirected incidence from node network (list of stream ids for each node id)
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        counts = np.array([len(sids) for sids in node_stream_ids], dtype=np.int64)
+        self.inc_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.inc_offsets[1:])
+        flat = [sid for sids in node_stream_ids for sid in sids]
+        self.inc_segments = self.segment_index(np.array(flat, dtype=np.int64))
+        if (self.inc_segments < 0).any():
+            missing = np.array(flat, dtype=np.int64)[self.inc_segments < 0]
+            raise Exception("Could not find segments for node network stream IDs ({0})".format(
+                ", ".join([str(sid) for sid in np.unique(missing)])
+            ))
+        self.from_node = np.full(self.segment_count, -1, dtype=np.int32)
+        self.to_node = np.full(self.segment_count, -1, dtype=np.int32)
+
+    def set_node_coords(self, node_ids, coords):
+        # attach coordinates by node id (nodes not listed keep NaN coordinates)
+        self.node_coords = np.full((self.node_count, 2), np.nan)
+        index = self.node_index(np.asarray(node_ids, dtype=np.int64))
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        valid = index >= 0
+        self.node_coords[index[valid]] = coords[valid]
+
+    def subnetwork(self, segments, nodes):
+        # network restricted to given segment and node indices (e.g. one basin), with node references, incidence and
+        # adjacency remapped to local indices
+        segments = np.asarray(segments, dtype=np.int64)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        sub = Network(self.segment_ids[segments], self.node_ids[nodes])
+        # extra last slot so that -1 maps to -1
+        node_map = np.full(self.node_count + 1, -1, dtype=np.int32)
+        node_map[nodes] = np.arange(len(nodes), dtype=np.int32)
+        sub.from_node = node_map[self.from_node[segments]]
+        sub.to_node = node_map[self.to_node[segments]]
+        sub.braided = self.braided[segments].copy()
+        sub.order = self.order[segments].copy()
+        if self.fids is not None:
+            sub.fids = self.fids[segments]
+        if self.node_coords is not None:
+            sub.node_coords = self.node_coords[nodes]
+        if self.inc_offsets is not None:
+            segment_map = np.full(self.segment_count, -1, dtype=np.int32)
+            segment_map[segments] = np.arange(len(segments), dtype=np.int32)
+            counts = self.inc_offsets[nodes+1] - self.inc_offsets[nodes]
+            sub.inc_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+            np.cumsum(counts, out=sub.inc_offsets[1:])
+            slots = np.repeat(self.inc_offsets[nodes] - sub.inc_offsets[:-1], counts) + np.arange(sub.inc_offsets[-1])
+            sub.inc_segments = segment_map[self.inc_segments[slots]]
+        if self.out_offsets is not None:
+            sub.build_adjacency()
+        return sub
+
+    def compress_chains(self):
+        # Network with each chain of segments joined at pass-through nodes (one upstream and one downstream segment)
+        # collapsed to one segment, from the chain's first from node to its last to node. Compressed segments take the
+        # id, braided flag and order of the most downstream segment of their chain and keep its relative order. Chains
+        # closing on themselves are left as they are. Returns compressed network, index of each segment's chain in it
+        # and index of each node in it (-1 for removed pass-through nodes, plus an extra last slot so -1 maps to -1).
+        from_node = self.from_node.tolist()
+        to_node = self.to_node.tolist()
+        through_nodes = np.nonzero((self.in_degree() == 1) & (self.out_degree() == 1))[0]
+        next_segment = [-1]*self.segment_count
+        is_next = [False]*self.segment_count
+        for upstream, downstream in zip(self.in_segments[self.in_offsets[through_nodes]].tolist(),
+                                        self.out_segments[self.out_offsets[through_nodes]].tolist()):
+            if upstream != downstream:
+                next_segment[upstream] = downstream
+                is_next[downstream] = True
+
+        # follow each chain from its first segment, so every segment is visited once
+        last = [-1]*self.segment_count
+        first_from_node = list(from_node)
+        for s in range(self.segment_count):
+            if is_next[s]:
+                continue
+            members = [s]
+            while next_segment[members[-1]] >= 0:
+                members.append(next_segment[members[-1]])
+            for member in members:
+                last[member] = members[-1]
+            first_from_node[members[-1]] = from_node[s]
+        removed = np.zeros(self.node_count + 1, dtype=bool)
+        for s in range(self.segment_count):
+            if last[s] < 0:
+                # chain closing on itself
+                last[s] = s
+            elif last[s] != s:
+                removed[to_node[s]] = True
+
+        last = np.array(last, dtype=np.int64)
+        chains = np.unique(last)
+        nodes = np.nonzero(~removed[:-1])[0]
+        compressed = Network(self.segment_ids[chains], self.node_ids[nodes])
+        # extra last slot so that -1 maps to -1
+        node_map = np.full(self.node_count + 1, -1, dtype=np.int32)
+        node_map[nodes] = np.arange(len(nodes), dtype=np.int32)
+        compressed.from_node = node_map[np.array(first_from_node, dtype=np.int64)[chains]]
+        compressed.to_node = node_map[self.to_node[chains]]
+        compressed.braided = self.braided[chains].copy()
+        compressed.order = self.order[chains].copy()
+        if self.node_coords is not None:
+            compressed.node_coords = self.node_coords[nodes]
+        compressed.build_adjacency()
+        return compressed, np.searchsorted(chains, last), node_map
+
+    def out_degree(self):
+        return np.diff(self.out_offsets)
+
+    def in_degree(self):
+        return np.diff(self.in_offsets)
+
+    def source_nodes(self):
+        # nodes with no upstream segments but with downstream segments
+        return np.nonzero((self.in_degree() == 0) & (self.out_degree() > 0))[0]
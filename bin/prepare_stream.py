@@ -1,12 +1,20 @@
+import math
+import os
+import numpy as np
 import ogr
+from bin.GridIndex import GridIndex
 from bin.PassPrint import PassPrint
+from bin.basins import _map_pool
+from bin.segment_intersection import _intersect_polyline_pairs
+from bin.shared import _check_updatable, _copy_feature_dataset_as_empty, _dataset_fingerprint, _stream_layer
 from common import feature_utils
 
 
 printer = None
 
 
-def prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column, tolerance):
+def prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column, tolerance, persist_index=False,
+                   intersection_engine="geos", tiles=None, processes=None):
     ogr.UseExceptions()
 
     global printer
@@ -16,10 +24,11 @@ def prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column,
     try:
         printer.msg("Opening dataset..")
         input_streams_ds = feature_utils.getFeatureDataset(input_stream_dataset)
-        input_streams_layer = input_streams_ds.GetLayer()
+        input_streams_layer = _stream_layer(input_streams_ds)
 
-        streams_ds = feature_utils.copyFeatureDatasetAsEmpty(input_streams_ds, output_path=copy_stream_dataset, overwrite=True, new_geom_type=ogr.wkbLineString)
-        streams_layer = streams_ds.GetLayer()
+        _check_updatable(copy_stream_dataset)
+        streams_ds = _copy_feature_dataset_as_empty(input_streams_ds, copy_stream_dataset, ogr.wkbLineString)
+        streams_layer = _stream_layer(streams_ds)
         streams_defn = streams_layer.GetLayerDefn()
 
         # check for stream id column
@@ -46,14 +55,38 @@ def prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column,
         input_streams_layer = None
         input_streams_ds = None
 
-        # printer.msg("Snapping endpoints..")
-        # new_features = _snap_endpoints(streams_layer, streams_defn, fields)
-        # if len(new_features):
-        #     printer.msg("  adding split features..")
-        #     streams_ds, streams_layer, streams_defn = _replace_and_update(streams_ds, copy_stream_dataset, new_features)
+        if tolerance and tolerance > 0:
+            printer.msg("Snapping endpoints..")
+            snap_count = _snap_endpoints(streams_layer, tolerance)
+            if snap_count:
+                printer.msg("  snapped {0} endpoints..".format(snap_count))
+
+        printer.msg("Indexing features..")
+        # copy is fully determined by input dataset and snap tolerance, so saved index is only reused for the same
+        # state of input (and never if input can't be fingerprinted)
+        input_fingerprint = _dataset_fingerprint(input_stream_dataset)
+        index_path = os.path.splitext(copy_stream_dataset)[0] + ".gidx" if persist_index and input_fingerprint else None
+        index_signature = (input_fingerprint, tolerance)
+        index = GridIndex.load(index_path, index_signature)
+        if index:
+            printer.msg("  using saved index..")
+        else:
+            index = _build_index(streams_layer)
+            if index_path:
+                index.save(index_path, index_signature)
 
         printer.msg("Checking intersections..")
-        new_features = _split_intersections(streams_layer, streams_defn, fields, field_sid)
+        if tiles and tiles > 1:
+            # tile workers read the copy from disk, so close and reopen to commit changes first
+            streams_layer = None
+            streams_defn = None
+            streams_ds = None
+            streams_ds = feature_utils.getFeatureDataset(copy_stream_dataset, write=1)
+            streams_layer = _stream_layer(streams_ds)
+            streams_defn = streams_layer.GetLayerDefn()
+        new_features = _split_intersections(streams_layer, streams_defn, fields, field_sid, index,
+                                            intersection_engine, tiles, processes, copy_stream_dataset)
+        index = None
         if len(new_features):
             printer.msg("  adding split features..")
             streams_ds, streams_layer, streams_defn = _replace_and_update(streams_ds, copy_stream_dataset, new_features)
@@ -71,7 +104,7 @@ def prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column,
 
 
 def _replace_and_update(dataset, path, new_features):
-    layer = dataset.GetLayer()
+    layer = _stream_layer(dataset)
     for feat in new_features:
         layer.CreateFeature(feat)
     feat = None
@@ -80,15 +113,16 @@ def _replace_and_update(dataset, path, new_features):
     layer = None
     dataset = None
     dataset = feature_utils.getFeatureDataset(path, write=1)
-    layer = dataset.GetLayer()
+    layer = _stream_layer(dataset)
     defn = layer.GetLayerDefn()
     return dataset, layer, defn
 
 
 def _copy_feature(input_streams_layer, streams_layer, streams_defn, input_fields, input_sid_field, stream_id_column):
-    num_streams = input_streams_layer.GetFeatureCount()
-    for i in range(num_streams):
-        feat = input_streams_layer.GetFeature(i)
+    # read in sequence, as fids don't always run from 0 (e.g. from 1 in GeoPackage)
+    input_streams_layer.ResetReading()
+    feat = input_streams_layer.GetNextFeature()
+    while feat:
         geom = feat.GetGeometryRef()
         geom_type = geom.GetGeometryType()
 
@@ -121,246 +155,364 @@ def _copy_feature(input_streams_layer, streams_layer, streams_defn, input_fields
             streams_layer.CreateFeature(copy_feat)
             copy_feat = None
             first = False
-
-
-def _snap_endpoints(streams_layer, streams_defn, fields, tolerance):
+        feat = input_streams_layer.GetNextFeature()
+
+
+def _read_vertices(streams_layer, only_fids=None):
+    # read all vertices once into flat array, lines then referenced by offsets (line i spans offsets[i]:offsets[i+1]),
+    # optionally only of given features
+    fids = []
+    coords = []
+    offsets = [0]
+    if only_fids is not None:
+        for fid in sorted(only_fids):
+            points = streams_layer.GetFeature(fid).GetGeometryRef().GetPoints()
+            fids.append(fid)
+            coords += [(p[0], p[1]) for p in points]
+            offsets.append(len(coords))
+        return fids, np.array(coords, dtype=float).reshape(-1, 2), np.array(offsets)
+    streams_layer.ResetReading()
+    feat = streams_layer.GetNextFeature()
+    while feat:
+        points = feat.GetGeometryRef().GetPoints()
+        fids.append(feat.GetFID())
+        coords += [(p[0], p[1]) for p in points]
+        offsets.append(len(coords))
+        feat = streams_layer.GetNextFeature()
+    streams_layer.ResetReading()
+    return fids, np.array(coords, dtype=float).reshape(-1, 2), np.array(offsets)
+
+
+def _snap_endpoints(streams_layer, tolerance, batch_endpoints=100000):
+    fids, coords, offsets = _read_vertices(streams_layer)
+    num_lines = len(fids)
+    if not num_lines:
+        return 0
     tolerance2 = tolerance*tolerance
-    num_streams = streams_layer.GetFeatureCount()
-
-    # first create segments for all geometries
-    all_segments = []
-    for i in range(num_streams):
-        this_feat = streams_layer.GetFeature(i)
-        this_geom = this_feat.GetGeometryRef()
-        # get "this" coordinates
-        this_line = this_geom.GetPoints()
-        # create segments
-        all_segments.append([])
-        for c in range(1, this_line.length):
-            segment_start = this_line[c-1]
-            segment_end = this_line[c]
-            if segment_start[0] > segment_end[1]:
-                swap = segment_start
-                segment_start = segment_end
-                segment_end = swap
-            if segment_start[1] == segment_end[1]:
-                slope = float("inf")
-            else:
-                slope = (segment_end[1] - segment_start[1]) / (segment_end[0] - segment_start[0])
-            positive_slope = slope == float("inf") or slope >= 0
-            all_segments[i].append({
-                'x0': segment_start[0],
-                'x1': segment_end[0],
-                'y0': segment_start[1],
-                'y1': segment_end[1],
-                'ymin': segment_start[1] if positive_slope else segment_end[1],
-                'ymax': segment_end[1] if positive_slope else segment_start[1],
-                'slope': slope,
-                'yintercept': segment_start[1] - slope*segment_start[0]
-            })
-        this_line = None
-        this_geom = None
-        this_feat = None
-
-    new_features = []
-    remove_features = []
-    # loop features
-    for i in range(num_streams):
-        this_feat = streams_layer.GetFeature(i)
-        this_geom = this_feat.GetGeometryRef()
-        points = this_geom.GetPoints()
-        endpoints = [points[0], points[-1]]
-
-        # way this works is all possible snap points and distances are kept and closest is picked
-        snapped_ends = [[], []]
-
-        # loop against segments of other features
-        for j in range(i+1, num_streams):
-            for segment in all_segments[j]:
-
-                # check each endpoint distance from segment
-                for e in range(2):
-                    endpoint = endpoints[e]
-                    nearest_pt = None
-                    # quick check if outside x-range
-                    distance_x = 0
-                    if endpoint[0] < segment['x0']:
-                        distance_x = abs(segment['x0'] - endpoint[0])
-                    elif endpoint[1] > segment['x1']:
-                        distance_x = abs(segment['x1'] - endpoint[0])
-                    if distance_x > tolerance:
-                        continue
-                    # same with -yrange
-                    distance_y = 0
-                    if endpoint[1] < segment['ymin']:
-                        distance_y = abs(segment['ymin'] - endpoint[1])
-                    elif endpoint[1] > segment['ymax']:
-                        distance_y = abs(segment['ymax'] - endpoint[1])
-                    if distance_y > tolerance:
-                        continue
-                    # vertical line
-                    if slope == float("inf"):
-                        distance_x2 = (segment['x0'] - endpoint[0])**2
-                        if endpoint[1] < segment['y0']:
-                            nearest_pt = segment_start
-                            distance2 = distance_x2 + (segment['y0'] - endpoint[1])**2
-                        elif endpoint[1] > segment['y1']:
-                            nearest_pt = segment_end
-                            distance2 = distance_x2 + (segment['y1'] - endpoint[1])**2
-                        else:
-                            nearest_pt = (segment['x0'], endpoint[1])
-                            distance2 = distance_x2
-                    # flat line
-                    elif slope == 0:
-                        distance_y2 = (segment['y0'] - endpoint[1])**2
-                        if endpoint[0] < segment['x0']:
-                            nearest_pt = segment_start
-                            distance2 = distance_y2 + (segment['x0'] - endpoint[0])**2
-                        elif endpoint[0] > segment['x1']:
-                            nearest_pt = segment_end
-                            distance2 = distance_y2 + (segment['x1'] - endpoint[0])**2
-                        else:
-                            nearest_pt = (endpoint[0], segment['y0'])
-                            distance2 = distance_y2
-                    else:
-                        # solve for nearest point on segment
-                        critp_x = segment['slope']*(endpoint[1] - segment['slope']*endpoint[0] - segment['yintercept'])
-                        critp_x /= (1 + segment['slope']**2)
-                        critp_x += endpoint[0]
-                        distance_x2 = (critp_x - endpoint[0])**2
-                        if distance_x2 < tolerance2:
-                            critp_y = segment['slope']*critp_x + segment['yintercept']
-                            distance_y2 = (critp_y - endpoint[1])**2
-                            if distance_y2 < tolerance2:
-                                nearest_pt = (critp_x, critp_y)
-                                distance2 = distance_x2 + distance_y2
-                    # add to list
-                    if nearest_pt and distance2 <= tolerance2:
-                        snapped_ends[e].append([nearest_pt, distance2])
-        # end of inner loops
-
-        # check list of snapped ends for closest
-        best_snap = [None, None]
-        for p in range(2):
-            for snap in snapped_ends[p]:
-                # actual intersect exists, then don't snap
-                if snap[1] == 0:
-                    best_snap[p] = False
-                    break
-                if not best_snap[p] or snap[1] < best_snap[p][1]:
-                    best_snap[p] = snap
-        snapped_ends = None
-
-        # add snap point to existing line
-        changed = False
-        for p in range(2):
-            if best_snap[p]:
-                changed = True
-                if p == 0:
-                    points = [best_snap[p][0]] + points
-                else:
-                    points += [best_snap[p][0]]
-        best_snap = None
-
-        # mark as new feature and feature to remove
-        if changed:
-            remove_features.append(this_feat)
-            new_geom = ogr.Geometry(ogr.wkbLineString)
-            for p in points:
-                new_geom.AddPoint(p[0], p[1])
-            new_feat = ogr.Feature(streams_defn)
-            new_feat.SetGeometry(new_geom)
-            new_geom = None
-            for field in fields:
-                new_feat.SetField(field['name'], feature_utils.getFieldValue(this_feat, field))
-            new_features.append(new_feat)
-            new_feat = None
-
-        this_geom = None
-        this_feat = None
-
-    if len(remove_features):
-        printer.msg("  deleting split features..")
-        for feat in remove_features:
-            fid = feat.GetFID()
-            streams_layer.DeleteFeature(fid)
-            feat = None
-        remove_features = None
 
-    return new_features
+    # segments as start vertex index, with line index of each
+    line_lengths = offsets[1:] - offsets[:-1]
+    seg_counts = np.maximum(line_lengths - 1, 0)
+    seg_line = np.repeat(np.arange(num_lines), seg_counts)
+    seg_start = np.arange(len(seg_line)) - np.repeat(np.cumsum(seg_counts) - seg_counts, seg_counts) + offsets[seg_line]
+    if not len(seg_start):
+        return 0
+    x0, y0 = coords[seg_start, 0], coords[seg_start, 1]
+    x1, y1 = coords[seg_start+1, 0], coords[seg_start+1, 1]
+    dx, dy = x1 - x0, y1 - y0
+    seg_len2 = dx*dx + dy*dy
+
+    # hash grid with segment bounding boxes (expanded by tolerance) registered in every cell they touch
+    cell_size = max(tolerance, float(np.median(np.sqrt(seg_len2))))
+    cx0 = np.floor((np.minimum(x0, x1) - tolerance) / cell_size).astype(np.int64)
+    cx1 = np.floor((np.maximum(x0, x1) + tolerance) / cell_size).astype(np.int64)
+    cy0 = np.floor((np.minimum(y0, y1) - tolerance) / cell_size).astype(np.int64)
+    cy1 = np.floor((np.maximum(y0, y1) + tolerance) / cell_size).astype(np.int64)
+    min_cx, min_cy = cx0.min(), cy0.min()
+    rows = cy1.max() - min_cy + 1
+    widths = cx1 - cx0 + 1
+    spans = widths * (cy1 - cy0 + 1)
+    cell_seg = np.repeat(np.arange(len(seg_start)), spans)
+    local = np.arange(len(cell_seg)) - np.repeat(np.cumsum(spans) - spans, spans)
+    cell_keys = (cx0[cell_seg] + local % widths[cell_seg] - min_cx) * rows + (cy0[cell_seg] + local // widths[cell_seg] - min_cy)
+    order = np.argsort(cell_keys, kind='mergesort')
+    cell_keys = cell_keys[order]
+    cell_seg = cell_seg[order]
+    local = None
+
+    # line end points (empty lines have none)
+    has_points = line_lengths > 0
+    end_line = np.repeat(np.arange(num_lines)[has_points], 2)
+    end_vertex = np.column_stack((offsets[:-1][has_points], offsets[1:][has_points] - 1)).ravel()
+    end_x, end_y = coords[end_vertex, 0], coords[end_vertex, 1]
+    end_keys = (
+        (np.floor(end_x / cell_size).astype(np.int64) - min_cx) * rows +
+        (np.floor(end_y / cell_size).astype(np.int64) - min_cy)
+    )
+
+    # find closest segment of another line for every end point, in batches of end points
+    snap_seg = np.full(len(end_vertex), -1, dtype=np.int64)
+    snap_t = np.zeros(len(end_vertex))
+    snap_pt = np.zeros((len(end_vertex), 2))
+    for b0 in range(0, len(end_vertex), batch_endpoints):
+        b1 = min(b0 + batch_endpoints, len(end_vertex))
+        lo = np.searchsorted(cell_keys, end_keys[b0:b1], side='left')
+        hi = np.searchsorted(cell_keys, end_keys[b0:b1], side='right')
+        counts = hi - lo
+        cand_end = np.repeat(np.arange(b0, b1), counts)
+        cand_seg = cell_seg[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        other = seg_line[cand_seg] != end_line[cand_end]
+        cand_end, cand_seg = cand_end[other], cand_seg[other]
+        if not len(cand_seg):
+            continue
+
+        # nearest point on segment (exact vertex where clamped to segment ends)
+        px, py = end_x[cand_end], end_y[cand_end]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((px - x0[cand_seg])*dx[cand_seg] + (py - y0[cand_seg])*dy[cand_seg]) / seg_len2[cand_seg]
+        t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+        nx = x0[cand_seg] + t*dx[cand_seg]
+        ny = y0[cand_seg] + t*dy[cand_seg]
+        nx[t == 0], ny[t == 0] = x0[cand_seg][t == 0], y0[cand_seg][t == 0]
+        nx[t == 1], ny[t == 1] = x1[cand_seg][t == 1], y1[cand_seg][t == 1]
+        dist2 = (nx - px)**2 + (ny - py)**2
+        within = dist2 <= tolerance2
+        if not within.any():
+            continue
+        cand_end, cand_seg, t, nx, ny, dist2 = (
+            cand_end[within], cand_seg[within], t[within], nx[within], ny[within], dist2[within]
+        )
+
+        # closest per end point (ties broken by segment order)
+        order = np.lexsort((cand_seg, dist2, cand_end))
+        first = order[np.concatenate(([True], np.diff(cand_end[order]) != 0))]
+        snap_seg[cand_end[first]] = cand_seg[first]
+        snap_t[cand_end[first]] = t[first]
+        snap_pt[cand_end[first], 0] = nx[first]
+        snap_pt[cand_end[first], 1] = ny[first]
+        # already touching, no snap needed
+        touching = first[dist2[first] == 0]
+        snap_seg[cand_end[touching]] = -1
+
+    # don't snap onto end points of other lines, those are merged as nodes when building the node network (and
+    # extending both lines to each other would create an overlap)
+    valid = snap_seg >= 0
+    seg_first = seg_start == offsets[seg_line]
+    seg_last = seg_start + 2 == offsets[seg_line + 1]
+    onto_end = valid.copy()
+    onto_end[valid] = (
+        ((snap_t[valid] == 0) & seg_first[snap_seg[valid]]) |
+        ((snap_t[valid] == 1) & seg_last[snap_seg[valid]])
+    )
+    snap_seg[onto_end] = -1
+    snapped = np.nonzero(snap_seg >= 0)[0]
+    if not len(snapped):
+        return 0
+
+    # bulk edits per line: extend snapped ends, and insert vertices where other lines snap onto interior of segments
+    extend_start = {}
+    extend_end = {}
+    insertions = {}
+    for e in snapped:
+        line = int(end_line[e])
+        point = (float(snap_pt[e, 0]), float(snap_pt[e, 1]))
+        if e % 2 == 0:
+            extend_start[line] = point
+        else:
+            extend_end[line] = point
+        t = snap_t[e]
+        if 0 < t < 1:
+            seg = int(snap_seg[e])
+            target = int(seg_line[seg])
+            if target not in insertions:
+                insertions[target] = []
+            insertions[target].append((int(seg_start[seg]), float(t), point))
+
+    changed_lines = sorted(set(extend_start.keys()) | set(extend_end.keys()) | set(insertions.keys()))
+    for line in changed_lines:
+        inserts = sorted(insertions.get(line, []))
+        points = []
+        if line in extend_start:
+            points.append(extend_start[line])
+        i = 0
+        for v in range(offsets[line], offsets[line+1]):
+            vertex = (float(coords[v, 0]), float(coords[v, 1]))
+            points.append(vertex)
+            while i < len(inserts) and inserts[i][0] == v:
+                next_vertex = (float(coords[v+1, 0]), float(coords[v+1, 1]))
+                if inserts[i][2] != points[-1] and inserts[i][2] != next_vertex:
+                    points.append(inserts[i][2])
+                i += 1
+        if line in extend_end:
+            points.append(extend_end[line])
+
+        feat = streams_layer.GetFeature(fids[line])
+        new_geom = ogr.Geometry(ogr.wkbLineString)
+        for point in points:
+            new_geom.AddPoint(point[0], point[1])
+        feat.SetGeometry(new_geom)
+        streams_layer.SetFeature(feat)
+        new_geom = None
+        feat = None
+
+    return len(snapped)
+
+
+def _build_index(streams_layer):
+    envelopes = {}
+    streams_layer.ResetReading()
+    feat = streams_layer.GetNextFeature()
+    while feat:
+        envelopes[feat.GetFID()] = feat.GetGeometryRef().GetEnvelope()
+        feat = streams_layer.GetNextFeature()
+    streams_layer.ResetReading()
+    return GridIndex.from_envelopes(envelopes)
+
+
+def _intersection_points(this_geom, that_geom):
+    intersection = this_geom.Intersection(that_geom)
+    if intersection.IsEmpty():
+        return None
+    igtype = intersection.GetGeometryType()
+    if igtype == ogr.wkbPoint:
+        intersection_points = intersection.GetPoints()
+    elif igtype == ogr.wkbMultiPoint:
+        intersection_points = []
+        for g in range(intersection.GetGeometryCount()):
+            point = intersection.GetGeometryRef(g)
+            intersection_points.append(point.GetPoints()[0])
+            point = None
+    else:
+        # don't currently handle line intersections
+        raise Exception("Unable to handle intersection type {0}".format(igtype))
+    intersection = None
+    return intersection_points
+
+
+def _geos_intersections(streams_layer, pairs):
+    this_fid = None
+    this_feat = None
+    this_geom = None
+    for i, j in pairs:
+        if i != this_fid:
+            this_fid = i
+            this_feat = streams_layer.GetFeature(i)
+            this_geom = this_feat.GetGeometryRef()
+        that_feat = streams_layer.GetFeature(j)
+        that_geom = that_feat.GetGeometryRef()
+
+        intersection_points = _intersection_points(this_geom, that_geom)
+        if intersection_points and len(intersection_points):
+            # vertex indices not known
+            yield i, j, intersection_points, None, None
+
+        that_geom = None
+        that_feat = None
+    this_geom = None
+    this_feat = None
+
+
+def _numpy_intersections(streams_layer, candidate_pairs, only_fids=None, batch_pairs=100000):
+    fids, coords, offsets = _read_vertices(streams_layer, only_fids)
+    line_by_fid = dict((fid, i) for i, fid in enumerate(fids))
+
+    def run_batch(pairs):
+        degenerate = []
+        for i, j, points, this_vertices, that_vertices in _intersect_polyline_pairs(coords, offsets, pairs):
+            if points is None:
+                degenerate.append((fids[i], fids[j]))
+            elif len(points):
+                yield fids[i], fids[j], [tuple(p) for p in points.tolist()], this_vertices.tolist(), that_vertices.tolist()
+        # collinear and degenerate cases fall back to GEOS
+        for result in _geos_intersections(streams_layer, degenerate):
+            yield result
+
+    pairs = []
+    for i, j in candidate_pairs:
+        pairs.append((line_by_fid[i], line_by_fid[j]))
+        if len(pairs) >= batch_pairs:
+            for result in run_batch(pairs):
+                yield result
+            pairs = []
+    if len(pairs):
+        for result in run_batch(pairs):
+            yield result
+
+
+def _pair_intersections(streams_layer, candidate_pairs, engine, only_fids=None):
+    if engine == "numpy":
+        return _numpy_intersections(streams_layer, candidate_pairs, only_fids)
+    elif engine == "geos":
+        return _geos_intersections(streams_layer, candidate_pairs)
+    raise Exception("Unknown intersection engine ({0})".format(engine))
+
+
+def _tiled_intersections(dataset_path, streams_layer, index, engine, tiles, processes):
+    # Split layer extent into tiles. Candidate pairs of features whose envelopes lie within a single tile are checked
+    # by a worker per tile (reading the dataset from disk), largest tiles first. Pairs involving features crossing tile
+    # boundaries are checked in a final seam pass. Each pair is checked exactly once, so results match a serial run.
+    minx, maxx, miny, maxy = streams_layer.GetExtent()
+    per_side = int(math.ceil(math.sqrt(tiles)))
+    tile_width = (maxx - minx) / per_side or 1.0
+    tile_height = (maxy - miny) / per_side or 1.0
+
+    def tile_of(envelope):
+        tx0 = int((envelope[0] - minx) / tile_width)
+        tx1 = int((envelope[1] - minx) / tile_width)
+        ty0 = int((envelope[2] - miny) / tile_height)
+        ty1 = int((envelope[3] - miny) / tile_height)
+        return (tx0, ty0) if tx0 == tx1 and ty0 == ty1 else None
+
+    tile_by_fid = dict((fid, tile_of(envelope)) for fid, envelope in index.envelopes.items())
+    tile_pairs = {}
+    seam_pairs = []
+    for i, j in index.candidate_pairs():
+        tile = tile_by_fid[i]
+        if tile is not None and tile == tile_by_fid[j]:
+            tile_pairs.setdefault(tile, []).append((i, j))
+        else:
+            seam_pairs.append((i, j))
+
+    tasks = []
+    for tile in sorted(tile_pairs.keys(), key=lambda tile: -len(tile_pairs[tile])):
+        pairs = tile_pairs[tile]
+        tile_fids = set([i for i, j in pairs] + [j for i, j in pairs])
+        tasks.append((dataset_path, pairs, engine, tile_fids))
+    tile_pairs = None
+    printer.msg("  {0} tiles, {1} seam pairs..".format(len(tasks), len(seam_pairs)))
+    for i, results in _map_pool(_tile_intersections, tasks, processes):
+        for result in results:
+            yield result
+
+    seam_fids = set([i for i, j in seam_pairs] + [j for i, j in seam_pairs])
+    for result in _pair_intersections(streams_layer, seam_pairs, engine, seam_fids):
+        yield result
+
+
+def _tile_intersections(task):
+    # process pool worker, intersections of one tile read from dataset on disk
+    dataset_path, pairs, engine, tile_fids = task
+    ogr.UseExceptions()
+    streams_ds = feature_utils.getFeatureDataset(dataset_path)
+    streams_layer = _stream_layer(streams_ds)
+    try:
+        return list(_pair_intersections(streams_layer, pairs, engine, tile_fids))
+    finally:
+        streams_layer = None
+        streams_ds = None
 
 
-def _split_intersections(streams_layer, streams_defn, fields, field_sid):
+def _split_intersections(streams_layer, streams_defn, fields, field_sid, index=None, engine="geos", tiles=None,
+                         processes=None, dataset_path=None):
     global printer
-    num_streams = streams_layer.GetFeatureCount()
+    if not index:
+        index = _build_index(streams_layer)
+
+    if tiles and tiles > 1:
+        pair_intersections = _tiled_intersections(dataset_path, streams_layer, index, engine, tiles, processes)
+    else:
+        pair_intersections = _pair_intersections(streams_layer, index.candidate_pairs(), engine)
+
+    # collect intersection points (with vertex index where known) for each feature first, so features crossing
+    # several others are only split once
+    split_points = {}
+    for i, j, intersection_points, this_vertices, that_vertices in pair_intersections:
+        for fid, vertices in ((i, this_vertices), (j, that_vertices)):
+            if fid not in split_points:
+                split_points[fid] = []
+            split_points[fid] += zip(intersection_points, vertices or [None]*len(intersection_points))
+
+    # split out new line segments
     new_features = []
     remove_features = []
-    removed_indices = []
-    for i in range(num_streams):
-        this_feat = streams_layer.GetFeature(i)
-        this_geom = this_feat.GetGeometryRef()
-        this_env = this_geom.GetEnvelope()
-        this_id = feature_utils.getFieldValue(this_feat, field_sid)
-
-        for j in range(i+1, num_streams):
-            that_feat = streams_layer.GetFeature(j)
-            that_geom = that_feat.GetGeometryRef()
-            that_env = that_geom.GetEnvelope()
-
-            # check bounds
-            check_intersection = True
-            if that_env[0] > this_env[1] or that_env[1] < this_env[0]:
-                check_intersection = False
-            if check_intersection and (that_env[2] > this_env[3] or that_env[3] < this_env[2]):
-                check_intersection = False
-
-            # check intersection
-            has_intersection = False
-            if check_intersection:
-                intersection = this_geom.Intersection(that_geom)
-                if not intersection.IsEmpty():
-                    has_intersection = True
-                    igtype = intersection.GetGeometryType()
-                    if igtype == ogr.wkbPoint:
-                        intersection_points = intersection.GetPoints()
-                    elif igtype == ogr.wkbMultiPoint:
-                        intersection_points = []
-                        for g in range(intersection.GetGeometryCount()):
-                            point = intersection.GetGeometryRef(g)
-                            intersection_points.append(point.GetPoints()[0])
-                            point = None
-                    else:
-                        # don't currently handle line intersections
-                        raise Exception("Unable to handle intersection type {0}".format(igtype))
-                    if not intersection_points or not len(intersection_points):
-                        has_intersection = False
-            # split out new line segments
-            if has_intersection:
-                this_split_feats = _split_feature(streams_layer, streams_defn, fields, field_sid, this_feat, intersection_points)
-                if len(this_split_feats):
-                    printer.msg("  split segment={0}".format(this_id))
-                    if this_id not in removed_indices:
-                        removed_indices.append(this_id)
-                        remove_features.append(this_feat)
-                    new_features += this_split_feats
-                that_split_feats = _split_feature(streams_layer, streams_defn, fields, field_sid, that_feat, intersection_points)
-                if len(that_split_feats):
-                    that_id = feature_utils.getFieldValue(that_feat, field_sid)
-                    printer.msg("  split segment={0}".format(that_id))
-                    if that_id not in remove_features:
-                        removed_indices.append(that_id)
-                        remove_features.append(that_feat)
-                    new_features += that_split_feats
-                add_new_feats = None
-
-            intersection = None
-            that_env = None
-            that_geom = None
-            that_feat = None
-
-        this_env = None
-        this_geom = None
-        this_feat = None
+    for fid in sorted(split_points.keys()):
+        feat = streams_layer.GetFeature(fid)
+        split_feats = _split_feature(streams_layer, streams_defn, fields, field_sid, feat, split_points[fid])
+        if len(split_feats):
+            printer.msg("  split segment={0}".format(feature_utils.getFieldValue(feat, field_sid)))
+            remove_features.append(feat)
+            new_features += split_feats
+        feat = None
 
     if len(remove_features):
         printer.msg("  deleting split features..")
@@ -374,20 +526,41 @@ def _split_intersections(streams_layer, streams_defn, fields, field_sid):
 
 
 def _split_feature(layer, defn, fields, id_column, feature, intersection_points):
+    # intersection points as (point, vertex) with index of starting vertex of segment where point occurs, or None if
+    # not known, in which case the point is matched against all vertices
     geom = feature.GetGeometryRef()
     coords = geom.GetPoints()
 
+    # vertices at intersection points, where known only the ends of that segment are checked (a point inside the
+    # segment can still be a vertex elsewhere where the line folds back on itself, so is then matched as unknown, as
+    # are all points of lines repeating a vertex, which are split at every occurrence)
+    split_vertices = set()
+    unknown_points = []
+    repeated = len(set((point[0], point[1]) for point in coords)) < len(coords)
+    for ipoint, vertex in intersection_points:
+        if vertex is not None and not repeated:
+            if coords[vertex][0] == ipoint[0] and coords[vertex][1] == ipoint[1]:
+                split_vertices.add(vertex)
+                continue
+            if coords[vertex+1][0] == ipoint[0] and coords[vertex+1][1] == ipoint[1]:
+                split_vertices.add(vertex + 1)
+                continue
+        unknown_points.append(ipoint)
+    if len(unknown_points):
+        for v in range(len(coords)):
+            for ipoint in unknown_points:
+                if coords[v][0] == ipoint[0] and coords[v][1] == ipoint[1]:
+                    split_vertices.add(v)
+                    break
+
     # split current geometry by intersection points
     new_line_coords = []
     running_coords = []
-    for point in coords:
-        running_coords.append(point)
-        for ipoint in intersection_points:
-            if point[0] == ipoint[0] and point[1] == ipoint[1]:
-                if len(running_coords) >= 2:
-                    new_line_coords.append(running_coords)
-                    running_coords = [running_coords[-1]]
-                break
+    for v in range(len(coords)):
+        running_coords.append(coords[v])
+        if v in split_vertices and len(running_coords) >= 2:
+            new_line_coords.append(running_coords)
+            running_coords = [coords[v]]
     if len(running_coords) >= 2:
         new_line_coords.append(running_coords)
 
@@ -419,25 +592,25 @@ def _split_feature(layer, defn, fields, id_column, feature, intersection_points)
 
 
 def _assign_stream_ids(streams_layer, field_sid):
-    existing_ids = []
-    num_streams = streams_layer.GetFeatureCount()
-    for i in range(num_streams):
-        feat = streams_layer.GetFeature(i)
-        sid = feature_utils.getFieldValue(feat, field_sid)
-        if sid > 0:
-            if sid in existing_ids:
-                feat.SetField(field_sid['name'], -1)
-                streams_layer.SetFeature(feat)
-            else:
-                existing_ids.append(sid)
-
-    existing_ids.sort()
-    next_id = existing_ids[-1]
-
-    for i in range(num_streams):
-        feat = streams_layer.GetFeature(i)
-        sid = feature_utils.getFieldValue(feat, field_sid)
-        if sid <= 0:
-            next_id += 1
-            feat.SetField(field_sid['name'], next_id)
-            streams_layer.SetFeature(feat)
+    # read ids in sequence first (fids don't always run from 0), then renumber duplicate and missing ids by fid
+    fid_ids = []
+    streams_layer.ResetReading()
+    feat = streams_layer.GetNextFeature()
+    while feat:
+        fid_ids.append((feat.GetFID(), feature_utils.getFieldValue(feat, field_sid)))
+        feat = streams_layer.GetNextFeature()
+
+    existing_ids = set()
+    renumber_fids = []
+    for fid, sid in fid_ids:
+        if sid > 0 and sid not in existing_ids:
+            existing_ids.add(sid)
+        else:
+            renumber_fids.append(fid)
+
+    next_id = max(existing_ids) if len(existing_ids) else 0
+    for fid in renumber_fids:
+        feat = streams_layer.GetFeature(fid)
+        next_id += 1
+        feat.SetField(field_sid['name'], next_id)
+        streams_layer.SetFeature(feat)
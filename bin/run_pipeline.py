@@ -0,0 +1,130 @@
+import numpy as np
+import common.feature_utils as feature_utils
+from common import raster_utils
+from gdal import osr
+import bin.get_node_network
+import bin.calculate_flow
+import bin.complete_braided_streams
+import bin.calculate_stream_order
+from bin.PassPrint import PassPrint
+from bin.network.Network import Network
+from bin.get_node_network import _read_end_nodes, _consolidate_nodes, _number_nodes, _write_node_tables, \
+    _write_node_dataset
+from bin.calculate_flow import _solve_flow, _write_flow_table
+from bin.complete_braided_streams import _check_braided_directions, _find_braided_networks
+from bin.calculate_stream_order import ORDER_TYPES, _assign_orders, _get_node_network, _write_order_table
+from shared import _check_srs_units, _stream_layer, _write_segment_columns
+
+
+printer = None
+
+
+def run_pipeline(stream_dataset, stream_id_column, drainage_node_ids, from_node_column, to_node_column, braided_column,
+                 stream_order_column, tolerance, elevation_dataset, output_node_shp, output_table_path,
+                 output_table_rev_path, output_flow_table_path, output_order_table_path, engine="python",
+                 order_columns=None):
+    # Runs node network, flow, braided stream completion and stream order on a prepared stream dataset, keeping the
+    # network in memory between stages. Streams are read once and attributes written once at the end. Intermediate
+    # outputs (node dataset and tables) are only written if paths are given.
+    global printer
+    if not printer:
+        printer = PassPrint()
+    for module in (bin.get_node_network, bin.calculate_flow, bin.complete_braided_streams, bin.calculate_stream_order):
+        module.printer = printer
+
+    if not drainage_node_ids or not len(drainage_node_ids):
+        raise Exception("Drainage node ids must be manually supplied")
+    if not order_columns:
+        order_columns = {"strahler": stream_order_column}
+    for order_type in order_columns:
+        if order_type not in ORDER_TYPES:
+            raise Exception("Unknown stream order type ({0})".format(order_type))
+    order_types = [order_type for order_type in ORDER_TYPES if order_type in order_columns]
+
+    printer.msg("Reading streams dataset..")
+    streams_ds = feature_utils.getFeatureDataset(stream_dataset)
+    streams_layer = _stream_layer(streams_ds)
+    streams_srs = streams_layer.GetSpatialRef()
+    streams_defn = streams_layer.GetLayerDefn()
+    _check_srs_units(srs=streams_srs)
+    id_field_index = streams_defn.GetFieldIndex(stream_id_column)
+    if id_field_index < 0:
+        raise Exception("Could not find stream ID column ({0})".format(stream_id_column))
+    all_nodes, all_stream_ids, all_fids = _read_end_nodes(streams_layer, streams_defn.GetFieldDefn(id_field_index))
+    streams_defn = None
+    streams_layer = None
+    streams_ds = None
+
+    printer.msg("Creating node network..")
+    nodes = _consolidate_nodes(all_nodes, tolerance)
+    all_nodes = None
+    network_map = _number_nodes(nodes, all_stream_ids)
+    if output_table_path or output_table_rev_path:
+        printer.msg("Saving node network table..")
+        _write_node_tables(nodes, network_map, output_table_path, output_table_rev_path)
+    network_map = None
+    if output_node_shp:
+        printer.msg("Saving node shapefile..")
+        _write_node_dataset(output_node_shp, streams_srs, nodes)
+
+    network = Network(all_stream_ids)
+    network.fids = np.array(all_fids, dtype=np.int64)
+    network.set_incidence([node.id for node in nodes], [node.segments for node in nodes])
+    network.set_node_coords([node.id for node in nodes], [node.coords[:2] for node in nodes])
+    nodes = None
+    drainage_nodes = network.node_index(list(drainage_node_ids))
+    if (drainage_nodes < 0).any():
+        raise Exception("Could not match all drainage node IDs given")
+
+    printer.msg("Calculating flow..")
+    braided_count, unconnected_segments = _solve_flow(network, drainage_nodes.tolist())
+    network.build_adjacency()
+    if output_flow_table_path:
+        printer.msg("Saving flow table..")
+        _write_flow_table(network, output_flow_table_path,
+                          [stream_id_column, from_node_column, to_node_column, braided_column])
+
+    braided_segments = np.nonzero(network.braided & (network.from_node >= 0) & (network.to_node >= 0))[0].tolist()
+    if len(braided_segments):
+        if elevation_dataset:
+            printer.msg("Checking braided flow direction..")
+            dem = raster_utils.getRasterAsGdal(elevation_dataset)
+            dem_transform = osr.CoordinateTransformation(streams_srs, raster_utils.getRasterSpatialReference(dem))
+            try:
+                _check_braided_directions(network, braided_segments, dem, dem_transform)
+            finally:
+                dem = None
+        printer.msg("Completing braided networks..")
+        braided_segment_ids = _find_braided_networks(network, braided_segments)
+        network.braided[np.isin(network.segment_ids, braided_segment_ids)] = True
+
+    printer.msg("Assigning stream order..")
+    orders, unordered_count = _assign_orders(network, _get_node_network(network), order_types, engine)
+    if unordered_count:
+        printer.warn("  {0} segments could not be ordered, check for loops in flow direction".format(unordered_count))
+    if output_order_table_path:
+        printer.msg("Saving stream order table..")
+        _write_order_table(network, orders, order_types, output_order_table_path)
+
+    printer.msg("Updating streams..")
+    written_count, created = _write_segment_columns(stream_dataset, network, [
+        (from_node_column, [nid if nid >= 0 else None for nid in network.node_ids_of(network.from_node).tolist()]),
+        (to_node_column, [nid if nid >= 0 else None for nid in network.node_ids_of(network.to_node).tolist()]),
+        (braided_column, network.braided.astype(np.int64).tolist())
+    ] + [(order_columns[order_type], orders[order_type].tolist()) for order_type in order_types])
+    for column in created:
+        printer.msg("  created column {0}".format(column))
+    printer.msg("  {0} features updated".format(written_count))
+
+    # print warnings last
+    if len(unconnected_segments):
+        printer.warn(
+            "WARNING: Unconnected segments in stream network. Assign drainage point to unconnected branches or remove them.",
+            indent=0
+        )
+        printer.warn(
+            "  {0}: {1}".format(stream_id_column, ", ".join([str(sid) for sid in network.segment_ids[unconnected_segments]])),
+            indent=0
+        )
+    if braided_count > 0:
+        printer.warn("WARNING: Possible braided stream errors, check outputs and correct as needed.", indent=0)
@@ -0,0 +1,116 @@
+import numpy as np
+
+
+# max segment-by-segment combinations evaluated at once, to bound memory of batched intersection
+BATCH_COMBINATIONS = 1000000
+
+
+def _cross(ax, ay, bx, by):
+    return ax*by - ay*bx
+
+
+def _intersect_segment_arrays(p0, p1, q0, q1):
+    # Intersect paired segment arrays (p0->p1 against q0->q1, each of shape (k, 2)). Returns boolean hit mask, hit
+    # points, and mask of degenerate combinations (collinear overlap or zero-length segments) which can't be resolved
+    # as single points. Orientation of each end point against the other segment is used, so that when a vertex lies
+    # exactly on the other segment the vertex coordinates themselves are returned, not a recomputed point.
+    rx, ry = p1[:, 0] - p0[:, 0], p1[:, 1] - p0[:, 1]
+    sx, sy = q1[:, 0] - q0[:, 0], q1[:, 1] - q0[:, 1]
+    o1 = _cross(sx, sy, p0[:, 0] - q0[:, 0], p0[:, 1] - q0[:, 1])
+    o2 = _cross(sx, sy, p1[:, 0] - q0[:, 0], p1[:, 1] - q0[:, 1])
+    o3 = _cross(rx, ry, q0[:, 0] - p0[:, 0], q0[:, 1] - p0[:, 1])
+    o4 = _cross(rx, ry, q1[:, 0] - p0[:, 0], q1[:, 1] - p0[:, 1])
+
+    # bounding box overlap required for anything on touching/collinear configurations
+    overlap = (
+        (np.minimum(p0[:, 0], p1[:, 0]) <= np.maximum(q0[:, 0], q1[:, 0])) &
+        (np.minimum(q0[:, 0], q1[:, 0]) <= np.maximum(p0[:, 0], p1[:, 0])) &
+        (np.minimum(p0[:, 1], p1[:, 1]) <= np.maximum(q0[:, 1], q1[:, 1])) &
+        (np.minimum(q0[:, 1], q1[:, 1]) <= np.maximum(p0[:, 1], p1[:, 1]))
+    )
+    zero_length = ((rx == 0) & (ry == 0)) | ((sx == 0) & (sy == 0))
+    collinear = (o1 == 0) & (o2 == 0)
+    degenerate = overlap & (zero_length | collinear)
+
+    hit = (
+        overlap & ~degenerate &
+        (np.sign(o1) * np.sign(o2) <= 0) &
+        (np.sign(o3) * np.sign(o4) <= 0)
+    )
+
+    # parameter along p of crossing point, p0 + t*r = q0 + u*s gives t = cross(q0 - p0, s) / cross(r, s)
+    points = np.zeros((len(p0), 2))
+    denom = _cross(rx, ry, sx, sy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = _cross(q0[:, 0] - p0[:, 0], q0[:, 1] - p0[:, 1], sx, sy) / denom
+        points[:, 0] = p0[:, 0] + t*rx
+        points[:, 1] = p0[:, 1] + t*ry
+    # exact vertices where touching (in reverse priority order so own vertices take precedence)
+    for mask, vertex in ((o4 == 0, q1), (o3 == 0, q0), (o2 == 0, p1), (o1 == 0, p0)):
+        points[mask] = vertex[mask]
+
+    return hit, points, degenerate
+
+
+def _unique_points(points, ia, ib):
+    # same point is found on both segments sharing a vertex, keep first occurrence along this line
+    if not len(points):
+        return points, ia, ib
+    order = np.lexsort((ib, ia))
+    points, ia, ib = points[order], ia[order], ib[order]
+    _, first = np.unique(points, axis=0, return_index=True)
+    first.sort()
+    return points[first], ia[first], ib[first]
+
+
+def _intersect_polyline_pairs(coords, offsets, pairs):
+    # Batched intersection of many candidate polyline pairs. Lines are given as one concatenated (v, 2) vertex array
+    # with offsets (line i spans coords[offsets[i]:offsets[i+1]]), and pairs as (k, 2) line index array. Yields tuples
+    # of (i, j, points, this_vertices, that_vertices), with the unique intersection points of each pair and the index
+    # (within each line) of the starting vertex of the segment of each line where each point occurs. Points and
+    # vertices are None for pairs with degenerate (collinear) intersections, which should be resolved by other means.
+    # Pairs without intersections are not yielded.
+    coords = np.asarray(coords, dtype=float)
+    offsets = np.asarray(offsets)
+    pairs = np.asarray(pairs).reshape(-1, 2)
+    seg_counts = np.maximum(offsets[1:] - offsets[:-1] - 1, 0)
+    na = seg_counts[pairs[:, 0]]
+    nb = seg_counts[pairs[:, 1]]
+    combos = na * nb
+
+    start = 0
+    while start < len(pairs):
+        # grow batch up to combination limit (always at least one pair)
+        end = start + 1
+        total = combos[start]
+        while end < len(pairs) and total + combos[end] <= BATCH_COMBINATIONS:
+            total += combos[end]
+            end += 1
+        batch = np.arange(start, end)
+        start = end
+        if not total:
+            continue
+
+        batch_combos = combos[batch]
+        pair_of = np.repeat(batch, batch_combos)
+        local = np.arange(total) - np.repeat(np.cumsum(batch_combos) - batch_combos, batch_combos)
+        seg_a = local // nb[pair_of]
+        seg_b = local % nb[pair_of]
+        va = offsets[pairs[pair_of, 0]] + seg_a
+        vb = offsets[pairs[pair_of, 1]] + seg_b
+        hit, points, degenerate = _intersect_segment_arrays(coords[va], coords[va+1], coords[vb], coords[vb+1])
+
+        degenerate_pairs = np.unique(pair_of[degenerate])
+        hit_idx = np.nonzero(hit & ~np.isin(pair_of, degenerate_pairs))[0]
+        results = [(k, (None, None, None)) for k in degenerate_pairs]
+        if len(hit_idx):
+            # combinations are ordered by pair, so hits can be grouped on pair boundaries
+            hit_pair = pair_of[hit_idx]
+            group_starts = np.concatenate(([0], np.flatnonzero(np.diff(hit_pair)) + 1))
+            group_ends = np.append(group_starts[1:], len(hit_idx))
+            for g0, g1 in zip(group_starts, group_ends):
+                idx = hit_idx[g0:g1]
+                results.append((hit_pair[g0], _unique_points(points[idx], seg_a[idx], seg_b[idx])))
+        results.sort(key=lambda r: r[0])
+        for k, (pair_points, this_vertices, that_vertices) in results:
+            yield int(pairs[k, 0]), int(pairs[k, 1]), pair_points, this_vertices, that_vertices
@@ -1,14 +1,100 @@
 import csv
+import os
+import struct
+import numpy as np
+import ogr
 import common.feature_utils as feature_utils
+from bin.network.Network import Network
 from bin.network.Node import Node
 from bin.network.Segment import Segment
+from bin.tables import _read_table, _table_format
+
+
+# cache files written next to datasets, holding parsed network arrays
+NETWORK_CACHE_SUFFIX = ".network.npz"
+NODES_CACHE_SUFFIX = ".nodes.npz"
+# features per batch read through Arrow stream
+ARROW_BATCH_SIZE = 65536
+# features written per transaction, where driver supports transactions
+WRITE_BATCH_SIZE = 10000
+# OGR drivers of feature datasets by extension, any other path is read as a table
+FEATURE_DATASET_DRIVERS = {".shp": "ESRI Shapefile", ".gpkg": "GPKG", ".fgb": "FlatGeobuf"}
+# name of node layer, so nodes and streams can be layers of one GeoPackage
+NODE_LAYER_NAME = "nodes"
+
+
+def _is_feature_dataset(path):
+    return os.path.splitext(path)[1].lower() in FEATURE_DATASET_DRIVERS
+
+
+def _stream_layer(dataset):
+    # first layer that isn't the node layer (unless it is the only one)
+    for i in range(dataset.GetLayerCount()):
+        layer = dataset.GetLayer(i)
+        if layer.GetName() != NODE_LAYER_NAME:
+            return layer
+    return dataset.GetLayer()
+
+
+def _node_layer(dataset):
+    return dataset.GetLayerByName(NODE_LAYER_NAME) or dataset.GetLayer()
+
+
+def _check_updatable(path):
+    # FlatGeobuf files are written once, with their spatial index, and can't be updated in place
+    if FEATURE_DATASET_DRIVERS.get(os.path.splitext(path)[1].lower()) == "FlatGeobuf":
+        raise Exception("FlatGeobuf datasets can't be updated in place, use a GeoPackage or shapefile ({0})".format(path))
+
+
+def _create_feature_dataset(path, layer_name, srs, geom_type, fields):
+    # Create dataset with one layer, driver chosen by extension. GeoPackage and FlatGeobuf layers are spatially indexed
+    # (R-tree and packed Hilbert R-tree) and, for an existing GeoPackage, the layer is added to it (replacing any layer
+    # of the same name) so nodes can be written alongside streams. Shapefiles are created through feature_utils.
+    driver_name = FEATURE_DATASET_DRIVERS.get(os.path.splitext(path)[1].lower())
+    if driver_name in (None, "ESRI Shapefile"):
+        return feature_utils.createFeatureDataset(path, layer_name, srs, geom_type, fields=fields, overwrite=True)
+    driver = ogr.GetDriverByName(driver_name)
+    if driver_name == "GPKG" and os.path.exists(path):
+        dataset = driver.Open(path, 1)
+        for i in range(dataset.GetLayerCount()):
+            if dataset.GetLayer(i).GetName() == layer_name:
+                dataset.DeleteLayer(i)
+                break
+    else:
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        dataset = driver.CreateDataSource(path)
+    layer = dataset.CreateLayer(layer_name, srs, geom_type, ["SPATIAL_INDEX=YES"])
+    for field in fields:
+        layer.CreateField(feature_utils.createFieldDefinition(field['name'], field['type']))
+    layer = None
+    return dataset
+
+
+def _copy_feature_dataset_as_empty(dataset, path, geom_type):
+    # Empty copy of the stream layer (fields and spatial reference), driver chosen by extension. GeoPackage and
+    # FlatGeobuf copies are created here, spatially indexed, others through feature_utils.
+    driver_name = FEATURE_DATASET_DRIVERS.get(os.path.splitext(path)[1].lower())
+    if driver_name in (None, "ESRI Shapefile"):
+        return feature_utils.copyFeatureDatasetAsEmpty(dataset, output_path=path, overwrite=True, new_geom_type=geom_type)
+    layer = _stream_layer(dataset)
+    defn = layer.GetLayerDefn()
+    driver = ogr.GetDriverByName(driver_name)
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    copy_dataset = driver.CreateDataSource(path)
+    copy_layer = copy_dataset.CreateLayer(layer.GetName(), layer.GetSpatialRef(), geom_type, ["SPATIAL_INDEX=YES"])
+    for i in range(defn.GetFieldCount()):
+        copy_layer.CreateField(defn.GetFieldDefn(i))
+    copy_layer = None
+    return copy_dataset
 
 
 def _check_srs_units(dataset=None, layer=None, srs=None):
     if not srs:
         if not layer:
             dataset = feature_utils.getFeatureDataset(dataset)
-        layer = dataset.GetLayer()
+        layer = _stream_layer(dataset)
         srs = layer.GetSpatialRef()
     units = srs.GetLinearUnitsName().lower()
     if units not in ["foot", "feet", "meter", "meters", "metre", "metres"]:
@@ -18,7 +104,7 @@ def _check_srs_units(dataset=None, layer=None, srs=None):
 def _get_segments(stream_dataset, stream_id_column, nodes=None, from_node_column=None, to_node_column=None,
                   braided_column=None):
     stream_ds = feature_utils.getFeatureDataset(stream_dataset)
-    stream_layer = stream_ds.GetLayer()
+    stream_layer = _stream_layer(stream_ds)
     stream_defn = stream_layer.GetLayerDefn()
 
     f_index = stream_defn.GetFieldIndex(stream_id_column)
@@ -41,7 +127,23 @@ def _get_segments(stream_dataset, stream_id_column, nodes=None, from_node_column
             return Exception("Could not find column ({0})".format(braided_column))
         braided_column = stream_defn.GetFieldDefn(f_index)
 
+    # index nodes by id, and segment slots in each node by (node id, stream id), so wiring is a lookup per segment
+    node_map = None
+    slot_map = None
+    if nodes:
+        node_map = {}
+        slot_map = {}
+        for node in nodes:
+            node_map[node.id] = node
+            for s in range(len(node.segments)):
+                key = (node.id, node.segments[s])
+                if key in slot_map:
+                    slot_map[key].append(s)
+                else:
+                    slot_map[key] = [s]
+
     segments = []
+    missing = []
     stream_feat = stream_layer.GetNextFeature()
     while stream_feat:
         sid = feature_utils.getFieldValue(stream_feat, stream_id_field)
@@ -57,33 +159,29 @@ def _get_segments(stream_dataset, stream_id_column, nodes=None, from_node_column
                     segment.from_node = from_node_id
                     segment.to_node = to_node_id
                 else:
-                    from_node = None
-                    to_node = None
-                    if from_node_id > 0 or to_node_id > 0:
-                        for node in nodes:
-                            if not from_node and node.id == from_node_id:
-                                from_node = node
-                            if not to_node and node.id == to_node_id:
-                                to_node = node
-                            if (from_node or from_node_id <= 0) and (to_node or to_node_id <= 0):
-                                break
+                    from_node = node_map.get(from_node_id) if from_node_id > 0 else None
+                    to_node = node_map.get(to_node_id) if to_node_id > 0 else None
                     if (from_node_id > 0 and not from_node) or (to_node_id > 0 and not to_node):
-                        raise Exception("Could not find nodes ({1}, {2}) for segment={0}".format(sid, from_node_id, to_node_id))
+                        missing.append((sid, from_node_id, to_node_id))
                     if from_node:
-                        for s in range(len(from_node.segments)):
-                            if from_node.segments[s] == sid:
-                                from_node.segments[s] = segment
-                                break
+                        slots = slot_map.get((from_node.id, sid))
+                        if slots:
+                            from_node.segments[slots.pop(0)] = segment
                         segment.from_node = from_node
                     if to_node:
-                        for s in range(len(to_node.segments)):
-                            if to_node.segments[s] == sid:
-                                to_node.segments[s] = segment
-                                break
+                        slots = slot_map.get((to_node.id, sid))
+                        if slots:
+                            to_node.segments[slots.pop(0)] = segment
                         segment.to_node = to_node
 
             segments.append(segment)
-            stream_feat = stream_layer.GetNextFeature()
+        stream_feat = stream_layer.GetNextFeature()
+
+    if len(missing):
+        raise Exception("Could not find nodes for {0} segment(s): {1}".format(
+            len(missing),
+            ", ".join(["segment={0} ({1}, {2})".format(*m) for m in missing])
+        ))
 
     stream_defn = None
     stream_layer = None
@@ -92,18 +190,424 @@ def _get_segments(stream_dataset, stream_id_column, nodes=None, from_node_column
     return segments
 
 
-def _parse_nodes(node_dataset_or_table, drainage_node_ids=None, require_drainage=False, get_coords=False):
-    nodes = []
-    drainage_nodes = []
+def _dataset_fingerprint(path, layer=None):
+    # Fingerprint of dataset files on disk (size and modification time, plus feature count and schema if layer given),
+    # used to validate cache files. None if dataset isn't given as path to file(s), in which case caching is skipped.
+    if not isinstance(path, basestring) or not os.path.isfile(path):
+        return None
+    base, ext = os.path.splitext(path)
+    files = [base + sidecar for sidecar in (".shp", ".shx", ".dbf")] if ext.lower() == ".shp" else [path]
+    stats = []
+    for filepath in files:
+        if os.path.exists(filepath):
+            stat = os.stat(filepath)
+            stats.append((os.path.basename(filepath), stat.st_size, stat.st_mtime))
+    fingerprint = [stats]
+    if layer:
+        defn = layer.GetLayerDefn()
+        fingerprint.append(layer.GetFeatureCount())
+        fingerprint.append([
+            (defn.GetFieldDefn(i).GetName(), defn.GetFieldDefn(i).GetType()) for i in range(defn.GetFieldCount())
+        ])
+    return repr(fingerprint)
+
+
+def _load_cache(path, fingerprint):
+    # dictionary of cached arrays, or None if no cache file or fingerprint doesn't match
+    if not fingerprint or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['fingerprint']) != fingerprint:
+                return None
+            return dict((name, data[name]) for name in data.files if name != 'fingerprint')
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def _missing_columns(stream_dataset, columns):
+    # columns not found in stream layer of dataset
+    stream_ds = feature_utils.getFeatureDataset(stream_dataset)
+    stream_defn = _stream_layer(stream_ds).GetLayerDefn()
+    missing = [column for column in columns if stream_defn.GetFieldIndex(column) < 0]
+    stream_defn = None
+    stream_ds = None
+    return missing
+
+
+def _load_cached_columns(stream_dataset, stream_id_column, columns):
+    # Column values as last cached for stream dataset, whatever state the dataset is in now (e.g. node columns from
+    # before an edit). Returns segment ids and list of column arrays, or None if not cached.
+    if not isinstance(stream_dataset, basestring):
+        return None
+    cache_path = os.path.splitext(stream_dataset)[0] + NETWORK_CACHE_SUFFIX
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            if str(data['stream_id_column']) != stream_id_column:
+                return None
+            return data['segment_ids'], [data["col_" + column] for column in columns]
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def _save_cache(path, fingerprint, arrays):
+    if not fingerprint:
+        return
+    try:
+        with open(path, 'wb') as f:
+            np.savez(f, fingerprint=np.array(fingerprint), **arrays)
+    except (IOError, OSError):
+        # cache is optional (e.g. read-only location)
+        pass
+
+
+def _read_columns(layer, columns, end_points=False):
+    # Bulk read of attribute columns, and optionally the first and last vertex of each line. Reads through the Arrow
+    # stream interface as numpy arrays where GDAL supports it (GDAL >= 3.6), otherwise feature by feature. Returns
+    # array of FIDs, list of masked arrays per column (masked where null), and (n, 2, 2) array of end points (or None),
+    # NaN for features with no or empty geometry. Either way, other fields (and geometries, unless end points are read)
+    # are ignored so only what is needed is read.
+    defn = layer.GetLayerDefn()
+    field_names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    ignored = [name for name in field_names if name not in columns]
+    if not end_points:
+        ignored.append("OGR_GEOMETRY")
+    layer.SetIgnoredFields(ignored)
+    try:
+        if hasattr(layer, 'GetArrowStreamAsNumPy'):
+            return _read_columns_arrow(layer, columns, end_points)
+        return _read_columns_features(layer, columns, end_points)
+    finally:
+        layer.SetIgnoredFields([])
+        layer.ResetReading()
+
+
+def _read_columns_arrow(layer, columns, end_points):
+    fid_column = layer.GetFIDColumn() or "OGC_FID"
+    geometry_column = layer.GetGeometryColumn() or "wkb_geometry"
+
+    fids = []
+    column_values = [[] for column in columns]
+    geometries = []
+    layer.ResetReading()
+    stream = layer.GetArrowStreamAsNumPy(options=[
+        "INCLUDE_FID=YES", "USE_MASKED_ARRAYS=YES", "MAX_FEATURES_IN_BATCH={0}".format(ARROW_BATCH_SIZE)
+    ])
+    for batch in stream:
+        fids.append(np.asarray(batch[fid_column], dtype=np.int64))
+        for i in range(len(columns)):
+            column_values[i].append(np.ma.asarray(batch[columns[i]]))
+        if end_points:
+            geometries.append(batch[geometry_column])
+    stream = None
+
+    fids = np.concatenate(fids) if len(fids) else np.zeros(0, dtype=np.int64)
+    column_values = [
+        np.ma.concatenate(values) if len(values) else np.ma.array(np.zeros(0, dtype=np.int64))
+        for values in column_values
+    ]
+    points = None
+    if end_points:
+        points = np.zeros((len(fids), 2, 2))
+        i = 0
+        for batch_geometries in geometries:
+            for wkb in batch_geometries:
+                points[i] = _wkb_end_points(wkb)
+                i += 1
+    return fids, column_values, points
+
+
+def _read_columns_features(layer, columns, end_points):
+    fids = []
+    column_values = [[] for column in columns]
+    points = []
+    layer.ResetReading()
+    feat = layer.GetNextFeature()
+    while feat:
+        fids.append(feat.GetFID())
+        for i in range(len(columns)):
+            column_values[i].append(feat.GetField(columns[i]))
+        if end_points:
+            points.append(_end_points(feat.GetGeometryRef()))
+        feat = layer.GetNextFeature()
+
+    masked = []
+    for values in column_values:
+        nulls = [value is None for value in values]
+        masked.append(np.ma.array([value if value is not None else 0 for value in values], mask=nulls))
+    return (
+        np.array(fids, dtype=np.int64),
+        masked,
+        np.array(points, dtype=float).reshape(-1, 2, 2) if end_points else None
+    )
+
+
+def _end_points(geometry):
+    # first and last vertex of line, NaN if no or empty geometry
+    line = geometry.GetPoints() if geometry is not None else None
+    if not line:
+        return (np.nan, np.nan), (np.nan, np.nan)
+    return line[0][:2], line[-1][:2]
+
+
+def _wkb_end_points(wkb):
+    # first and last vertex of line from WKB, parsed directly for simple linestrings
+    if wkb is None or wkb is np.ma.masked:
+        return (np.nan, np.nan), (np.nan, np.nan)
+    wkb = bytes(wkb)
+    order = '<' if bytearray(wkb[:1])[0] == 1 else '>'
+    geometry_type = struct.unpack(order + 'I', wkb[1:5])[0]
+    flags = geometry_type & 0xE0000000
+    base_type = (geometry_type & 0x0FFFFFFF) % 1000
+    if base_type == 2 and not (flags & 0x20000000):
+        # dimensions from ISO type (1000s for Z/M) or EWKB flags
+        dimensions = 2 + (1 if geometry_type & 0x80000000 else 0) + (1 if geometry_type & 0x40000000 else 0)
+        dimensions += {0: 0, 1: 1, 2: 1, 3: 2}[((geometry_type & 0x0FFFFFFF) // 1000)]
+        count = struct.unpack(order + 'I', wkb[5:9])[0]
+        if count:
+            size = 8*dimensions
+            first = struct.unpack(order + 'dd', wkb[9:9+16])
+            last = struct.unpack(order + 'dd', wkb[9+size*(count-1):9+size*(count-1)+16])
+            return first, last
+    return _end_points(ogr.CreateGeometryFromWkb(wkb))
+
+
+def _read_network(stream_dataset, stream_id_column, from_node_column=None, to_node_column=None, braided_column=None,
+                  attribute_columns=None):
+    stream_ds = feature_utils.getFeatureDataset(stream_dataset)
+    stream_layer = _stream_layer(stream_ds)
+    stream_defn = stream_layer.GetLayerDefn()
+
+    columns = [column for column in (from_node_column, to_node_column, braided_column) if column]
+    columns += [column for column in (attribute_columns or []) if column not in columns]
+    fields = []
+    for column in [stream_id_column] + columns:
+        f_index = stream_defn.GetFieldIndex(column)
+        if f_index < 0:
+            raise Exception("Could not find column ({0})".format(column))
+        fields.append(stream_defn.GetFieldDefn(f_index))
+
+    # column values by segment, from cache if valid for this dataset and these columns, otherwise read from dataset
+    cache_path = os.path.splitext(stream_dataset)[0] + NETWORK_CACHE_SUFFIX if isinstance(stream_dataset, basestring) else None
+    fingerprint = _dataset_fingerprint(stream_dataset, stream_layer)
+    cached = _load_cache(cache_path, fingerprint)
+    if cached is not None and str(cached.get('stream_id_column')) != stream_id_column:
+        cached = None
+    if cached is not None and all(("col_" + column) in cached for column in columns):
+        values = cached
+    else:
+        fids, column_values, end_points = _read_columns(stream_layer, [stream_id_column] + columns)
+        # skip features with null stream id
+        has_id = ~np.ma.getmaskarray(column_values[0])
+        segment_ids = column_values[0][has_id].astype(np.int64)
+        fids = fids[has_id]
+        column_values = [values[has_id].filled(-1) for values in column_values[1:]]
+        # keep other columns already cached for this state of dataset
+        values = cached if cached is not None else {}
+        values['stream_id_column'] = np.array(stream_id_column)
+        values['segment_ids'] = np.asarray(segment_ids)
+        values['fids'] = fids
+        for i in range(len(columns)):
+            values["col_" + columns[i]] = np.asarray(column_values[i])
+        if cache_path:
+            _save_cache(cache_path, fingerprint, values)
+
+    stream_defn = None
+    stream_layer = None
+    stream_ds = None
+
+    if from_node_column and to_node_column:
+        # node ids <= 0 (including missing) are treated as unconnected
+        network = Network.from_node_ids(
+            values['segment_ids'],
+            values["col_" + from_node_column],
+            values["col_" + to_node_column],
+            values["col_" + braided_column] > 0 if braided_column else None
+        )
+    else:
+        network = Network(values['segment_ids'])
+        if braided_column:
+            network.braided = values["col_" + braided_column] > 0
+    network.fids = values['fids']
+    network.fingerprint = fingerprint
+    for column in (attribute_columns or []):
+        network.attributes[column] = values["col_" + column]
+    return network
+
+
+def _update_network_cache(stream_dataset, stream_id_column, network, column_values):
+    # After writing columns back to stream dataset, refresh the network cache to the new state of the dataset, so the
+    # next stage doesn't have to re-read it. Columns cached for the state read into the network are carried over.
+    if not network.fingerprint:
+        return
+    cache_path = os.path.splitext(stream_dataset)[0] + NETWORK_CACHE_SUFFIX
+    values = _load_cache(cache_path, network.fingerprint)
+    if values is None or str(values['stream_id_column']) != stream_id_column:
+        values = {}
+    values['stream_id_column'] = np.array(stream_id_column)
+    values['segment_ids'] = network.segment_ids
+    values['fids'] = network.fids
+    for column in column_values:
+        values["col_" + column] = np.asarray(column_values[column])
+
+    stream_ds = feature_utils.getFeatureDataset(stream_dataset)
+    stream_layer = _stream_layer(stream_ds)
+    network.fingerprint = _dataset_fingerprint(stream_dataset, stream_layer)
+    stream_layer = None
+    stream_ds = None
+    _save_cache(cache_path, network.fingerprint, values)
+
+
+def _write_segment_columns(stream_dataset, network, column_values, previous_values=None):
+    # Write per-segment integer column values (list of column name and list of values by segment, None to leave as is)
+    # back to stream dataset by feature FID. Missing columns are all created before any features are written. Only
+    # features whose values changed are fetched and written, in FID order, batched in transactions where the driver
+    # supports them. Batches are committed as they go, so on failure only the open batch is rolled back and features of earlier
+    # batches stay written. Current values are bulk read, unless previous values of all columns are given (e.g. as read
+    # into network), in which case fetched features are checked against them. Returns number of features written and
+    # list of created columns.
+    columns = [column for column, values in column_values]
+    column_values = [list(values) for column, values in column_values]
+
+    _check_updatable(stream_dataset)
+    streams_ds = feature_utils.getFeatureDataset(stream_dataset, write=True)
+    streams_layer = _stream_layer(streams_ds)
+    streams_defn = streams_layer.GetLayerDefn()
 
-    if not node_dataset_or_table.endswith(".shp"):
-        # if not shapefile, read as csv table
+    created = [column for column in columns if streams_defn.GetFieldIndex(column) < 0]
+    for column in created:
+        streams_layer.CreateField(feature_utils.createFieldDefinition(column, int))
+
+    fids = network.fids.tolist()
+    bulk_read = previous_values is None or not all(column in previous_values or column in created for column in columns)
+    if bulk_read:
+        # bulk read current values
+        existing = [column for column in columns if column not in created]
+        read_fids, read_values, _ = _read_columns(streams_layer, existing)
+        rows = dict(zip(read_fids.tolist(), range(len(read_fids))))
+        rows = [rows.get(fid) for fid in fids]
+        previous_values = {}
+        for column, values in zip(existing, read_values):
+            values = values.tolist()
+            previous_values[column] = [values[r] if r is not None else None for r in rows]
+    # new columns have no previous values
+    previous = [[None]*len(fids) if column in created else list(previous_values[column]) for column in columns]
+    changed = [
+        s for s in range(len(fids))
+        if any(values[s] is not None and values[s] != prev[s] for values, prev in zip(column_values, previous))
+    ]
+    changed.sort(key=lambda s: fids[s])
+    features = (streams_layer.GetFeature(fids[s]) for s in changed)
+
+    segment_by_fid = dict(zip(fids, range(len(fids))))
+    transactions = streams_layer.TestCapability(ogr.OLCTransactions)
+    written = 0
+    started = False
+    try:
+        for stream_feat in features:
+            s = segment_by_fid.get(stream_feat.GetFID())
+            if s is None:
+                continue
+            dirty = False
+            for column, values, prev in zip(columns, column_values, previous):
+                # values just bulk read are current, so only given previous values are checked against the feature
+                current = prev[s] if bulk_read else stream_feat.GetField(column)
+                if values[s] is not None and current != values[s]:
+                    stream_feat.SetField(column, values[s])
+                    dirty = True
+            if not dirty:
+                continue
+            if transactions and written % WRITE_BATCH_SIZE == 0:
+                if started:
+                    streams_layer.CommitTransaction()
+                    started = False
+                streams_layer.StartTransaction()
+                started = True
+            streams_layer.SetFeature(stream_feat)
+            written += 1
+        if started:
+            streams_layer.CommitTransaction()
+            started = False
+    except Exception:
+        if started:
+            streams_layer.RollbackTransaction()
+        raise
+    finally:
+        stream_feat = None
+        streams_defn = None
+        streams_layer = None
+        streams_ds = None
+
+    return written, created
+
+
+def _parse_nodes(node_dataset_or_table, drainage_node_ids=None, require_drainage=False, get_coords=False):
+    is_table = not _is_feature_dataset(node_dataset_or_table)
+    if is_table:
+        # if not feature dataset, read as table
         # but first require drainage node IDs
         if require_drainage and (not drainage_node_ids or not len(drainage_node_ids)):
             raise Exception("If node network table provided, drainage node ids must be manually supplied")
         # also can't get coords from table output
         if get_coords:
             raise Exception("Coordinates cannot be pulled from node network table")
+
+    cache_path = os.path.splitext(node_dataset_or_table)[0] + NODES_CACHE_SUFFIX
+    fingerprint = _dataset_fingerprint(node_dataset_or_table)
+    values = _load_cache(cache_path, fingerprint)
+    if values is None:
+        values = _read_node_arrays(node_dataset_or_table, is_table)
+        _save_cache(cache_path, fingerprint, values)
+
+    nodes = []
+    drainage_nodes = []
+    node_ids = values['node_ids'].tolist()
+    offsets = values['offsets'].tolist()
+    stream_ids = values['stream_ids'].tolist()
+    drainage = values['drainage'].tolist()
+    coords = values['coords'].tolist() if get_coords else None
+    for i in range(len(node_ids)):
+        node = Node(node_ids[i])
+        node.segments = stream_ids[offsets[i]:offsets[i+1]]
+        if get_coords:
+            node.coords = tuple(coords[i])
+        nodes.append(node)
+        if drainage[i]:
+            drainage_nodes.append(node)
+
+    # manually supplied drainage node ids overwrites found
+    if require_drainage and drainage_node_ids and len(drainage_node_ids):
+        drainage_nodes = []
+        for node in nodes:
+            if node.id in drainage_node_ids:
+                drainage_nodes.append(node)
+        if len(drainage_nodes) != len(drainage_node_ids):
+            raise Exception("Could not match all drainage node IDs given")
+
+    return nodes, drainage_nodes
+
+
+def _read_node_arrays(node_dataset_or_table, is_table):
+    # Node network as arrays: node ids, stream ids of each node (node i has stream_ids[offsets[i]:offsets[i+1]]),
+    # drainage flags and coordinates (node dataset only).
+    node_ids = []
+    counts = []
+    stream_ids = []
+    drainage = []
+    coords = []
+
+    if is_table and _table_format(node_dataset_or_table) != "csv":
+        # stream ids as list column, read as flattened values and lengths
+        table = _read_table(node_dataset_or_table)
+        node_ids = table.column("NODE").to_numpy().tolist()
+        for chunk in table.column("STREAM_IDS").chunks:
+            counts += np.diff(chunk.offsets.to_numpy()).tolist()
+            stream_ids += chunk.flatten().to_numpy().tolist()
+        drainage = [0]*len(node_ids)
+
+    elif is_table:
         with open(node_dataset_or_table, 'rb') as csvfile:
             reader = csv.reader(csvfile)
             first = True
@@ -111,13 +615,15 @@ def _parse_nodes(node_dataset_or_table, drainage_node_ids=None, require_drainage
                 if first:
                     first = False
                 elif row[0]:
-                    node = Node(int(row[0]))
-                    node.segments = [int(sid) for sid in row[1].split(",")]
-                    nodes.append(node)
+                    sids = [int(sid) for sid in row[1].split(",")]
+                    node_ids.append(int(row[0]))
+                    counts.append(len(sids))
+                    stream_ids += sids
+                    drainage.append(0)
 
     else:
         node_ds = feature_utils.getFeatureDataset(node_dataset_or_table)
-        node_layer = node_ds.GetLayer()
+        node_layer = _node_layer(node_ds)
 
         fields = [
             {'name': "NODE",       'type': int},
@@ -128,32 +634,25 @@ def _parse_nodes(node_dataset_or_table, drainage_node_ids=None, require_drainage
 
         node_feat = node_layer.GetNextFeature()
         while node_feat:
-            node = Node(feature_utils.getFieldValue(node_feat, fields[0]))
-
-            streamids = feature_utils.getFieldValue(node_feat, fields[1]).split(",")
-            node.segments = [int(sid) for sid in streamids]
-            nodes.append(node)
-
-            if get_coords:
-                geom = node_feat.GetGeometryRef()
-                node.coords = geom.GetPoint()
-
-            if feature_utils.getFieldValue(node_feat, fields[3]) > 0:
-                drainage_nodes.append(node)
-
+            sids = [int(sid) for sid in feature_utils.getFieldValue(node_feat, fields[1]).split(",")]
+            node_ids.append(feature_utils.getFieldValue(node_feat, fields[0]))
+            counts.append(len(sids))
+            stream_ids += sids
+            drainage.append(1 if feature_utils.getFieldValue(node_feat, fields[3]) > 0 else 0)
+            point = node_feat.GetGeometryRef().GetPoint()
+            coords.append((point[0], point[1], point[2] if len(point) > 2 else 0))
             node_feat = node_layer.GetNextFeature()
 
         node_feat = None
         node_layer = None
         node_ds = None
 
-    # manually supplied drainage node ids overwrites found
-    if require_drainage and drainage_node_ids and len(drainage_node_ids):
-        drainage_nodes = []
-        for node in nodes:
-            if node.id in drainage_node_ids:
-                drainage_nodes.append(node)
-        if len(drainage_nodes) != len(drainage_node_ids):
-            raise Exception("Could not match all drainage node IDs given")
-
-    return nodes, drainage_nodes
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return {
+        'node_ids': np.array(node_ids, dtype=np.int64),
+        'offsets': offsets,
+        'stream_ids': np.array(stream_ids, dtype=np.int64),
+        'drainage': np.array(drainage, dtype=np.int8),
+        'coords': np.array(coords, dtype=float).reshape(-1, 3)
+    }
@@ -0,0 +1,131 @@
+import csv
+import os
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# output table extensions written as columnar tables (requires pyarrow), any other as CSV
+PARQUET_EXTENSIONS = (".parquet",)
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc")
+# column types, as arrow types of columnar tables
+COLUMN_TYPES = ("int64", "float64", "int64 list")
+
+
+class TableWriter:
+    # Writes table rows as CSV, or as Parquet or Arrow IPC file (by path extension), buffering rows into record batches.
+    # Columns are given as (name, type) pairs, type being one of COLUMN_TYPES. List values (e.g. stream ids of a node)
+    # are written as list columns, or comma-joined in CSV. None values are written as nulls (empty in CSV).
+
+    path = None
+    names = None
+    table_format = None
+    _schema = None
+
+    def __init__(self, path, fields, buffer_rows=65536):
+        self.path = path
+        self.names = [name for name, column_type in fields]
+        self.table_format = _table_format(path)
+        self._buffer = []
+        self._buffer_rows = buffer_rows
+        self._file = None
+        self._writer = None
+        for name, column_type in fields:
+            if column_type not in COLUMN_TYPES:
+                raise Exception("Unknown table column type ({0})".format(column_type))
+        if self.table_format == "csv":
+            self._file = open(path, 'wb')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.names)
+            return
+        if pyarrow is None:
+            raise Exception("Writing {0} tables ({1}) requires pyarrow".format(self.table_format, path))
+        self._schema = pyarrow.schema([(name, _arrow_type(column_type)) for name, column_type in fields])
+        if self.table_format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        else:
+            self._writer = pyarrow.ipc.new_file(path, self._schema)
+
+    def write(self, row):
+        if self.table_format == "csv":
+            self._writer.writerow([_csv_value(value) for value in row])
+            return
+        self._buffer.append(row)
+        if len(self._buffer) >= self._buffer_rows:
+            self.flush()
+
+    def write_columns(self, columns):
+        # write many rows at once, given as list of values per column
+        if self.table_format == "csv":
+            for row in zip(*columns):
+                self.write(row)
+            return
+        self.flush()
+        self._write_batch(columns)
+
+    def flush(self):
+        if len(self._buffer):
+            self._write_batch([list(values) for values in zip(*self._buffer)])
+            self._buffer = []
+
+    def _write_batch(self, columns):
+        self._writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, self._schema)],
+            schema=self._schema
+        ))
+
+    def close(self):
+        if self.table_format == "csv":
+            if self._file:
+                self._file.close()
+                self._file = None
+            return
+        self.flush()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+def _arrow_type(column_type):
+    if column_type == "int64 list":
+        return pyarrow.list_(pyarrow.int64())
+    return pyarrow.int64() if column_type == "int64" else pyarrow.float64()
+
+
+def _table_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return "parquet"
+    if extension in ARROW_EXTENSIONS:
+        return "arrow"
+    return "csv"
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ",".join([str(v) for v in value])
+    return value
+
+
+def _write_table(path, columns):
+    # Write table from list of (column name, type, values), format by path extension as for TableWriter.
+    writer = TableWriter(path, [(name, column_type) for name, column_type, values in columns])
+    try:
+        writer.write_columns([values for name, column_type, values in columns])
+    finally:
+        writer.close()
+
+
+def _read_table(path):
+    # columnar (Parquet or Arrow IPC) table as pyarrow table
+    if pyarrow is None:
+        raise Exception("Reading {0} tables ({1}) requires pyarrow".format(_table_format(path), path))
+    if _table_format(path) == "parquet":
+        return pyarrow.parquet.read_table(path)
+    with pyarrow.ipc.open_file(path) as reader:
+        return reader.read_all()
@@ -1,10 +1,12 @@
 import os
 import shutil
+import ogr
 import streamorder
 from bin.PassPrint import PassPrint
+from bin.shared import FEATURE_DATASET_DRIVERS
 
 
-# streams shapefile, will be copied
+# streams dataset (shapefile, GeoPackage or FlatGeobuf), will be copied
 streams_shp = r"C:\Users\LawrenceS\Documents\ProjectsPython\stream-order\test\NHDFlowline_CAalbers_clean_modified.shp"
 # output directory
 out_dir = r"C:\Users\LawrenceS\Documents\ProjectsPython\stream-order\test\test_prepare"
@@ -14,7 +16,9 @@ from_node_col           = "FROM_NODE"
 to_node_col             = "TO_NODE"
 braided_col             = "BRAIDED"
 stream_order_col        = "STRAHLER"
-# outputs -- aside from Node shapefile, optional and can be Null
+# outputs -- aside from Node shapefile, optional and can be Null (tables ending .parquet or .arrow are written as
+# columnar tables, which requires pyarrow, otherwise as CSV). Node dataset can also be a GeoPackage or FlatGeobuf, and
+# with a GeoPackage streams dataset can be the working copy itself ("streams.gpkg") to keep nodes as a layer of it.
 out_node_shp            = "nodes.shp"
 out_network_table       = "network.csv"
 out_network_rev_table   = "network_rev.csv"
@@ -34,6 +38,42 @@ do = {
 }
 
 
+def dataset_files(path):
+    # files making up a dataset, a shapefile being all files sharing its base name (e.g. .shp, .shx, .dbf, .prj)
+    base, ext = os.path.splitext(path)
+    if ext.lower() != ".shp":
+        return [path] if os.path.exists(path) else []
+    directory = os.path.dirname(path)
+    basename = os.path.basename(base).lower()
+    return [
+        os.path.join(directory, filename) for filename in os.listdir(directory)
+        if os.path.splitext(filename)[0].lower() == basename
+    ]
+
+
+def copy_dataset(path, copy_path):
+    copy_base = os.path.splitext(copy_path)[0]
+    for filepath in dataset_files(path):
+        filecopy_path = copy_base + os.path.splitext(filepath)[1]
+        if os.path.exists(filecopy_path):
+            os.remove(filecopy_path)
+        shutil.copyfile(filepath, filecopy_path)
+
+
+def convert_dataset(path, copy_path):
+    # copy into the format of the copy path extension (e.g. FlatGeobuf into a GeoPackage)
+    remove_dataset(copy_path)
+    driver = ogr.GetDriverByName(FEATURE_DATASET_DRIVERS[os.path.splitext(copy_path)[1].lower()])
+    dataset = ogr.Open(path)
+    driver.CopyDataSource(dataset, copy_path)
+    dataset = None
+
+
+def remove_dataset(path):
+    for filepath in dataset_files(path):
+        os.remove(filepath)
+
+
 if __name__ == '__main__':
 
     printer = PassPrint()
@@ -51,55 +91,37 @@ if __name__ == '__main__':
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    # copy shapefile
-    working_streams_shp = os.path.join(out_dir, "streams.shp")
-    if not os.path.exists(working_streams_shp):
-        printer.msg("Copying streams shapefile..")
-        streams_shp_dir = os.path.dirname(streams_shp)
-        streams_shp_name = os.path.basename(streams_shp)
-        streams_shp_basename = os.path.splitext(streams_shp_name)[0].lower()
-        for filename in os.listdir(streams_shp_dir):
-            namesplit = os.path.splitext(filename)
-            if namesplit[0].lower() == streams_shp_basename:
-                copy_path = os.path.join(out_dir, "streams"+namesplit[1])
-                if os.path.exists(copy_path):
-                    os.remove(copy_path)
-                shutil.copyfile(
-                    os.path.join(streams_shp_dir, filename),
-                    copy_path
-                )
+    # copy streams dataset, FlatGeobuf can't be updated in place so working copy is a GeoPackage
+    streams_ext = os.path.splitext(streams_shp)[1]
+    working_ext = ".gpkg" if streams_ext.lower() == ".fgb" else streams_ext
+    working_streams_shp = os.path.join(out_dir, "streams"+working_ext)
+    raw_streams_shp = os.path.join(out_dir, "streams_raw"+streams_ext)
+    if do['prepare_stream']:
+        # prepared from raw copy into working copy
+        printer.msg("Copying streams dataset..")
+        copy_dataset(streams_shp, raw_streams_shp)
+    elif not os.path.exists(working_streams_shp):
+        printer.msg("Copying streams dataset..")
+        if working_ext == streams_ext:
+            copy_dataset(streams_shp, working_streams_shp)
+        else:
+            convert_dataset(streams_shp, working_streams_shp)
     printer.msg("")
 
     if do['prepare_stream']:
         printer.decrease_indent()
         printer.msg("Preparing Streams Data..")
         printer.increase_indent()
-        # rename working shapefile first
-        streams_shp_dir = os.path.dirname(working_streams_shp)
-        streams_shp_name = os.path.basename(working_streams_shp)
-        for filename in os.listdir(streams_shp_dir):
-            namesplit = os.path.splitext(filename)
-            if namesplit[0].lower() == "streams":
-                copy_path = os.path.join(out_dir, "streams_raw"+namesplit[1])
-                if os.path.exists(copy_path):
-                    os.remove(copy_path)
-                os.rename(
-                    os.path.join(streams_shp_dir, filename),
-                    copy_path
-                )
-        # run process
         try:
             streamorder.prepare_stream(
-                input_stream_dataset=os.path.join(out_dir, "streams_raw.shp"),
+                input_stream_dataset=raw_streams_shp,
                 copy_stream_dataset=working_streams_shp,
                 stream_id_column=stream_id_col
             )
         except Exception:
             # delete on error
-            for filename in os.listdir(streams_shp_dir):
-                namesplit = os.path.splitext(filename)
-                if namesplit[0].lower() == "streams" or namesplit[0].lower() == "streams_raw":
-                    os.remove(os.path.join(out_dir, filename))
+            remove_dataset(working_streams_shp)
+            remove_dataset(raw_streams_shp)
             raise
         printer.msg("")
 
@@ -3,35 +3,38 @@ import bin.get_node_network
 import bin.calculate_flow
 import bin.complete_braided_streams
 import bin.calculate_stream_order
+import bin.run_pipeline
 
 
 printer = None
 
 
-def prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column, tolerance=1.0):
+def prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column, tolerance=1.0, persist_index=False,
+                   intersection_engine="geos", tiles=None, processes=None):
     global printer
     module = bin.prepare_stream
     module.printer = printer
-    return module.prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column, tolerance)
+    return module.prepare_stream(input_stream_dataset, copy_stream_dataset, stream_id_column, tolerance,
+                                 persist_index, intersection_engine, tiles, processes)
 
 
 def get_node_network(stream_dataset, stream_id_column, output_node_shp, output_table_path, output_table_rev_path=None,
-                     tolerance=1):
+                     tolerance=1, memory_budget_mb=None):
     global printer
     module = bin.get_node_network
     module.printer = printer
     return module.get_node_network(stream_dataset, stream_id_column, output_node_shp, output_table_path,
-                                   output_table_rev_path, tolerance)
+                                   output_table_rev_path, tolerance, memory_budget_mb)
 
 
 def calculate_flow(stream_dataset, stream_id_column, node_dataset_or_table, drainage_node_ids=None,
                    from_node_column="FROM_NODE", to_node_column="TO_NODE", braided_column="BRAIDED",
-                   output_flow_table_path=None):
+                   output_flow_table_path=None, processes=None):
     global printer
     module = bin.calculate_flow
     module.printer = printer
     return module.calculate_flow(stream_dataset, stream_id_column, node_dataset_or_table, drainage_node_ids,
-                                 from_node_column, to_node_column, braided_column, output_flow_table_path)
+                                 from_node_column, to_node_column, braided_column, output_flow_table_path, processes)
 
 
 def complete_braided_streams(stream_dataset, stream_id_column, node_dataset_or_table, from_node_column="FROM_NODE",
@@ -44,9 +47,24 @@ def complete_braided_streams(stream_dataset, stream_id_column, node_dataset_or_t
 
 
 def calculate_stream_order(stream_dataset, stream_id_column, from_node_column="FROM_NODE", to_node_column="TO_NODE",
-                           braided_column="BRAIDED", stream_order_column="STRAHLER", output_table_path=None):
+                           braided_column="BRAIDED", stream_order_column="STRAHLER", output_table_path=None,
+                           engine="python", order_columns=None, changed_stream_ids=None, processes=None):
     global printer
     module = bin.calculate_stream_order
     module.printer = printer
     return module.calculate_stream_order(stream_dataset, stream_id_column, from_node_column, to_node_column,
-                                         braided_column, stream_order_column, output_table_path)
+                                         braided_column, stream_order_column, output_table_path, engine,
+                                         order_columns, changed_stream_ids, processes)
+
+
+def run_pipeline(stream_dataset, stream_id_column, drainage_node_ids, from_node_column="FROM_NODE",
+                 to_node_column="TO_NODE", braided_column="BRAIDED", stream_order_column="STRAHLER", tolerance=1,
+                 elevation_dataset=None, output_node_shp=None, output_table_path=None, output_table_rev_path=None,
+                 output_flow_table_path=None, output_order_table_path=None, engine="python", order_columns=None):
+    global printer
+    module = bin.run_pipeline
+    module.printer = printer
+    return module.run_pipeline(stream_dataset, stream_id_column, drainage_node_ids, from_node_column, to_node_column,
+                               braided_column, stream_order_column, tolerance, elevation_dataset, output_node_shp,
+                               output_table_path, output_table_rev_path, output_flow_table_path,
+                               output_order_table_path, engine, order_columns)
@@ -0,0 +1,33 @@
+import os
+import sys
+import pytest
+
+# modules import each other both as bin.<module> and as top level modules of bin
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "bin")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def memory_layer():
+    # factory of in-memory line layers with SID field, lines as (stream id or None, points or None for no geometry)
+    ogr = pytest.importorskip("ogr")
+
+    def create(lines):
+        dataset = ogr.GetDriverByName("Memory").CreateDataSource("")
+        layer = dataset.CreateLayer("streams", None, ogr.wkbLineString)
+        layer.CreateField(ogr.FieldDefn("SID", ogr.OFTInteger))
+        defn = layer.GetLayerDefn()
+        for stream_id, points in lines:
+            feat = ogr.Feature(defn)
+            if stream_id is not None:
+                feat.SetField("SID", stream_id)
+            if points is not None:
+                geom = ogr.Geometry(ogr.wkbLineString)
+                for x, y in points:
+                    geom.AddPoint_2D(x, y)
+                feat.SetGeometry(geom)
+            layer.CreateFeature(feat)
+        return dataset, layer
+    return create
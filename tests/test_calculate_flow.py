@@ -0,0 +1,114 @@
+import random
+import pytest
+
+pytest.importorskip("ogr")
+pytest.importorskip("common.feature_utils")
+
+import bin.calculate_flow as calculate_flow
+from bin.PassPrint import PassPrint
+from bin.calculate_stream_order import ORDER_TYPES, _assign_orders, _get_node_network
+from bin.network.Network import Network
+
+calculate_flow.printer = PassPrint()
+
+
+def _network(segment_nodes):
+    # network with node incidence from {stream id: (node id, node id)}
+    network = Network(sorted(segment_nodes))
+    incidence = {}
+    for sid in sorted(segment_nodes):
+        for nid in set(segment_nodes[sid]):
+            incidence.setdefault(nid, []).append(sid)
+    node_ids = sorted(incidence)
+    network.set_incidence(node_ids, [incidence[nid] for nid in node_ids])
+    return network
+
+
+def test_tree_orientation():
+    network = _network({10: (1, 2), 11: (2, 3), 12: (2, 4)})
+    braided_count, unconnected = calculate_flow._solve_flow(network, [network.node_index(1)])
+    assert braided_count == 0 and unconnected == []
+    assert network.node_ids_of(network.from_node).tolist() == [2, 3, 4]
+    assert network.node_ids_of(network.to_node).tolist() == [1, 2, 2]
+
+
+def test_loop_is_braided_and_acyclic():
+    network = _network({10: (1, 2), 11: (2, 3), 12: (3, 4), 13: (4, 2), 14: (3, 5)})
+    braided_count, unconnected = calculate_flow._solve_flow(network, [network.node_index(1)])
+    assert unconnected == []
+    assert network.braided.tolist() == [False, True, True, True, False]
+    network.build_adjacency()
+    orders, unordered_count = _assign_orders(network, _get_node_network(network), ORDER_TYPES)
+    assert unordered_count == 0
+
+
+def test_ring_segment_left_unconnected():
+    # outlet 1 <- 2 <- 4, with a segment looping back onto node 2
+    network = _network({10: (1, 2), 11: (2, 2), 12: (2, 4)})
+    braided_count, unconnected = calculate_flow._solve_flow(network, [network.node_index(1)])
+    assert unconnected == [1]
+    assert network.from_node[1] < 0 and network.to_node[1] < 0
+    network.build_adjacency()
+    orders, unordered_count = _assign_orders(network, _get_node_network(network), ("strahler",))
+    assert unordered_count == 0
+    assert orders["strahler"].tolist() == [1, -1, 1]
+
+
+def _random_basins(rng, basin_count):
+    # {stream id: (node id, node id)} of separate random trees with some extra segments closing loops, and the outlet
+    # node of each, nodes numbered on from those of the previous basin
+    segment_nodes = {}
+    outlets = []
+    first = 1
+    for b in range(basin_count):
+        node_count = rng.randint(1, 25)
+        outlets.append(first)
+        for n in range(1, node_count):
+            segment_nodes[len(segment_nodes) + 1] = (first + n, first + rng.randint(0, n - 1))
+        for k in range(rng.randint(0, 3) if node_count > 2 else 0):
+            a, b = rng.sample(range(node_count), 2)
+            segment_nodes[len(segment_nodes) + 1] = (first + a, first + b)
+        first += node_count
+    return segment_nodes, outlets
+
+
+def test_basins_match_single_process():
+    rng = random.Random(4)
+    for trial in range(20):
+        segment_nodes, outlets = _random_basins(rng, rng.randint(1, 8))
+        # some basins without drainage node
+        drainage_ids = [nid for nid in outlets if rng.random() < 0.8]
+        network = _network(segment_nodes)
+        expected = calculate_flow._solve_flow(network, network.node_index(drainage_ids).tolist())
+        basins_network = _network(segment_nodes)
+        result = calculate_flow._solve_flow_basins(basins_network, network.node_index(drainage_ids).tolist(), 2)
+        assert result[0] == expected[0] and sorted(result[1]) == sorted(expected[1])
+        assert basins_network.from_node.tolist() == network.from_node.tolist()
+        assert basins_network.to_node.tolist() == network.to_node.tolist()
+        assert basins_network.braided.tolist() == network.braided.tolist()
+
+
+def test_random_trees_orient_to_outlet():
+    rng = random.Random(10)
+    for trial in range(200):
+        # tree draining to outlet node 1, each node n > 1 draining to a lower node id, segments listed in either
+        # direction and in shuffled order
+        node_count = rng.randint(2, 30)
+        expected = dict((sid, (sid + 1, rng.randint(1, sid))) for sid in range(1, node_count))
+        stream_ids = list(expected)
+        rng.shuffle(stream_ids)
+        tree = dict((sid, expected[sid][::rng.choice([1, -1])]) for sid in stream_ids)
+        network = _network(tree)
+        braided_count, unconnected = calculate_flow._solve_flow(network, [network.node_index(1)])
+        assert braided_count == 0 and unconnected == []
+        assert list(zip(network.node_ids_of(network.from_node).tolist(),
+                        network.node_ids_of(network.to_node).tolist())) == [expected[sid] for sid in sorted(expected)]
+
+        # extra segments closing loops still leave every segment ordered
+        for k in range(rng.randint(1, 3)):
+            tree[node_count + k] = tuple(rng.sample(range(1, node_count + 1), 2))
+        network = _network(tree)
+        calculate_flow._solve_flow(network, [network.node_index(1)])
+        network.build_adjacency()
+        orders, unordered_count = _assign_orders(network, _get_node_network(network), ("strahler",))
+        assert unordered_count == 0
@@ -0,0 +1,178 @@
+import random
+import numpy as np
+import pytest
+
+pytest.importorskip("ogr")
+pytest.importorskip("common.feature_utils")
+
+from bin.calculate_stream_order import ORDER_TYPES, _assign_network_orders, _assign_orders, _assign_orders_basins, \
+    _check_stored_orders, _get_node_network, _strahler_order, _update_orders
+from bin.network.Network import Network
+
+
+def _random_tree(rng, node_count):
+    # stream ids 1.., each node n > 1 draining to a lower node id, outlet node 1
+    from_ids = list(range(2, node_count + 1))
+    to_ids = [rng.randint(1, n - 1) for n in from_ids]
+    return list(range(1, node_count)), from_ids, to_ids
+
+
+def _random_braided_network(rng, node_count, braid_probability=0.2, loop_probability=0.0):
+    # random tree as _random_tree, with extra braided segments from nodes to other lower node ids (and optionally
+    # segments back up to higher node ids, forming loops)
+    segment_ids, from_ids, to_ids = _random_tree(rng, node_count)
+    braided = [False]*len(segment_ids)
+    for n in range(3, node_count + 1):
+        if rng.random() < braid_probability:
+            from_ids.append(n)
+            to_ids.append(rng.randint(1, n - 1))
+            braided.append(True)
+            braided[n - 2] = rng.random() < 0.5
+        if rng.random() < loop_probability:
+            from_ids.append(n)
+            to_ids.append(rng.randint(n, node_count))
+            braided.append(False)
+    return list(range(1, len(from_ids) + 1)), from_ids, to_ids, braided
+
+
+def _orders(segment_ids, from_ids, to_ids, order_types):
+    network = Network.from_node_ids(segment_ids, from_ids, to_ids)
+    orders, unordered_count = _assign_orders(network, _get_node_network(network), order_types)
+    return network, orders
+
+
+def test_reconnected_segment_matches_full_recalculation():
+    order_types = ("strahler", "shreve")
+    rng = random.Random(0)
+    for trial in range(300):
+        segment_ids, from_ids, to_ids = _random_tree(rng, rng.randint(3, 40))
+        network, stored = _orders(segment_ids, from_ids, to_ids, order_types)
+
+        # reconnect one segment to another downstream node
+        s = rng.randrange(len(segment_ids))
+        if from_ids[s] <= 2:
+            continue
+        previous_to = to_ids[s]
+        to_ids = list(to_ids)
+        to_ids[s] = rng.randint(1, from_ids[s] - 1)
+
+        edited, expected = _orders(segment_ids, from_ids, to_ids, order_types)
+        network = Network.from_node_ids(segment_ids, from_ids, to_ids)
+        previous_nodes = network.node_index([from_ids[s], previous_to]).tolist()
+        orders, updated = _update_orders(network, [s], stored, order_types, previous_nodes)
+        for order_type in order_types:
+            assert orders[order_type].tolist() == expected[order_type].tolist()
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_order_types_int64(engine):
+    order_types = ("strahler", "shreve", "horton", "hack")
+    segment_ids, from_ids, to_ids = _random_tree(random.Random(1), 20)
+    network = Network.from_node_ids(segment_ids, from_ids, to_ids)
+    orders, unordered_count = _assign_orders(network, _get_node_network(network), order_types, engine)
+    assert unordered_count == 0
+    for order_type in order_types:
+        assert orders[order_type].dtype == np.int64
+
+
+def test_stored_orders_checked_against_cache():
+    segment_ids, from_ids, to_ids = _random_tree(random.Random(2), 10)
+    network, stored = _orders(segment_ids, from_ids, to_ids, ("strahler",))
+    columns = {"strahler": "STRAHLER"}
+    # cache in reverse segment order, last segment changed since
+    previous_segments = np.arange(network.segment_count)[::-1]
+    cached = [stored["strahler"][previous_segments].copy()]
+    changed = np.array([network.segment_count - 1])
+    _check_stored_orders(network, changed, previous_segments, cached, stored, ("strahler",), columns)
+
+    # order of changed segment can differ, others not
+    cached[0][0] += 1
+    _check_stored_orders(network, changed, previous_segments, cached, stored, ("strahler",), columns)
+    cached[0][1] += 1
+    with pytest.raises(Exception, match="don't match"):
+        _check_stored_orders(network, changed, previous_segments, cached, stored, ("strahler",), columns)
+
+    # unchanged segment missing from cache
+    cached[0][1] -= 1
+    with pytest.raises(Exception, match="out of date"):
+        _check_stored_orders(network, changed, previous_segments[:-1], [cached[0][:-1]], stored, ("strahler",), columns)
+
+
+def test_strahler_matches_recursive_definition():
+    rng = random.Random(11)
+    for trial in range(200):
+        segment_ids, from_ids, to_ids, braided = _random_braided_network(rng, rng.randint(2, 60))
+        network = Network.from_node_ids(segment_ids, from_ids, to_ids, braided)
+        orders, unordered_count = _assign_orders(network, _get_node_network(network), ("strahler",))
+
+        # order of each segment by the node rule applied to orders of all segments into its from node, recursively
+        expected = {}
+
+        def order(s):
+            if s not in expected:
+                upstream = [u for u in range(len(segment_ids)) if to_ids[u] == from_ids[s]]
+                expected[s] = _strahler_order([order(u) for u in upstream], [braided[u] for u in upstream])
+            return expected[s]
+
+        assert orders["strahler"].tolist() == [order(s) for s in range(len(segment_ids))]
+
+
+def test_numpy_engine_matches_python():
+    rng = random.Random(3)
+    for trial in range(200):
+        network_args = _random_braided_network(rng, rng.randint(2, 60), loop_probability=0.05 if trial % 2 else 0)
+        results = []
+        for engine in ("python", "numpy"):
+            network = Network.from_node_ids(*network_args)
+            results.append(_assign_orders(network, _get_node_network(network), ORDER_TYPES, engine))
+        (python_orders, python_unordered), (numpy_orders, numpy_unordered) = results
+        assert numpy_unordered == python_unordered
+        for order_type in ORDER_TYPES:
+            assert numpy_orders[order_type].tolist() == python_orders[order_type].tolist()
+
+
+def test_basins_match_single_process():
+    rng = random.Random(5)
+    for trial in range(20):
+        # several basins, node ids numbered on from those of the previous one
+        segment_ids, from_ids, to_ids, braided = [], [], [], []
+        for b in range(rng.randint(1, 8)):
+            first = max(from_ids + to_ids + [0])
+            basin = _random_braided_network(rng, rng.randint(2, 30), loop_probability=0.05)
+            from_ids += [nid + first for nid in basin[1]]
+            to_ids += [nid + first for nid in basin[2]]
+            braided += basin[3]
+        segment_ids = list(range(1, len(from_ids) + 1))
+        network = Network.from_node_ids(segment_ids, from_ids, to_ids, braided)
+        expected, expected_unordered = _assign_orders(network, _get_node_network(network), ORDER_TYPES)
+        network = Network.from_node_ids(segment_ids, from_ids, to_ids, braided)
+        orders, unordered_count = _assign_orders_basins(network, ORDER_TYPES, "python", 2)
+        assert unordered_count == expected_unordered
+        for order_type in ORDER_TYPES:
+            assert orders[order_type].tolist() == expected[order_type].tolist()
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_compressed_chains_match_full_network(engine):
+    rng = random.Random(6)
+    for trial in range(100):
+        segment_ids, from_ids, to_ids, braided = _random_braided_network(rng, rng.randint(2, 40),
+                                                                        loop_probability=0.05 if trial % 2 else 0)
+        # split segments into chains through new pass-through nodes, in shuffled segment order
+        next_id = max(from_ids + to_ids) + 1
+        segments = []
+        for from_id, to_id, is_braided in zip(from_ids, to_ids, braided):
+            count = rng.randint(0, 3) if rng.random() < 0.5 else 0
+            nodes = [from_id] + list(range(next_id, next_id + count)) + [to_id]
+            next_id += count
+            segments += [(a, b, is_braided) for a, b in zip(nodes[:-1], nodes[1:])]
+        rng.shuffle(segments)
+        segment_ids = list(range(1, len(segments) + 1))
+        from_ids, to_ids, braided = [list(values) for values in zip(*segments)]
+
+        network = Network.from_node_ids(segment_ids, from_ids, to_ids, braided)
+        orders, unordered_count = _assign_orders(network, _get_node_network(network), ORDER_TYPES, engine)
+        network = Network.from_node_ids(segment_ids, from_ids, to_ids, braided)
+        expected = _assign_network_orders(network, _get_node_network(network), ORDER_TYPES, engine)
+        for order_type in ORDER_TYPES:
+            assert orders[order_type].tolist() == expected[order_type].tolist()
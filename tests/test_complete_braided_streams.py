@@ -0,0 +1,81 @@
+import random
+import pytest
+
+pytest.importorskip("ogr")
+pytest.importorskip("gdal")
+pytest.importorskip("common.feature_utils")
+pytest.importorskip("common.raster_utils")
+
+import bin.complete_braided_streams as complete_braided_streams
+from bin.PassPrint import PassPrint
+from bin.complete_braided_streams import _find_braided_networks
+from bin.network.Network import Network
+
+complete_braided_streams.printer = PassPrint()
+
+
+def _random_braided_dag(rng, node_count, braid_probability=0.3, outlet_probability=0.0):
+    # each node n > 1 drains to a lower node id, outlet node 1, with extra braided segments to other lower node ids
+    # (and optionally segments leaving the network, to node id 0)
+    from_ids = list(range(2, node_count + 1))
+    to_ids = [rng.randint(1, n - 1) for n in from_ids]
+    braided = [False]*len(from_ids)
+    for n in range(3, node_count + 1):
+        if rng.random() < braid_probability:
+            from_ids.append(n)
+            to_ids.append(rng.randint(1, n - 1))
+            braided.append(True)
+        if rng.random() < outlet_probability:
+            from_ids.append(n)
+            to_ids.append(0)
+            braided.append(False)
+    return list(range(1, len(from_ids) + 1)), from_ids, to_ids, braided
+
+
+def _expected_braids(segment_ids, from_ids, to_ids, braided):
+    # brute force: post-dominator sets of each node, from lowest node id up as all flow is to lower ids, with nodes
+    # without segments out draining to the exit (node 0). The immediate post-dominator is the one with one fewer
+    # post-dominator itself. Braid is every segment reachable from the split node before its rejoin node. None if any
+    # braid leaves the network before rejoining.
+    out_segments = {}
+    for s, from_id in enumerate(from_ids):
+        out_segments.setdefault(from_id, []).append(s)
+    post_dominators = {0: {0}}
+    for node in sorted(set(from_ids + to_ids) - {0}):
+        shared = {0}
+        for i, s in enumerate(out_segments.get(node, [])):
+            shared = set(post_dominators[to_ids[s]]) if not i else shared & post_dominators[to_ids[s]]
+        post_dominators[node] = {node} | shared
+
+    in_braid = set()
+    for split_node in set(from_ids[s] for s in range(len(from_ids)) if braided[s]):
+        rejoin_node = [node for node in post_dominators[split_node] - {split_node}
+                       if len(post_dominators[node]) == len(post_dominators[split_node]) - 1][0]
+        if rejoin_node == 0:
+            return None
+        stack = [split_node]
+        seen = set(stack)
+        while stack:
+            for s in out_segments.get(stack.pop(), []):
+                in_braid.add(segment_ids[s])
+                if to_ids[s] != rejoin_node and to_ids[s] not in seen:
+                    seen.add(to_ids[s])
+                    stack.append(to_ids[s])
+    return in_braid
+
+
+def test_braids_match_brute_force():
+    rng = random.Random(7)
+    for trial in range(300):
+        segment_ids, from_ids, to_ids, braided = _random_braided_dag(rng, rng.randint(3, 40),
+                                                                    outlet_probability=0.05 if trial % 2 else 0)
+        if not any(braided):
+            continue
+        network = Network.from_node_ids(segment_ids, from_ids, to_ids, braided)
+        braided_segments = [s for s in range(len(braided)) if braided[s]]
+        expected = _expected_braids(segment_ids, from_ids, to_ids, braided)
+        if expected is None:
+            with pytest.raises(Exception, match="Could not parse braided stream network"):
+                _find_braided_networks(network, braided_segments)
+        else:
+            assert set(_find_braided_networks(network, braided_segments)) == expected
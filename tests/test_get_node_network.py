@@ -0,0 +1,85 @@
+import math
+import random
+import pytest
+
+pytest.importorskip("ogr")
+pytest.importorskip("common.feature_utils")
+
+import bin.get_node_network as get_node_network
+from bin.PassPrint import PassPrint
+from bin.external_sort import RecordSpool, _external_sort
+from bin.get_node_network import _cluster_endpoints, _get_node_network_external, _read_end_nodes, _consolidate_nodes, \
+    _sweep_clusters
+from bin.network.Network import Network
+
+
+def test_null_stream_ids_skipped(memory_layer):
+    dataset, layer = memory_layer([
+        (1, [(0, 0), (1, 0)]),
+        (None, [(1, 0), (2, 0)]),
+        (3, [(1, 0), (1, 1)])
+    ])
+    defn = layer.GetLayerDefn()
+    all_nodes, all_stream_ids, all_fids = _read_end_nodes(layer, defn.GetFieldDefn(defn.GetFieldIndex("SID")))
+    assert all_stream_ids == [1, 3]
+    assert len(all_fids) == 2 and len(all_nodes) == 4
+    network = Network(all_stream_ids)
+    assert network.segment_ids.tolist() == [1, 3]
+    nodes = _consolidate_nodes(all_nodes, 0.1)
+    assert sorted(sorted(node.segments) for node in nodes) == [[1], [1, 3], [3]]
+
+
+def test_missing_geometries_skipped(memory_layer):
+    dataset, layer = memory_layer([
+        (1, [(0, 0), (1, 0)]),
+        (2, None),
+        (3, []),
+        (4, [(1, 0), (1, 1)])
+    ])
+    defn = layer.GetLayerDefn()
+    all_nodes, all_stream_ids, all_fids = _read_end_nodes(layer, defn.GetFieldDefn(defn.GetFieldIndex("SID")))
+    assert all_stream_ids == [1, 4]
+    assert len(all_fids) == 2 and len(all_nodes) == 4
+
+
+def test_external_skips_as_in_memory(tmp_path, monkeypatch, memory_layer):
+    pyarrow = pytest.importorskip("pyarrow")
+    monkeypatch.setattr(get_node_network, "printer", PassPrint())
+    dataset, layer = memory_layer([
+        (1, [(0, 0), (1, 0)]),
+        (None, [(1, 0), (2, 0)]),
+        (2, None),
+        (3, [(1, 0), (1, 1)]),
+        (4, [(1, 1), (2, 2)])
+    ])
+    defn = layer.GetLayerDefn()
+    id_field_defn = defn.GetFieldDefn(defn.GetFieldIndex("SID"))
+    all_nodes, all_stream_ids, _ = _read_end_nodes(layer, id_field_defn)
+    expected = sorted(sorted(node.segments) for node in _consolidate_nodes(all_nodes, 0.1))
+
+    layer.ResetReading()
+    table_path = str(tmp_path / "network.parquet")
+    _get_node_network_external(layer, id_field_defn, None, str(tmp_path / "nodes.gpkg"), table_path, None, 0.1, 1)
+    stream_ids = pyarrow.parquet.read_table(table_path).column("STREAM_IDS").to_pylist()
+    assert sorted(sorted(sids) for sids in stream_ids) == expected
+
+
+def test_sweep_clusters_match_in_memory(tmp_path):
+    rng = random.Random(9)
+    for trial in range(60):
+        tolerance = rng.choice([0, 0.5, 1.0, 2.5])
+        cell_size = tolerance if tolerance > 0 else 1.0
+        extent = rng.choice([5, 20, 100])
+        # many points per trial to sort in several runs, on a coarse grid so some coincide
+        coords = [(rng.randint(-extent*4, extent*4) / 4.0, rng.randint(-extent*4, extent*4) / 4.0)
+                  for i in range(rng.choice([10, 300, 3000]))]
+        spool = RecordSpool([('cx', '<i8'), ('cy', '<i8'), ('seq', '<i8'), ('x', '<f8'), ('y', '<f8'), ('sid', '<i8')],
+                            str(tmp_path), 100)
+        try:
+            for seq, (x, y) in enumerate(coords):
+                spool.append((int(math.floor(x / cell_size)), int(math.floor(y / cell_size)), seq, x, y, 0))
+            records = _external_sort(spool, ['cx', 'cy', 'seq'], 0.01, str(tmp_path))
+            clusters = [[member[2] for member in cluster] for cluster in _sweep_clusters(records, tolerance)]
+        finally:
+            spool.remove()
+        assert sorted(clusters) == sorted(_cluster_endpoints(coords, tolerance))
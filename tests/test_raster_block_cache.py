@@ -0,0 +1,47 @@
+import random
+import numpy as np
+
+from bin.RasterBlockCache import RasterBlockCache
+
+
+class _Band(object):
+    # raster band over an array, counting block reads
+    def __init__(self, values, block_size, nodata=None):
+        self.values = values
+        self.block_size = block_size
+        self.nodata = nodata
+        self.YSize, self.XSize = values.shape
+        self.reads = 0
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+    def GetNoDataValue(self):
+        return self.nodata
+
+    def ReadAsArray(self, x0, y0, width, height):
+        self.reads += 1
+        return self.values[y0:y0 + height, x0:x0 + width].copy()
+
+
+def test_samples_match_array():
+    rng = random.Random(8)
+    for trial in range(100):
+        height, width = rng.randint(1, 40), rng.randint(1, 40)
+        values = np.array([[rng.randint(0, 5) for x in range(width)] for y in range(height)])
+        nodata = 0 if trial % 2 else None
+        band = _Band(values, (rng.randint(1, 16), rng.randint(1, 16)), nodata)
+        cache = RasterBlockCache(band, max_blocks=rng.randint(1, 4))
+        for call in range(3):
+            count = rng.randint(0, 50)
+            px = [rng.randint(-3, width + 2) for i in range(count)]
+            py = [rng.randint(-3, height + 2) for i in range(count)]
+            expected = [float(values[y, x]) if 0 <= x < width and 0 <= y < height and values[y, x] != nodata
+                        else np.nan for x, y in zip(px, py)]
+            reads = band.reads
+            sampled = cache.sample(px, py)
+            np.testing.assert_array_equal(sampled, expected)
+            # each block read at most once per call
+            blocks = set((x // band.block_size[0], y // band.block_size[1]) for x, y in zip(px, py)
+                         if 0 <= x < width and 0 <= y < height)
+            assert band.reads - reads <= len(blocks)
@@ -0,0 +1,78 @@
+from fractions import Fraction
+import numpy as np
+import pytest
+from bin.segment_intersection import _intersect_segment_arrays, _intersect_polyline_pairs
+
+
+def _random_segments(count, seed):
+    rng = np.random.RandomState(seed)
+    return [rng.uniform(-10, 10, (count, 2)) for i in range(4)]
+
+
+def _exact_crossing(p0, p1, q0, q1):
+    # reference crossing point in exact arithmetic, None if segments don't properly cross
+    p0, p1, q0, q1 = [[Fraction(float(v)) for v in point] for point in (p0, p1, q0, q1)]
+    r = (p1[0] - p0[0], p1[1] - p0[1])
+    s = (q1[0] - q0[0], q1[1] - q0[1])
+    denom = r[0]*s[1] - r[1]*s[0]
+    if denom == 0:
+        return None
+    qp = (q0[0] - p0[0], q0[1] - p0[1])
+    t = (qp[0]*s[1] - qp[1]*s[0]) / denom
+    u = (qp[0]*r[1] - qp[1]*r[0]) / denom
+    if not (0 < t < 1 and 0 < u < 1):
+        return None
+    return float(p0[0] + t*r[0]), float(p0[1] + t*r[1])
+
+
+def test_proper_crossing():
+    hit, points, degenerate = _intersect_segment_arrays(
+        np.array([[0.0, 0.0]]), np.array([[2.0, 0.0]]), np.array([[1.0, -1.0]]), np.array([[1.0, 3.0]])
+    )
+    assert hit[0] and not degenerate[0]
+    assert np.allclose(points[0], (1.0, 0.0))
+
+
+def test_pair_vertices():
+    # line 0 crossed mid-segment by line 1, and touched at its vertex (2, 0) by the vertex of line 2
+    coords = [(0, 0), (1, 0), (2, 0), (3, 0), (0.5, -1), (0.5, 1), (2, -1), (2, 0), (2, 1)]
+    offsets = [0, 4, 6, 9]
+    results = list(_intersect_polyline_pairs(coords, offsets, [(0, 1), (0, 2), (1, 2)]))
+    assert [(i, j) for i, j, points, this_vertices, that_vertices in results] == [(0, 1), (0, 2)]
+    i, j, points, this_vertices, that_vertices = results[0]
+    assert points.tolist() == [[0.5, 0.0]] and this_vertices.tolist() == [0] and that_vertices.tolist() == [0]
+    i, j, points, this_vertices, that_vertices = results[1]
+    assert points.tolist() == [[2.0, 0.0]] and this_vertices.tolist() == [1] and that_vertices.tolist() == [0]
+
+
+def test_random_crossings_match_exact():
+    p0, p1, q0, q1 = _random_segments(2000, 1)
+    hit, points, degenerate = _intersect_segment_arrays(p0, p1, q0, q1)
+    crossings = 0
+    for k in range(len(p0)):
+        expected = _exact_crossing(p0[k], p1[k], q0[k], q1[k])
+        assert hit[k] == (expected is not None)
+        if expected is not None:
+            crossings += 1
+            assert np.allclose(points[k], expected)
+    assert crossings > 100
+
+
+def test_random_crossings_match_geos():
+    ogr = pytest.importorskip("ogr")
+    p0, p1, q0, q1 = _random_segments(500, 2)
+    for k in range(len(p0)):
+        lines = []
+        for a, b in ((p0[k], p1[k]), (q0[k], q1[k])):
+            line = ogr.Geometry(ogr.wkbLineString)
+            line.AddPoint_2D(a[0], a[1])
+            line.AddPoint_2D(b[0], b[1])
+            lines.append(line)
+        intersection = lines[0].Intersection(lines[1])
+        results = list(_intersect_polyline_pairs([p0[k], p1[k], q0[k], q1[k]], [0, 2, 4], [(0, 1)]))
+        if intersection.IsEmpty():
+            assert not len(results)
+        else:
+            i, j, points, this_vertices, that_vertices = results[0]
+            assert len(points) == 1
+            assert np.allclose(points[0], intersection.GetPoint_2D(0))
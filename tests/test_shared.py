@@ -0,0 +1,108 @@
+import pytest
+
+ogr = pytest.importorskip("ogr")
+pytest.importorskip("common.feature_utils")
+
+import numpy as np
+import bin.shared as shared
+from bin.network.Network import Network
+from bin.shared import _copy_feature_dataset_as_empty, _dataset_fingerprint, _load_cache, _save_cache, \
+    _write_segment_columns
+
+
+@pytest.mark.parametrize("extension,driver_name", [(".gpkg", "GPKG"), (".fgb", "FlatGeobuf")])
+def test_empty_copy_driver_by_extension(tmp_path, memory_layer, extension, driver_name):
+    path = str(tmp_path / ("streams" + extension))
+    dataset, layer = memory_layer([(1, [(0, 0), (1, 0)])])
+    copy_dataset = _copy_feature_dataset_as_empty(dataset, path, ogr.wkbLineString)
+    assert copy_dataset.GetDriver().GetName() == driver_name
+    layer = copy_dataset.GetLayer()
+    assert layer.GetFeatureCount() == 0
+    assert layer.GetLayerDefn().GetFieldIndex("SID") >= 0
+    copy_dataset = None
+    assert ogr.Open(path).GetDriver().GetName() == driver_name
+
+
+class _TransactionLayer(object):
+    # layer reporting transaction support, logging transactions and failing on a given SetFeature call
+    def __init__(self, layer, fail_at=None):
+        self.layer = layer
+        self.fail_at = fail_at
+        self.log = []
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    def TestCapability(self, capability):
+        return capability == ogr.OLCTransactions or self.layer.TestCapability(capability)
+
+    def StartTransaction(self):
+        self.log.append("start")
+
+    def CommitTransaction(self):
+        self.log.append("commit")
+
+    def RollbackTransaction(self):
+        self.log.append("rollback")
+
+    def SetFeature(self, feat):
+        if self.fail_at is not None and self.log.count("set") == self.fail_at:
+            raise RuntimeError("write failed")
+        self.log.append("set")
+        return self.layer.SetFeature(feat)
+
+
+class _Dataset(object):
+    def __init__(self, layer):
+        self.layer = layer
+
+    def GetLayerCount(self):
+        return 1
+
+    def GetLayer(self, i=0):
+        return self.layer
+
+
+def _write_network(layer):
+    layer.ResetReading()
+    fids = []
+    feat = layer.GetNextFeature()
+    while feat:
+        fids.append(feat.GetFID())
+        feat = layer.GetNextFeature()
+    network = Network(list(range(1, len(fids) + 1)))
+    network.fids = np.array(fids, dtype=np.int64)
+    return network
+
+
+@pytest.mark.parametrize("fail_at", [None, 0, 1])
+def test_write_segment_columns_rolls_back(monkeypatch, memory_layer, fail_at):
+    dataset, layer = memory_layer([(1, [(0, 0), (1, 0)]), (2, [(1, 0), (2, 0)])])
+    wrapped = _TransactionLayer(layer, fail_at)
+    monkeypatch.setattr(shared.feature_utils, "getFeatureDataset", lambda path, write=False: _Dataset(wrapped))
+
+    network = _write_network(layer)
+    if fail_at is None:
+        written, created = _write_segment_columns("streams.gpkg", network, [("SID", [5, 6])])
+        assert written == 2 and created == []
+        assert wrapped.log == ["start", "set", "set", "commit"]
+    else:
+        with pytest.raises(RuntimeError):
+            _write_segment_columns("streams.gpkg", network, [("SID", [5, 6])])
+        assert wrapped.log[0] == "start" and wrapped.log[-1] == "rollback"
+
+
+def test_cache_invalidated_by_dataset_change(tmp_path):
+    path = str(tmp_path / "streams.gpkg")
+    cache_path = str(tmp_path / "streams.npz")
+    with open(path, 'wb') as f:
+        f.write(b"streams")
+    fingerprint = _dataset_fingerprint(path)
+    _save_cache(cache_path, fingerprint, {'segment_ids': np.array([3, 1, 2])})
+    assert _load_cache(cache_path, _dataset_fingerprint(path))['segment_ids'].tolist() == [3, 1, 2]
+
+    with open(path, 'ab') as f:
+        f.write(b" edited")
+    assert _dataset_fingerprint(path) != fingerprint
+    assert _load_cache(cache_path, _dataset_fingerprint(path)) is None
+    assert _dataset_fingerprint(str(tmp_path / "missing.gpkg")) is None
@@ -0,0 +1,46 @@
+import pytest
+
+pyarrow = pytest.importorskip("pyarrow")
+
+from bin.tables import TableWriter, _read_table, _write_table
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".arrow"])
+def test_empty_table_typed(tmp_path, extension):
+    path = str(tmp_path / ("nodes" + extension))
+    writer = TableWriter(path, [("NODE", "int64"), ("STREAM_IDS", "int64 list"), ("X", "float64")])
+    writer.close()
+    table = _read_table(path)
+    assert table.num_rows == 0
+    assert table.schema.field("NODE").type == pyarrow.int64()
+    assert table.schema.field("STREAM_IDS").type == pyarrow.list_(pyarrow.int64())
+    assert table.schema.field("X").type == pyarrow.float64()
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".arrow"])
+def test_table_round_trip(tmp_path, extension):
+    path = str(tmp_path / ("nodes" + extension))
+    _write_table(path, [
+        ("NODE", "int64", [1, 2]),
+        ("STREAM_IDS", "int64 list", [[1, 2], [2]]),
+        ("FROM", "int64", [None, 1])
+    ])
+    table = _read_table(path)
+    assert table.column("NODE").to_pylist() == [1, 2]
+    assert table.column("STREAM_IDS").to_pylist() == [[1, 2], [2]]
+    assert table.column("FROM").to_pylist() == [None, 1]
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".arrow"])
+def test_empty_node_table_read(tmp_path, extension):
+    pytest.importorskip("ogr")
+    pytest.importorskip("common.feature_utils")
+    from bin.get_node_network import _write_node_tables
+    from bin.shared import _read_node_arrays
+
+    path = str(tmp_path / ("nodes" + extension))
+    _write_node_tables([], {}, path, None)
+    arrays = _read_node_arrays(path, True)
+    assert len(arrays['node_ids']) == 0
+    assert arrays['offsets'].tolist() == [0]
+    assert len(arrays['stream_ids']) == 0